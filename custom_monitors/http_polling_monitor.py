@@ -0,0 +1,551 @@
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Base class (mixin) for monitors which poll one or more HTTP APIs (targets) on each sample interval.
+
+It takes care of the functionality which is common to all the HTTP polling monitors:
+
+- Persistent HTTP session with a connection pool so connections are re-used across samples.
+- Polling multiple targets concurrently using a bounded thread pool. Responses are handled in the
+  monitor thread as soon as each request completes and requests which are still in progress when
+  the next sample is gathered are skipped for that sample.
+- Connect and read timeouts.
+- Retrying requests which failed because of a connection error, timeout or a server error using
+  exponential backoff with jitter.
+- Circuit breaker which stops polling targets which are down (after a number of consecutive
+  failures) and only tries them again after a cool down period which grows exponentially while
+  the target stays down.
+- Optional request latency and error count self-metrics.
+
+Monitors need to inherit from both, this mixin and ScalyrMonitor (in that order), for example
+"class PiHoleMonitor(HTTPPollingMonitorMixin, ScalyrMonitor)". Agent only loads monitor classes
+which directly inherit from ScalyrMonitor so this module itself doesn't define any monitor.
+
+Monitors need to call "_initialize_http_polling()" and "_set_targets()" in "_initialize()" and
+implement "_get_jobs()" (abstract method) which returns a list of (target, fetch function, fetch function args,
+handler function) tuples. Fetch function runs in the thread pool and should use "_request()" to
+perform HTTP requests and handler function is called in the monitor thread with the target and
+the value returned by the fetch function.
+"""
+
+if False:
+    from typing import Optional
+    from typing import Dict
+    from typing import List
+    from typing import Tuple
+    from typing import Any
+    from typing import Callable
+
+import abc
+import time
+import random
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import as_completed
+
+import six
+import requests
+from requests.adapters import HTTPAdapter
+
+from scalyr_agent import define_config_option
+from scalyr_agent import define_metric
+
+# Response status codes for which the request is retried
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# How long to wait for the responses during a single sample (as a fraction of the sample
+# interval). Responses which arrive later are handled during the next sample so a single slow
+# target doesn't delay the sample for all the other targets.
+RESULTS_WAIT_TIMEOUT_RATIO = 0.5
+
+
+def define_http_polling_config_options(monitor_module, service_name, metric_prefix):
+    # type: (str, str, str) -> None
+    """
+    Define config options and self-metrics which are common to all the HTTP polling monitors for
+    the provided monitor module.
+    """
+    define_config_option(
+        monitor_module,
+        "max_concurrency",
+        "Maximum number of targets to poll concurrently. Defaults to 16.",
+        default=16,
+        convert_to=int,
+        min_value=1,
+    )
+    define_config_option(
+        monitor_module,
+        "connect_timeout",
+        "Timeout (in seconds) for establishing connection to the %s API. Defaults to 5."
+        % (service_name),
+        default=5,
+        convert_to=float,
+    )
+    define_config_option(
+        monitor_module,
+        "read_timeout",
+        "Timeout (in seconds) for reading the %s API response. Defaults to 10." % (service_name),
+        default=10,
+        convert_to=float,
+    )
+    define_config_option(
+        monitor_module,
+        "pool_size",
+        "Maximum number of persistent HTTP connections to keep open per target. Defaults to 4.",
+        default=4,
+        convert_to=int,
+        min_value=1,
+    )
+    define_config_option(
+        monitor_module,
+        "max_retries",
+        "Maximum number of times a request which failed because of a connection error, timeout or "
+        "a server error is retried during a single sample. Defaults to 1.",
+        default=1,
+        convert_to=int,
+        min_value=0,
+    )
+    define_config_option(
+        monitor_module,
+        "retry_backoff",
+        "Base delay (in seconds) for the exponential backoff between retries. Defaults to 0.5.",
+        default=0.5,
+        convert_to=float,
+    )
+    define_config_option(
+        monitor_module,
+        "circuit_breaker_threshold",
+        "Number of consecutive failed requests after which the target is not polled anymore until "
+        "the circuit breaker cool down period has passed. 0 disables the circuit breaker. "
+        "Defaults to 3.",
+        default=3,
+        convert_to=int,
+        min_value=0,
+    )
+    define_config_option(
+        monitor_module,
+        "circuit_breaker_cooldown",
+        "How long (in seconds) to wait before polling a target again after the circuit breaker "
+        "has been opened. Cool down is doubled for every subsequent failure. Defaults to 60.",
+        default=60,
+        convert_to=float,
+    )
+    define_config_option(
+        monitor_module,
+        "circuit_breaker_max_cooldown",
+        "Maximum circuit breaker cool down period in seconds. Defaults to 900.",
+        default=900,
+        convert_to=float,
+    )
+    define_config_option(
+        monitor_module,
+        "emit_request_metrics",
+        "True to emit request latency and error count metrics for each target. Defaults to False.",
+        default=False,
+        convert_to=bool,
+    )
+
+    define_metric(
+        monitor_module,
+        metric_prefix + ".http.request.latency_ms",
+        "Average %s API request latency in milliseconds during the sample." % (service_name),
+    )
+    define_metric(
+        monitor_module,
+        metric_prefix + ".http.request.errors",
+        "Number of failed %s API requests (including retries) during the sample."
+        % (service_name),
+    )
+
+
+def get_backoff_delay(attempt, base_delay, max_delay):
+    # type: (int, float, float) -> float
+    """
+    Return exponential backoff delay for the provided attempt (starting with 0) with "equal
+    jitter" (random value between half and full exponential delay) so the requests for targets
+    which failed at the same time are spread out.
+    """
+    delay = min(base_delay * (2 ** attempt), max_delay)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker which is opened after a number of consecutive failures. While the circuit is
+    open, no requests are allowed. Once the cool down period has passed, requests are allowed
+    again and the first failure opens the circuit again with a longer cool down period.
+    """
+
+    def __init__(self, failure_threshold, cooldown, max_cooldown):
+        # type: (int, float, float) -> None
+        self.__failure_threshold = failure_threshold
+        self.__cooldown = cooldown
+        self.__max_cooldown = max_cooldown
+
+        self.__lock = threading.Lock()
+        self.__consecutive_failures = 0
+        self.__open_until = 0.0
+
+    def allow_request(self, now):
+        # type: (float) -> bool
+        with self.__lock:
+            return now >= self.__open_until
+
+    def record_success(self):
+        # type: () -> None
+        with self.__lock:
+            self.__consecutive_failures = 0
+            self.__open_until = 0.0
+
+    def record_failure(self, now):
+        # type: (float) -> Optional[float]
+        """
+        Record a failure and return the cool down period (in seconds) if the circuit has been
+        opened because of this failure.
+        """
+        with self.__lock:
+            self.__consecutive_failures += 1
+
+            if not self.__failure_threshold:
+                return None
+
+            if self.__consecutive_failures < self.__failure_threshold:
+                return None
+
+            cooldown = get_backoff_delay(
+                self.__consecutive_failures - self.__failure_threshold,
+                self.__cooldown,
+                self.__max_cooldown,
+            )
+            self.__open_until = now + cooldown
+
+            return cooldown
+
+
+class RequestStats(object):
+    """
+    Request latency and error count for a single target since the last call to get_and_reset().
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__count = 0
+        self.__latency_sum = 0.0
+        self.__errors = 0
+
+    def record(self, latency, error):
+        # type: (float, bool) -> None
+        with self.__lock:
+            self.__count += 1
+            self.__latency_sum += latency
+
+            if error:
+                self.__errors += 1
+
+    def get_and_reset(self):
+        # type: () -> Tuple[int, float, int]
+        """
+        Return (request count, latency sum in seconds, error count) and reset the values.
+        """
+        with self.__lock:
+            values = (self.__count, self.__latency_sum, self.__errors)
+            self.__count, self.__latency_sum, self.__errors = 0, 0.0, 0
+
+        return values
+
+
+class HTTPPollingTarget(object):
+    """
+    HTTP API which is polled by the monitor.
+    """
+
+    def __init__(self, base_url, timeout=None, extra_fields=None):
+        # type: (str, Optional[float], Optional[Dict[str, Any]]) -> None
+        if base_url.endswith("/"):
+            base_url = str(base_url[:-1])
+
+        self.base_url = base_url
+        self.timeout = timeout
+        self.extra_fields = extra_fields or {}
+
+        # NOTE: Those are set by the monitor once the targets are registered
+        self.circuit_breaker = None  # type: Optional[CircuitBreaker]
+        self.request_stats = RequestStats()
+
+
+@six.add_metaclass(abc.ABCMeta)
+class HTTPPollingMonitorMixin(object):
+    # Prefix for the self-metrics names (e.g. "pihole")
+    metric_prefix = "http_polling"
+
+    def _initialize_http_polling(self):
+        # type: () -> None
+        self._connect_timeout = self._config.get(
+            "connect_timeout", convert_to=float, default=5,
+        )
+        self._read_timeout = self._config.get(
+            "read_timeout", convert_to=float, default=10,
+        )
+        self._pool_size = self._config.get(
+            "pool_size", convert_to=int, default=4, min_value=1,
+        )
+        self._max_concurrency = self._config.get(
+            "max_concurrency", convert_to=int, default=16, min_value=1,
+        )
+        self._max_retries = self._config.get(
+            "max_retries", convert_to=int, default=1, min_value=0,
+        )
+        self._retry_backoff = self._config.get(
+            "retry_backoff", convert_to=float, default=0.5,
+        )
+        self._circuit_breaker_threshold = self._config.get(
+            "circuit_breaker_threshold", convert_to=int, default=3, min_value=0,
+        )
+        self._circuit_breaker_cooldown = self._config.get(
+            "circuit_breaker_cooldown", convert_to=float, default=60,
+        )
+        self._circuit_breaker_max_cooldown = self._config.get(
+            "circuit_breaker_max_cooldown", convert_to=float, default=900,
+        )
+        self._emit_request_metrics = self._config.get(
+            "emit_request_metrics", convert_to=bool, default=False,
+        )
+
+        self._targets = []  # type: List[Any]
+
+        # Time spent waiting for the responses is subtracted from the sleep between samples so
+        # the targets are polled on a fixed cadence
+        self._adjust_sleep_by_gather_time = True
+
+        # NOTE: Session and thread pool are created lazily on first sample since _initialize() is
+        # also called when stopping the agent
+        self.__session = None  # type: Optional[requests.Session]
+        self.__executor = None  # type: Optional[ThreadPoolExecutor]
+
+        # Maps futures for jobs which are still in progress to (target, handler function)
+        self.__pending_futures = {}  # type: Dict[Any, Tuple[Any, Callable]]
+
+    def _set_targets(self, targets, default_extra_field):
+        # type: (List[Any], str) -> None
+        """
+        Register targets which are polled by this monitor.
+
+        If there are multiple targets, targets without extra fields get "default_extra_field"
+        extra field set to the target base URL so we can tell them apart.
+        """
+        if len(targets) > 1:
+            for target in targets:
+                if not target.extra_fields:
+                    target.extra_fields = {default_extra_field: target.base_url}
+
+        for target in targets:
+            target.circuit_breaker = CircuitBreaker(
+                failure_threshold=self._circuit_breaker_threshold,
+                cooldown=self._circuit_breaker_cooldown,
+                max_cooldown=self._circuit_breaker_max_cooldown,
+            )
+
+        self._targets = targets
+
+    def stop(self, *args, **kwargs):
+        if self.__executor:
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
+
+        self.__pending_futures = {}
+
+        if self.__session:
+            self.__session.close()
+            self.__session = None
+
+        super(HTTPPollingMonitorMixin, self).stop(*args, **kwargs)
+
+    def _get_session(self):
+        # type: () -> requests.Session
+        if not self.__session:
+            adapter = HTTPAdapter(
+                pool_connections=max(len(self._targets), 1), pool_maxsize=self._pool_size
+            )
+
+            self.__session = requests.Session()
+            self.__session.mount("http://", adapter)
+            self.__session.mount("https://", adapter)
+
+        return self.__session
+
+    def _get_executor(self, jobs_count):
+        # type: (int) -> ThreadPoolExecutor
+        if not self.__executor:
+            self.__executor = ThreadPoolExecutor(
+                max_workers=min(max(jobs_count, 1), self._max_concurrency)
+            )
+
+        return self.__executor
+
+    @abc.abstractmethod
+    def _get_jobs(self):
+        # type: () -> List[Tuple[Any, Callable, Tuple, Callable]]
+        """
+        Return a list of (target, fetch function, fetch function args, handler function) tuples
+        for all the jobs which need to run on each sample.
+        """
+        pass
+
+    def gather_sample(self):
+        # type: () -> None
+        self._run_jobs(self._get_jobs())
+
+        if self._emit_request_metrics:
+            self._emit_request_stats()
+
+    def _run_jobs(self, jobs):
+        # type: (List[Tuple[Any, Callable, Tuple, Callable]]) -> None
+        # NOTE: Thread pool is sized for all the configured jobs and not only for the ones which
+        # run during this sample
+        jobs_count = len(jobs)
+
+        # Dead targets are skipped until the circuit breaker cool down period has passed
+        now = time.time()
+        jobs = [job for job in jobs if job[0].circuit_breaker.allow_request(now)]
+
+        if not jobs and not self.__pending_futures:
+            return
+
+        if len(jobs) == 1 and not self.__pending_futures:
+            target, fetch_func, args, handler_func = jobs[0]
+            self._handle_job_result(target, handler_func, lambda: fetch_func(target, *args))
+            return
+
+        # NOTE: HTTP requests are performed concurrently in the thread pool, but we handle the
+        # responses and emit metrics in the monitor thread as soon as each request completes
+        executor = self._get_executor(jobs_count)
+
+        # Handle late responses for requests from the previous samples which have completed since
+        for future, (target, handler_func) in list(self.__pending_futures.items()):
+            if future.done():
+                del self.__pending_futures[future]
+                self._handle_job_result(target, handler_func, future.result)
+
+        pending_jobs = set(self.__pending_futures.values())
+
+        for target, fetch_func, args, handler_func in jobs:
+            if (target, handler_func) in pending_jobs:
+                self._logger.warn(
+                    "Previous request for %s is still in progress, skipping it for this sample"
+                    % (target.base_url)
+                )
+                continue
+
+            future = executor.submit(fetch_func, target, *args)
+            self.__pending_futures[future] = (target, handler_func)
+
+        # Requests which don't complete in time stay pending and are handled during one of the
+        # next samples
+        try:
+            for future in as_completed(
+                list(self.__pending_futures.keys()),
+                timeout=self._sample_interval_secs * RESULTS_WAIT_TIMEOUT_RATIO,
+            ):
+                target, handler_func = self.__pending_futures.pop(future)
+                self._handle_job_result(target, handler_func, future.result)
+        except FuturesTimeoutError:
+            pass
+
+    def _handle_job_result(self, target, handler_func, get_result_func):
+        # type: (Any, Callable, Callable) -> None
+        """
+        Call handler function for the job result returned by "get_result_func".
+
+        Errors are logged and not propagated so a failure for one target doesn't prevent results for
+        other targets (and request stats for this sample) from being handled.
+        """
+        try:
+            handler_func(target, get_result_func())
+        except Exception:
+            self._logger.exception("Failed to handle result for %s" % (target.base_url))
+
+    def _request(self, target, path, method="GET", **kwargs):
+        # type: (Any, str, str, Any) -> Tuple[Optional[requests.Response], Optional[str]]
+        """
+        Perform HTTP request for the provided target and return (response, error) tuple.
+
+        Requests which fail because of a connection error, timeout or a server error are retried
+        with exponential backoff and the result is recorded in the target circuit breaker.
+        """
+        url = target.base_url + path
+        timeout = (self._connect_timeout, target.timeout or self._read_timeout)
+
+        attempt = 0
+
+        while True:
+            start_time = time.time()
+
+            try:
+                resp = self._get_session().request(method, url, timeout=timeout, **kwargs)
+                error = None
+                failed = resp.status_code in RETRYABLE_STATUS_CODES
+            except requests.exceptions.RequestException as e:
+                resp = None
+                error = str(e)
+                failed = True
+
+            target.request_stats.record(time.time() - start_time, failed or resp.status_code >= 400)
+
+            if not failed or attempt >= self._max_retries:
+                break
+
+            # NOTE: Retries can also run in the monitor thread so we need to wake up as soon as
+            # the monitor is stopped
+            delay = get_backoff_delay(attempt, self._retry_backoff, self._retry_backoff * 8)
+
+            if self._run_state.sleep_but_awaken_if_stopped(delay):
+                return resp, error
+
+            attempt += 1
+
+        if not failed:
+            target.circuit_breaker.record_success()
+            return resp, None
+
+        cooldown = target.circuit_breaker.record_failure(time.time())
+
+        if cooldown is not None:
+            self._logger.warn(
+                "Requests for %s are failing, not polling it for the next %.1f seconds"
+                % (target.base_url, cooldown)
+            )
+
+        return resp, error
+
+    def _emit_request_stats(self):
+        # type: () -> None
+        for target in self._targets:
+            count, latency_sum, errors = target.request_stats.get_and_reset()
+
+            if not count:
+                continue
+
+            self._logger.emit_value(
+                self.metric_prefix + ".http.request.latency_ms",
+                round((latency_sum / count) * 1000, 2),
+                extra_fields=target.extra_fields,
+            )
+            self._logger.emit_value(
+                self.metric_prefix + ".http.request.errors",
+                errors,
+                extra_fields=target.extra_fields,
+            )
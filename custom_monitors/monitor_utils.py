@@ -0,0 +1,31 @@
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Utility functions which are shared by multiple monitors.
+"""
+
+if False:
+    from typing import List
+
+import math
+
+
+def get_percentile(sorted_values, percentile):
+    # type: (List[float], float) -> float
+    """
+    Return percentile for the provided sorted list of values using the nearest rank method.
+    """
+    rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+    return sorted_values[max(min(rank, len(sorted_values)), 1) - 1]
@@ -15,8 +15,49 @@
 """
 Scalyr monitors which collects various 3D printer metrics (printer status, tool temperature, bed
 temperature, etc.) using OctoPrint API.
+
+Monitor uses a persistent HTTP session so the connection to the OctoPrint instance is re-used
+across samples.
+
+A single monitor instance can also poll multiple OctoPrint instances (e.g. a print farm) using
+"targets" config option. In that case all the targets are polled concurrently using a thread pool
+so the time it takes to gather a sample is bounded by the slowest target and not by the sum of all
+of them. For example:
+
+    "targets": [
+        {"base_url": "http://printer1/", "api_key": "key1", "extra_fields": {"printer": "p1"}},
+        {"base_url": "http://printer2/", "api_key": "key2", "timeout": 5}
+    ]
+
+Print job progress (completion, print time left, filament usage) can also be collected from the
+/api/job endpoint using "collect_job_data" config option. Requests for all the endpoints and all
+the targets are performed concurrently. Failed requests are retried with backoff and instances
+which are down are not polled again until the circuit breaker cool down period has passed (see
+http_polling_monitor module).
+
+Instead of polling, monitor can also consume OctoPrint push API (SockJS socket which streams
+"current" printer state messages roughly twice per second) using "collection_mode: push" config
+option. In this mode temperature samples are aggregated in memory and on each sample interval the
+monitor emits average (under the original metric name), min and max value for the actual
+temperature and the last value for the target temperature. This way we don't miss temperature
+transients between samples and we don't need to issue a request for every sample.
 """
 
+if False:
+    from typing import Optional
+    from typing import Dict
+    from typing import List
+    from typing import Tuple
+    from typing import Any
+    from typing import Callable
+
+import time
+import random
+import string
+import threading
+
+from collections import OrderedDict
+
 import six
 import requests
 
@@ -24,16 +65,65 @@ from scalyr_agent import ScalyrMonitor
 from scalyr_agent import define_config_option
 from scalyr_agent import define_log_field
 from scalyr_agent import define_metric
+from scalyr_agent import util as scalyr_util
+from scalyr_agent.json_lib import JsonArray
+
+try:
+    from custom_monitors.http_polling_monitor import HTTPPollingMonitorMixin
+    from custom_monitors.http_polling_monitor import HTTPPollingTarget
+    from custom_monitors.http_polling_monitor import define_http_polling_config_options
+except ImportError:
+    # Monitor module has been loaded directly from the custom_monitors directory
+    from http_polling_monitor import HTTPPollingMonitorMixin  # type: ignore
+    from http_polling_monitor import HTTPPollingTarget  # type: ignore
+    from http_polling_monitor import define_http_polling_config_options  # type: ignore
 
 __monitor__ = __name__
 
 define_log_field(__monitor__, "monitor", "Always ``octoprint_monitor``.")
 
 define_config_option(
-    __monitor__, "base_url", "Base URL to the octoprint instance.",
+    __monitor__,
+    "base_url",
+    "Base URL to the octoprint instance. Required unless \"targets\" option is used.",
+)
+define_config_option(
+    __monitor__,
+    "api_key",
+    "API key used to authenticate. Required unless \"targets\" option is used.",
+)
+define_config_option(
+    __monitor__,
+    "targets",
+    "Optional list of OctoPrint instances to poll concurrently. Each item is an object with "
+    "\"base_url\", \"api_key\" and optional \"timeout\" (read timeout in seconds) and "
+    "\"extra_fields\" (extra fields which are added to all the metrics for that target) keys.",
+    convert_to=JsonArray,
+)
+define_config_option(
+    __monitor__,
+    "collection_mode",
+    "How to collect printer data. \"polling\" (default) polls /api/printer on each sample "
+    "interval and \"push\" consumes OctoPrint push API in a background thread and emits "
+    "aggregated temperature values on each sample interval.",
+    default="polling",
+)
+define_config_option(
+    __monitor__,
+    "collect_job_data",
+    "True to also collect print job progress data from /api/job endpoint. Defaults to False.",
+    default=False,
+    convert_to=bool,
 )
 define_config_option(
-    __monitor__, "api_key", "API key used to authenticate.",
+    __monitor__,
+    "printer_exclude",
+    "Comma delimited list of /api/printer response sections we don't need and should be excluded "
+    "from the response (\"exclude\" query parameter). Defaults to \"sd\".",
+    default="sd",
+)
+define_http_polling_config_options(
+    __monitor__, service_name="OctoPrint", metric_prefix="octoprint"
 )
 
 define_metric(
@@ -65,52 +155,481 @@ define_metric(
     extra_fields={"tool": ""},
 )
 
+for _metric_name in ["octoprint.bed.temperature.actual", "octoprint.tool.temperature.actual"]:
+    define_metric(
+        __monitor__,
+        _metric_name + ".min",
+        "Minimum temperature pushed during the sample interval (push collection mode only).",
+    )
+    define_metric(
+        __monitor__,
+        _metric_name + ".max",
+        "Maximum temperature pushed during the sample interval (push collection mode only).",
+    )
+
+define_metric(
+    __monitor__, "octoprint.job.completion", "Current print job completion in percent.",
+)
+define_metric(
+    __monitor__, "octoprint.job.print_time", "Time already spent printing current job in seconds.",
+)
+define_metric(
+    __monitor__,
+    "octoprint.job.print_time_left",
+    "Estimated time left for the current print job in seconds.",
+)
+define_metric(
+    __monitor__,
+    "octoprint.job.filament.length",
+    "Estimated filament length used by the current print job in mm.",
+    extra_fields={"tool": ""},
+)
+define_metric(
+    __monitor__,
+    "octoprint.job.filament.volume",
+    "Estimated filament volume used by the current print job in cm^3.",
+    extra_fields={"tool": ""},
+)
+
+
+class OctoPrintTarget(HTTPPollingTarget):
+    def __init__(self, base_url, api_key, timeout=None, extra_fields=None):
+        # type: (str, str, Optional[float], Optional[Dict[str, Any]]) -> None
+        super(OctoPrintTarget, self).__init__(
+            base_url=base_url, timeout=timeout, extra_fields=extra_fields
+        )
+
+        self.api_key = api_key
+
+
+COLLECTION_MODES = ["polling", "push"]
+
+# SockJS server sends a heartbeat frame every 25 seconds so if we don't receive anything for
+# longer than this, the connection is considered dead
+PUSH_READ_TIMEOUT = 60
+
+# Minimum and maximum delay (in seconds) between reconnect attempts
+PUSH_MIN_RECONNECT_DELAY = 1
+PUSH_MAX_RECONNECT_DELAY = 60
+
+# Maximum time (in seconds) to wait for all the push client threads to finish on stop
+PUSH_STOP_TIMEOUT = 5
+
+
+class OctoPrintPushClient(object):
+    """
+    Client which consumes OctoPrint push API in a background thread and aggregates pushed
+    temperature samples in memory.
+
+    It uses SockJS xhr_streaming transport which works over plain HTTP so we can use the same
+    requests session as for the polling mode and don't need a websocket library.
+    """
+
+    def __init__(self, target, session, connect_timeout, logger):
+        # type: (OctoPrintTarget, requests.Session, float, Any) -> None
+        self.__target = target
+        self.__session = session
+        self.__connect_timeout = connect_timeout
+        self.__logger = logger
+
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__thread = None  # type: Optional[threading.Thread]
+        self.__response = None  # type: Optional[requests.Response]
+
+        # Latest pushed printer state
+        self.__state = None  # type: Optional[Dict[str, Any]]
+        # Maps temperature sensor name (bed, tool0, etc.) to [count, min, max, sum, target] for
+        # actual temperature samples received since the last call to get_and_reset_values()
+        self.__temperatures = OrderedDict()  # type: Dict[str, List[Any]]
+        # True if at least one message has been received since the last (re)connect
+        self.__message_received = False
+
+    def start(self):
+        # type: () -> None
+        self.__thread = threading.Thread(
+            target=self.__run, name="octoprint push client %s" % (self.__target.base_url)
+        )
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        # type: () -> None
+        """
+        Signal the client thread to stop. Use "join()" to wait for the thread to finish.
+        """
+        self.__stop_event.set()
+
+        # Closing the response unblocks the thread which is waiting for the data
+        response = self.__response
+        if response is not None:
+            response.close()
+
+    def join(self, timeout):
+        # type: (float) -> None
+        if self.__thread:
+            self.__thread.join(max(timeout, 0))
+
+    def get_and_reset_values(self):
+        # type: () -> Tuple[Optional[Dict[str, Any]], Dict[str, List[Any]]]
+        """
+        Return latest printer state and aggregated temperature values since the last call.
+        """
+        with self.__lock:
+            state, self.__state = self.__state, None
+            temperatures, self.__temperatures = self.__temperatures, OrderedDict()
+
+        return state, temperatures
+
+    def handle_message(self, message):
+        # type: (Dict[str, Any]) -> None
+        self.__message_received = True
+
+        current = message.get("current", None)
+
+        if not current:
+            return
+
+        with self.__lock:
+            if current.get("state", None):
+                self.__state = current["state"]
+
+            for temps in current.get("temps", None) or []:
+                for key, value in six.iteritems(temps):
+                    if key == "time" or not isinstance(value, dict):
+                        continue
+
+                    actual = value.get("actual", None)
+
+                    if actual is None:
+                        continue
+
+                    stats = self.__temperatures.get(key, None)
+
+                    if stats is None:
+                        self.__temperatures[key] = [1, actual, actual, actual, value.get("target")]
+                        continue
+
+                    stats[0] += 1
+                    stats[1] = min(stats[1], actual)
+                    stats[2] = max(stats[2], actual)
+                    stats[3] += actual
+                    stats[4] = value.get("target", None)
+
+    def __run(self):
+        # type: () -> None
+        reconnect_attempts = 0
+
+        while not self.__stop_event.is_set():
+            self.__message_received = False
+
+            try:
+                self.__consume()
+            except Exception as e:
+                # NOTE: Closing the response from stop() can result in various exceptions being
+                # thrown by the underlying library
+                if self.__stop_event.is_set():
+                    break
+
+                self.__logger.warn(
+                    "Failed to consume push API for %s: %s" % (self.__target.base_url, str(e))
+                )
+
+            # NOTE: Back off is only reset once at least one message has been received so we
+            # don't hot loop against a server (or a proxy) which keeps closing the stream right
+            # away
+            if self.__message_received:
+                reconnect_attempts = 0
+            else:
+                reconnect_attempts += 1
+
+            delay = min(
+                PUSH_MIN_RECONNECT_DELAY * 2 ** reconnect_attempts, PUSH_MAX_RECONNECT_DELAY
+            )
+            self.__stop_event.wait(delay)
+
+    def __consume(self):
+        # type: () -> None
+        headers = {"X-Api-Key": self.__target.api_key}
+
+        # 1. Retrieve session which is used to authenticate the socket
+        resp = self.__session.post(
+            self.__target.base_url + "/api/login",
+            json={"passive": True},
+            headers=headers,
+            timeout=(self.__connect_timeout, PUSH_READ_TIMEOUT),
+        )
+        resp.raise_for_status()
+        login_data = resp.json()
+        auth = "%s:%s" % (login_data["name"], login_data["session"])
+
+        # 2. Open the stream
+        socket_url = "%s/sockjs/%s/%s" % (
+            self.__target.base_url,
+            random.randint(0, 999),
+            "".join(random.choice(string.ascii_lowercase + string.digits) for _ in range(8)),
+        )
+        self.__response = self.__session.post(
+            socket_url + "/xhr_streaming",
+            stream=True,
+            timeout=(self.__connect_timeout, PUSH_READ_TIMEOUT),
+        )
+
+        try:
+            self.__response.raise_for_status()
+
+            for line in self.__response.iter_lines():
+                if self.__stop_event.is_set():
+                    return
+
+                if not line or line.startswith(b"h"):
+                    # Heartbeat or prelude
+                    continue
+
+                if line == b"o":
+                    # 3. Authenticate once the socket is open
+                    self.__session.post(
+                        socket_url + "/xhr_send",
+                        data=scalyr_util.json_encode([scalyr_util.json_encode({"auth": auth})]),
+                        timeout=(self.__connect_timeout, PUSH_READ_TIMEOUT),
+                    ).raise_for_status()
+                elif line.startswith(b"a"):
+                    for message in scalyr_util.json_decode(line[1:].decode("utf-8")):
+                        if isinstance(message, six.string_types):
+                            message = scalyr_util.json_decode(message)
+
+                        self.handle_message(message)
+                elif line.startswith(b"c"):
+                    raise ValueError("Socket closed by server: %s" % (line[1:].decode("utf-8")))
+        finally:
+            self.__response.close()
+            self.__response = None
+
+
+class OctoPrintMonitor(HTTPPollingMonitorMixin, ScalyrMonitor):
+    metric_prefix = "octoprint"
 
-class OctoPrintMonitor(ScalyrMonitor):
     def _initialize(self):
         # type: () -> None
-        self.__base_url = self._config.get(
-            "base_url", convert_to=six.text_type, required_field=True,
+        self._initialize_http_polling()
+
+        base_url = self._config.get(
+            "base_url", convert_to=six.text_type, required_field=False,
+        )
+        api_key = self._config.get(
+            "api_key", convert_to=six.text_type, required_field=False,
+        )
+        targets = self._config.get(
+            "targets", convert_to=JsonArray, required_field=False, default=JsonArray(),
         )
-        self.__api_key = self._config.get(
-            "api_key", convert_to=six.text_type, required_field=True,
+
+        self.__collect_job_data = self._config.get(
+            "collect_job_data", convert_to=bool, default=False,
+        )
+        self.__printer_exclude = self._config.get(
+            "printer_exclude", convert_to=six.text_type, default="sd",
+        )
+        self.__collection_mode = self._config.get(
+            "collection_mode", convert_to=six.text_type, default="polling",
         )
 
-        if self.__base_url.endswith("/"):
-            self.__base_url = str(self.__base_url[:-1])
+        if self.__collection_mode not in COLLECTION_MODES:
+            raise ValueError(
+                "Invalid collection_mode: %s. Valid values are: %s"
+                % (self.__collection_mode, ", ".join(COLLECTION_MODES))
+            )
+
+        octoprint_targets = []  # type: List[OctoPrintTarget]
+
+        if base_url or api_key:
+            if not base_url or not api_key:
+                raise ValueError("Both base_url and api_key need to be specified")
+
+            octoprint_targets.append(OctoPrintTarget(base_url=base_url, api_key=api_key))
+
+        for target in targets:
+            if not target.get("base_url", None) or not target.get("api_key", None):
+                raise ValueError("Each target needs to contain base_url and api_key")
+
+            timeout = target.get("timeout", None)
+            extra_fields = dict(target.get("extra_fields", None) or {})
+
+            octoprint_targets.append(
+                OctoPrintTarget(
+                    base_url=six.text_type(target["base_url"]),
+                    api_key=six.text_type(target["api_key"]),
+                    timeout=float(timeout) if timeout is not None else None,
+                    extra_fields=extra_fields,
+                )
+            )
+
+        if not octoprint_targets:
+            raise ValueError("Either base_url and api_key or targets need to be specified")
+
+        # If there are multiple targets, we need to be able to tell them apart
+        self._set_targets(octoprint_targets, default_extra_field="printer")
+
+        # NOTE: Push clients are started lazily on first sample since _initialize() is also
+        # called when stopping the agent
+        self.__push_clients = []  # type: List[OctoPrintPushClient]
+
+    def stop(self, *args, **kwargs):
+        # NOTE: All the clients are signalled to stop first so they stop in parallel and then we
+        # wait for all of them using a single deadline
+        for push_client in self.__push_clients:
+            push_client.stop()
+
+        deadline = time.time() + PUSH_STOP_TIMEOUT
+
+        for push_client in self.__push_clients:
+            push_client.join(deadline - time.time())
+
+        self.__push_clients = []
+
+        super(OctoPrintMonitor, self).stop(*args, **kwargs)
+
+    def _get_endpoints(self):
+        # type: () -> List[Tuple[str, Dict[str, str], Callable]]
+        """
+        Return a list of (path, query params, handler function) tuples for all the API endpoints
+        we need to query for each target.
+        """
+        endpoints = []
+
+        # In push mode, printer data is retrieved using the push client
+        if self.__collection_mode == "polling":
+            printer_params = {}
+
+            if self.__printer_exclude:
+                printer_params["exclude"] = self.__printer_exclude
+
+            endpoints.append(("/api/printer", printer_params, self._handle_printer_data))
+
+        if self.__collect_job_data:
+            endpoints.append(("/api/job", {}, self._handle_job_data))
+
+        return endpoints
+
+    def _get_jobs(self):
+        # type: () -> List[Tuple[OctoPrintTarget, Callable, Tuple, Callable]]
+        jobs = []
+
+        for target in self._targets:
+            for path, params, handler_func in self._get_endpoints():
+                jobs.append((target, self._fetch_data, (path, params), handler_func))
+
+        return jobs
 
     def gather_sample(self):
         # type: () -> None
-        url = self.__base_url + "/api/printer"
-        headers = {"X-Api-Key": self.__api_key}
-        resp = requests.get(url, headers=headers)
+        if self.__collection_mode == "push":
+            self._gather_push_sample()
+
+            if not self.__collect_job_data:
+                return
+
+        super(OctoPrintMonitor, self).gather_sample()
+
+    def _gather_push_sample(self):
+        # type: () -> None
+        if not self.__push_clients:
+            # NOTE: Clients are started on first sample since _initialize() is also called when
+            # stopping the agent
+            for target in self._targets:
+                push_client = OctoPrintPushClient(
+                    target=target,
+                    session=self._get_session(),
+                    connect_timeout=self._connect_timeout,
+                    logger=self._logger,
+                )
+                push_client.start()
+                self.__push_clients.append(push_client)
 
-        if resp.status_code != 200:
-            self._logger.warn("Failed to retrieve printer data: %s" % (resp.text))
             return
 
-        data = resp.json()
+        for target, push_client in zip(self._targets, self.__push_clients):
+            state, temperatures = push_client.get_and_reset_values()
 
-        flags = data["state"]["flags"]
-        flags = dict([(key, str(value)) for key, value in flags.items()])
+            if state:
+                self._emit_state(target, state)
 
-        extra_fields = flags
-        self._logger.emit_value(
-            "state", data["state"]["text"], extra_fields=extra_fields
-        )
+            for key, (count, min_value, max_value, sum_value, target_value) in six.iteritems(
+                temperatures
+            ):
+                if key == "bed":
+                    metric_name_prefix = "octoprint.bed.temperature"
+                    extra_fields = target.extra_fields
+                elif key.startswith("tool"):
+                    metric_name_prefix = "octoprint.tool.temperature"
+                    extra_fields = dict(target.extra_fields)
+                    extra_fields["tool"] = key
+                else:
+                    continue
+
+                self._logger.emit_value(
+                    metric_name_prefix + ".actual",
+                    round(sum_value / count, 2),
+                    extra_fields=extra_fields,
+                )
+                self._logger.emit_value(
+                    metric_name_prefix + ".actual.min", min_value, extra_fields=extra_fields
+                )
+                self._logger.emit_value(
+                    metric_name_prefix + ".actual.max", max_value, extra_fields=extra_fields
+                )
+
+                if target_value is not None:
+                    self._logger.emit_value(
+                        metric_name_prefix + ".target", target_value, extra_fields=extra_fields
+                    )
+
+    def _fetch_data(self, target, path, params=None):
+        # type: (OctoPrintTarget, str, Optional[Dict[str, str]]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]
+        """
+        Retrieve data from the provided API endpoint for the provided target and return
+        (data, error) tuple.
+        """
+        headers = {"X-Api-Key": target.api_key}
+        resp, error = self._request(target, path, params=params, headers=headers)
+
+        if resp is None:
+            return None, error
+
+        if resp.status_code != 200:
+            return None, resp.text
+
+        try:
+            return resp.json(), None
+        except ValueError as e:
+            return None, "Failed to parse response: %s" % (str(e))
+
+    def _handle_printer_data(self, target, result):
+        # type: (OctoPrintTarget, Tuple[Optional[Dict[str, Any]], Optional[str]]) -> None
+        data, error = result
+
+        if error is not None or data is None:
+            self._logger.warn(
+                "Failed to retrieve printer data for %s: %s" % (target.base_url, error)
+            )
+            return
+
+        self._emit_state(target, data["state"])
 
         self._logger.emit_value(
-            "octoprint.bed.temperature.actual", data["temperature"]["bed"]["actual"]
+            "octoprint.bed.temperature.actual", data["temperature"]["bed"]["actual"],
+            extra_fields=target.extra_fields,
         )
         self._logger.emit_value(
-            "octoprint.bed.temperature.target", data["temperature"]["bed"]["target"]
+            "octoprint.bed.temperature.target", data["temperature"]["bed"]["target"],
+            extra_fields=target.extra_fields,
         )
 
         for key, value in six.iteritems(data["temperature"]):
             if not key.startswith("tool"):
                 continue
 
-            extra_fields = {"tool": key}
+            extra_fields = dict(target.extra_fields)
+            extra_fields["tool"] = key
 
             self._logger.emit_value(
                 "octoprint.tool.temperature.actual",
@@ -122,3 +641,58 @@ class OctoPrintMonitor(ScalyrMonitor):
                 data["temperature"][key]["target"],
                 extra_fields=extra_fields,
             )
+
+    def _emit_state(self, target, state):
+        # type: (OctoPrintTarget, Dict[str, Any]) -> None
+        flags = state["flags"]
+        flags = dict([(key, str(value)) for key, value in flags.items()])
+
+        extra_fields = dict(target.extra_fields)
+        extra_fields.update(flags)
+        self._logger.emit_value(
+            "state", state["text"], extra_fields=extra_fields
+        )
+
+    def _handle_job_data(self, target, result):
+        # type: (OctoPrintTarget, Tuple[Optional[Dict[str, Any]], Optional[str]]) -> None
+        data, error = result
+
+        if error is not None or data is None:
+            self._logger.warn("Failed to retrieve job data for %s: %s" % (target.base_url, error))
+            return
+
+        progress = data.get("progress", None) or {}
+
+        # NOTE: Progress values are null when there is no active print job
+        for metric_name, key in [
+            ("octoprint.job.completion", "completion"),
+            ("octoprint.job.print_time", "printTime"),
+            ("octoprint.job.print_time_left", "printTimeLeft"),
+        ]:
+            value = progress.get(key, None)
+
+            if value is None:
+                continue
+
+            if metric_name == "octoprint.job.completion":
+                value = round(value, 2)
+
+            self._logger.emit_value(metric_name, value, extra_fields=target.extra_fields)
+
+        filament = (data.get("job", None) or {}).get("filament", None) or {}
+
+        for tool, values in sorted(six.iteritems(filament)):
+            if not values:
+                continue
+
+            extra_fields = dict(target.extra_fields)
+            extra_fields["tool"] = tool
+
+            for metric_name, key in [
+                ("octoprint.job.filament.length", "length"),
+                ("octoprint.job.filament.volume", "volume"),
+            ]:
+                if values.get(key, None) is None:
+                    continue
+
+                self._logger.emit_value(metric_name, values[key], extra_fields=extra_fields)
@@ -15,8 +15,61 @@
 """
 Scalyr monitor which retrieves fully anonymized DNS query related metrics from a Pi-hole
 installations using Pi-hole API.
+
+Monitor uses a persistent HTTP session so the connection (and TLS session in case of https admin
+URL) to the Pi-hole instance is re-used across samples.
+
+Pi-hole counters are often unchanged between polls (e.g. at night). To avoid unnecessary work,
+monitor sends conditional requests (If-None-Match / If-Modified-Since) when the server returns
+ETag / Last-Modified headers and it also keeps a hash of the last response payload. If the payload
+hasn't changed since the last sample, we skip JSON decoding and only emit "pihole.status" metric
+as a heartbeat together with zero per second rates for the daily counters (or nothing at all if
+"unchanged_payload_heartbeat" is set to False).
+
+Pi-hole reports DNS query and blocked ads counters as daily cumulative counters which are reset at
+midnight. To make them easier to work with, monitor also emits per second rates for those counters
+which are calculated from the previous sample and handle counter resets.
+
+A single monitor instance can also poll multiple Pi-hole instances using "targets" config option.
+All the targets are polled concurrently using a bounded thread pool and metrics for each target
+are emitted as soon as the response for that target is received. Metrics for each target include
+"instance" extra field (defaults to the target base URL). For example:
+
+    "targets": [
+        {"base_url": "http://pihole1/", "basic_auth": "user:pass", "instance": "pihole1"},
+        {"base_url": "http://pihole2/", "timeout": 5}
+    ]
+
+If a request for a target is still in progress when the next sample is gathered (e.g. instance is
+very slow), that target is skipped for that sample so it doesn't delay the other targets. Failed
+requests are retried with backoff and instances which are down are not polled again until the
+circuit breaker cool down period has passed (see http_polling_monitor module).
+
+Monitor can also collect more detailed data (top domains, top blocked domains, top clients, query
+type breakdown, forward destinations breakdown and 10 minute over time data) using a single
+additional API request per target. To keep the metrics fully anonymized and to bound their
+cardinality, top domains and clients are never emitted as is - they are hashed into a fixed number
+of buckets ("top_items_cardinality_budget") and the counts are summed per bucket. To avoid emitting
+the same values on every sample, monitor keeps an in-memory LRU cache of the last emitted value for
+each of those metrics and only emits values which have changed since and on every full refresh
+interval (see "emitted_values_full_refresh_interval" config option) so values which never change
+don't disappear from time windowed queries and alerts.
 """
 
+if False:
+    from typing import Optional
+    from typing import Dict
+    from typing import Tuple
+    from typing import List
+    from typing import Any
+
+import re
+import time
+import zlib
+import hashlib
+
+from collections import OrderedDict
+
 import six
 import requests
 
@@ -24,58 +77,748 @@ from scalyr_agent import ScalyrMonitor
 from scalyr_agent import define_config_option
 from scalyr_agent import define_log_field
 from scalyr_agent import define_metric
+from scalyr_agent.json_lib import JsonArray
+
+try:
+    from custom_monitors.http_polling_monitor import HTTPPollingMonitorMixin
+    from custom_monitors.http_polling_monitor import HTTPPollingTarget
+    from custom_monitors.http_polling_monitor import define_http_polling_config_options
+except ImportError:
+    # Monitor module has been loaded directly from the custom_monitors directory
+    from http_polling_monitor import HTTPPollingMonitorMixin  # type: ignore
+    from http_polling_monitor import HTTPPollingTarget  # type: ignore
+    from http_polling_monitor import define_http_polling_config_options  # type: ignore
 
 __monitor__ = __name__
 
 define_log_field(__monitor__, "monitor", "Always ``pihole_monitor``.")
 
 define_config_option(
-    __monitor__, "base_url", "Base URL to PiHole admin page (e.g. https://<ip>/).",
+    __monitor__,
+    "base_url",
+    "Base URL to PiHole admin page (e.g. https://<ip>/). Required unless \"targets\" option is "
+    "used.",
 )
 define_config_option(
     __monitor__, "basic_auth", "Optional basic auth credentials in username:password notation.",
 )
+define_config_option(
+    __monitor__,
+    "targets",
+    "Optional list of Pi-hole instances to poll concurrently. Each item is an object with "
+    "\"base_url\" and optional \"basic_auth\", \"timeout\" (read timeout in seconds) and "
+    "\"instance\" (value for the \"instance\" metric extra field, defaults to base_url) keys.",
+    convert_to=JsonArray,
+)
+define_config_option(
+    __monitor__,
+    "api_token",
+    "Optional API token (\"auth\" query parameter) which is needed to retrieve detailed data "
+    "(top items, query types, forward destinations) if the admin interface is password "
+    "protected. Can also be specified for each target using \"api_token\" key.",
+)
+define_http_polling_config_options(__monitor__, service_name="Pi-hole", metric_prefix="pihole")
+define_config_option(
+    __monitor__,
+    "skip_unchanged_payloads",
+    "True to skip decoding and emitting metrics when API response hasn't changed since the "
+    "previous sample. Defaults to True.",
+    default=True,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "unchanged_payload_heartbeat",
+    "True to emit \"pihole.status\" metric as a heartbeat (and zero counter rates if "
+    "\"calculate_rates\" is enabled) when API response hasn't changed since "
+    "the previous sample. Defaults to True.",
+    default=True,
+    convert_to=bool,
+)
+
+define_config_option(
+    __monitor__,
+    "calculate_rates",
+    "True to emit per second rates for the daily DNS queries and blocked ads counters. Defaults to "
+    "True.",
+    default=True,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "collect_top_items",
+    "True to collect top domains, top blocked domains and top clients counts (hashed into a "
+    "fixed number of buckets). Defaults to False.",
+    default=False,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "collect_query_types",
+    "True to collect query type breakdown. Defaults to False.",
+    default=False,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "collect_forward_destinations",
+    "True to collect forward destinations breakdown. Defaults to False.",
+    default=False,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "collect_over_time_data",
+    "True to collect number of DNS queries and blocked ads in 10 minute intervals for the last 24 "
+    "hours. Defaults to False.",
+    default=False,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "top_items_count",
+    "Number of top domains and clients to retrieve. Defaults to 10.",
+    default=10,
+    convert_to=int,
+    min_value=1,
+)
+define_config_option(
+    __monitor__,
+    "top_items_cardinality_budget",
+    "Number of buckets top domains and clients are hashed into. This represents the maximum number "
+    "of distinct \"bucket\" values for each top item metric. Defaults to 32.",
+    default=32,
+    convert_to=int,
+    min_value=1,
+)
+define_config_option(
+    __monitor__,
+    "emitted_values_cache_size",
+    "Maximum number of last emitted detailed data values to keep in memory per target. Values "
+    "which haven't changed since they were last emitted are not emitted again. Defaults to 2000.",
+    default=2000,
+    convert_to=int,
+    min_value=1,
+)
+define_config_option(
+    __monitor__,
+    "emitted_values_full_refresh_interval",
+    "Detailed data values are only emitted when the value changes. This option specifies how often "
+    "(in seconds) to emit all of those values regardless of the change. Set it to 0 to emit them "
+    "on every sample. Defaults to 600.",
+    default=600,
+    convert_to=int,
+    min_value=0,
+)
+
+define_metric(
+    __monitor__,
+    "pihole.dns_queries_per_second",
+    "Number of DNS queries per second since the previous sample.",
+)
+define_metric(
+    __monitor__,
+    "pihole.ads_blocked_per_second",
+    "Number of blocked ads per second since the previous sample.",
+)
+
+define_metric(
+    __monitor__,
+    "pihole.top_queries.count",
+    "Number of queries for the top domains which hash into this bucket.",
+    extra_fields={"bucket": ""},
+)
+define_metric(
+    __monitor__,
+    "pihole.top_ads.count",
+    "Number of blocked queries for the top blocked domains which hash into this bucket.",
+    extra_fields={"bucket": ""},
+)
+define_metric(
+    __monitor__,
+    "pihole.top_clients.count",
+    "Number of queries for the top clients which hash into this bucket.",
+    extra_fields={"bucket": ""},
+)
+define_metric(
+    __monitor__,
+    "pihole.query_types.percentage",
+    "Percentage of queries of this type.",
+    extra_fields={"query_type": ""},
+)
+define_metric(
+    __monitor__,
+    "pihole.forward_destinations.percentage",
+    "Percentage of queries answered by this destination.",
+    extra_fields={"destination": ""},
+)
+define_metric(
+    __monitor__,
+    "pihole.over_time.dns_queries",
+    "Number of DNS queries in a 10 minute interval. Timestamp of the metric is the interval "
+    "timestamp.",
+)
+define_metric(
+    __monitor__,
+    "pihole.over_time.ads_blocked",
+    "Number of blocked ads in a 10 minute interval. Timestamp of the metric is the interval "
+    "timestamp.",
+)
+
+# Maps API response key for the top items to the metric name
+TOP_ITEMS_METRIC_NAMES = [
+    ("top_queries", "pihole.top_queries.count"),
+    ("top_ads", "pihole.top_ads.count"),
+    ("top_sources", "pihole.top_clients.count"),
+]
+
+# Maps API response key for the over time data to the metric name
+OVER_TIME_METRIC_NAMES = [
+    ("domains_over_time", "pihole.over_time.dns_queries"),
+    ("ads_over_time", "pihole.over_time.ads_blocked"),
+]
+
+# Maps daily counter metric name to the name of the rate metric for that counter
+COUNTER_RATE_METRIC_NAMES = [
+    ("pihole.dns_queries_today", "pihole.dns_queries_per_second"),
+    ("pihole.ads_blocked_today", "pihole.ads_blocked_per_second"),
+]
+
+# Parts of the response which change over time even if the actual counters don't and should be
+# ignored when determining if the payload has changed
+VOLATILE_PAYLOAD_FIELDS_RE = re.compile(br'"relative"\s*:\s*\{[^}]*\}')
+
+
+def parse_basic_auth(basic_auth_credentials):
+    # type: (Optional[str]) -> Optional[Tuple[str, str]]
+    if not basic_auth_credentials:
+        return None
+
+    auth = tuple(basic_auth_credentials.split(":"))
+
+    if len(auth) != 2:
+        raise ValueError("Invalid basic auth credentials")
+
+    return auth  # type: ignore
+
+
+def get_top_items_buckets(items, count, cardinality_budget):
+    # type: (Dict[str, int], int, int) -> Dict[str, int]
+    """
+    Hash top "count" items into "cardinality_budget" buckets and return a dictionary which maps
+    bucket name to the sum of the item values in that bucket.
+    """
+    top_items = sorted(items.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    buckets = {}  # type: Dict[str, int]
+    for name, value in top_items:
+        bucket = str((zlib.crc32(name.encode("utf-8")) & 0xFFFFFFFF) % cardinality_budget)
+        buckets[bucket] = buckets.get(bucket, 0) + value
+
+    return buckets
+
+
+class EmittedValuesCache(object):
+    """
+    LRU cache of the last emitted metric values which is used to avoid emitting values which
+    haven't changed.
+
+    Cache is cleared every "full_refresh_interval" seconds so all the values are emitted again
+    (0 means values are always treated as changed).
+    """
+
+    def __init__(self, max_size, full_refresh_interval=600):
+        # type: (int, int) -> None
+        self.__max_size = max_size
+        self.__full_refresh_interval = full_refresh_interval
+        self.__values = OrderedDict()  # type: OrderedDict
+        self.__last_full_refresh_ts = 0  # type: float
+
+    def is_changed(self, key, value):
+        # type: (Tuple, Any) -> bool
+        """
+        Return True if the value has changed since it was last stored (or the full refresh
+        interval has passed since the cache was last cleared) and store the new value.
+        """
+        now_ts = time.time()
+
+        if self.__last_full_refresh_ts + self.__full_refresh_interval <= now_ts:
+            self.__values = OrderedDict()
+            self.__last_full_refresh_ts = now_ts
+
+        previous_value = self.__values.pop(key, None)
+        self.__values[key] = value
+
+        if len(self.__values) > self.__max_size:
+            self.__values.popitem(last=False)
+
+        return previous_value is None or previous_value != value
+
+    def __len__(self):
+        return len(self.__values)
+
+
+class CounterRateCalculator(object):
+    """
+    Calculates per second rates for counters which only increase, but can be reset (e.g. daily
+    counters which are reset at midnight).
+    """
+
+    def __init__(self):
+        # Maps counter name to (value, timestamp) for the previous sample
+        self.__previous_values = {}  # type: Dict[str, Tuple[float, float]]
+
+    def calculate(self, name, value, timestamp):
+        # type: (str, float, float) -> Optional[float]
+        """
+        Store the new counter value and return per second rate since the previous value (or None
+        if there is no previous value).
+        """
+        previous = self.__previous_values.get(name, None)
+        self.__previous_values[name] = (value, timestamp)
+
+        if previous is None:
+            return None
+
+        previous_value, previous_timestamp = previous
+        elapsed = timestamp - previous_timestamp
+
+        if elapsed <= 0:
+            return None
+
+        delta = value - previous_value
+
+        if delta < 0:
+            # Counter has been reset so the current value is the count since the reset
+            delta = value
+
+        return round(delta / elapsed, 3)
+
+    def mark_unchanged(self, timestamp):
+        # type: (float) -> List[str]
+        """
+        Mark all the counters as unchanged at the provided timestamp and return names of the
+        counters which have a previous value (rate for those counters is 0 since the previous
+        sample).
+        """
+        for name, (value, _) in list(self.__previous_values.items()):
+            self.__previous_values[name] = (value, timestamp)
+
+        return list(self.__previous_values.keys())
+
+
+class PiHoleTarget(HTTPPollingTarget):
+    """
+    Pi-hole instance we poll, including state from the previous samples for that instance.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        auth=None,
+        api_token=None,
+        timeout=None,
+        extra_fields=None,
+        emitted_values_cache_size=2000,
+        emitted_values_full_refresh_interval=600,
+    ):
+        # type: (str, Optional[Tuple[str, str]], Optional[str], Optional[float], Optional[Dict[str, str]], int, int) -> None
+        super(PiHoleTarget, self).__init__(
+            base_url=base_url, timeout=timeout, extra_fields=extra_fields
+        )
+
+        self.auth = auth
+        self.api_token = api_token
+
+        # Conditional request headers and payload hash for the last successful response
+        self.conditional_headers = {}  # type: Dict[str, str]
+        self.last_payload_hash = None  # type: Optional[str]
+        self.last_status = None  # type: Optional[str]
+
+        self.rate_calculator = CounterRateCalculator()
+
+        # Last emitted detailed data values and top items buckets which were emitted in the
+        # previous sample
+        self.emitted_values_cache = EmittedValuesCache(
+            max_size=emitted_values_cache_size,
+            full_refresh_interval=emitted_values_full_refresh_interval,
+        )
+        self.top_items_buckets = {}  # type: Dict[str, Dict[str, int]]
 
 
-class PiHoleMonitor(ScalyrMonitor):
+class PiHoleMonitor(HTTPPollingMonitorMixin, ScalyrMonitor):
+    metric_prefix = "pihole"
+
     def _initialize(self):
         # type: () -> None
-        self.__base_url = self._config.get(
-            "base_url", convert_to=six.text_type, required_field=True,
+        self._initialize_http_polling()
+
+        base_url = self._config.get(
+            "base_url", convert_to=six.text_type, required_field=False,
         )
-        self.__basic_auth_credentials = self._config.get(
+        basic_auth_credentials = self._config.get(
             "basic_auth", convert_to=six.text_type, required_field=False,
         )
+        api_token = self._config.get(
+            "api_token", convert_to=six.text_type, required_field=False,
+        )
+        targets = self._config.get(
+            "targets", convert_to=JsonArray, required_field=False, default=JsonArray(),
+        )
+
+        self.__skip_unchanged_payloads = self._config.get(
+            "skip_unchanged_payloads", convert_to=bool, default=True,
+        )
+        self.__unchanged_payload_heartbeat = self._config.get(
+            "unchanged_payload_heartbeat", convert_to=bool, default=True,
+        )
+        self.__calculate_rates = self._config.get(
+            "calculate_rates", convert_to=bool, default=True,
+        )
+        self.__collect_top_items = self._config.get(
+            "collect_top_items", convert_to=bool, default=False,
+        )
+        self.__collect_query_types = self._config.get(
+            "collect_query_types", convert_to=bool, default=False,
+        )
+        self.__collect_forward_destinations = self._config.get(
+            "collect_forward_destinations", convert_to=bool, default=False,
+        )
+        self.__collect_over_time_data = self._config.get(
+            "collect_over_time_data", convert_to=bool, default=False,
+        )
+        self.__top_items_count = self._config.get(
+            "top_items_count", convert_to=int, default=10, min_value=1,
+        )
+        self.__top_items_cardinality_budget = self._config.get(
+            "top_items_cardinality_budget", convert_to=int, default=32, min_value=1,
+        )
+        emitted_values_cache_size = self._config.get(
+            "emitted_values_cache_size", convert_to=int, default=2000, min_value=1,
+        )
+        emitted_values_full_refresh_interval = self._config.get(
+            "emitted_values_full_refresh_interval", convert_to=int, default=600, min_value=0,
+        )
 
-        if self.__base_url.endswith("/"):
-            self.__base_url = str(self.__base_url[:-1])
+        pihole_targets = []  # type: List[PiHoleTarget]
 
-        if self.__basic_auth_credentials:
-            self.__auth = tuple(self.__basic_auth_credentials.split(":"))
+        if base_url:
+            pihole_targets.append(
+                PiHoleTarget(
+                    base_url=base_url,
+                    auth=parse_basic_auth(basic_auth_credentials),
+                    api_token=api_token,
+                    emitted_values_cache_size=emitted_values_cache_size,
+                    emitted_values_full_refresh_interval=emitted_values_full_refresh_interval,
+                )
+            )
 
-            if len(self.__auth) != 2:
-                raise ValueError("Invalid basic auth credentials")
-        else:
-            self.__auth = None
+        for target in targets:
+            if not target.get("base_url", None):
+                raise ValueError("Each target needs to contain base_url")
 
-    def gather_sample(self):
-        # type: () -> None
-        url = self.__base_url + "/admin/api.php"
+            target_base_url = six.text_type(target["base_url"])
+            timeout = target.get("timeout", None)
+            basic_auth = target.get("basic_auth", None)
+            target_api_token = target.get("api_token", None) or api_token
+
+            pihole_targets.append(
+                PiHoleTarget(
+                    base_url=target_base_url,
+                    auth=parse_basic_auth(six.text_type(basic_auth) if basic_auth else None),
+                    api_token=six.text_type(target_api_token) if target_api_token else None,
+                    timeout=float(timeout) if timeout is not None else None,
+                    extra_fields={
+                        "instance": six.text_type(target.get("instance", None) or target_base_url)
+                    },
+                    emitted_values_cache_size=emitted_values_cache_size,
+                    emitted_values_full_refresh_interval=emitted_values_full_refresh_interval,
+                )
+            )
+
+        if not pihole_targets:
+            raise ValueError("Either base_url or targets need to be specified")
+
+        # If there are multiple targets, we need to be able to tell them apart
+        self._set_targets(pihole_targets, default_extra_field="instance")
+
+    def _get_jobs(self):
+        # type: () -> List[Tuple[PiHoleTarget, Any, Tuple, Any]]
+        return [
+            (target, self._fetch_target_data, (), self._handle_target_data)
+            for target in self._targets
+        ]
+
+    def _get_details_params(self, target):
+        # type: (PiHoleTarget) -> Dict[str, str]
+        """
+        Return query params for the detailed data API request for the provided target (or an
+        empty dictionary if no detailed data should be collected).
+
+        NOTE: Pi-hole API merges responses for all the requested data types into a single
+        response so we only need a single request for all of them.
+        """
+        params = OrderedDict()  # type: Dict[str, str]
 
-        resp = requests.get(url, auth=self.__auth)
+        if self.__collect_top_items:
+            params["topItems"] = str(self.__top_items_count)
+            params["getQuerySources"] = str(self.__top_items_count)
+
+        if self.__collect_query_types:
+            params["getQueryTypes"] = ""
+
+        if self.__collect_forward_destinations:
+            params["getForwardDestinations"] = ""
+
+        if self.__collect_over_time_data:
+            params["overTimeData10mins"] = ""
+
+        if params and target.api_token:
+            params["auth"] = target.api_token
+
+        return params
+
+    def _fetch_target_data(self, target):
+        # type: (PiHoleTarget) -> List[Tuple[Optional[requests.Response], Optional[str]]]
+        """
+        Retrieve summary data and optional detailed data for the provided target and return a list
+        of (response, error) tuples.
+        """
+        results = [self._fetch_data(target)]
+
+        details_params = self._get_details_params(target)
+
+        if details_params:
+            results.append(self._fetch_data(target, details_params))
+
+        return results
+
+    def _fetch_data(self, target, params=None):
+        # type: (PiHoleTarget, Optional[Dict[str, str]]) -> Tuple[Optional[requests.Response], Optional[str]]
+        """
+        Retrieve API response for the provided target and return (response, error) tuple.
+        """
+        # Conditional requests are only used for the summary data
+        headers = target.conditional_headers if not params else {}
+
+        return self._request(
+            target, "/admin/api.php", params=params, auth=target.auth, headers=headers,
+        )
+
+    def _handle_target_data(self, target, results):
+        # type: (PiHoleTarget, List[Tuple[Optional[requests.Response], Optional[str]]]) -> None
+        self._handle_summary_response(target, *results[0])
+
+        if len(results) > 1:
+            self._handle_details_response(target, *results[1])
+
+    def _handle_summary_response(self, target, resp, error):
+        # type: (PiHoleTarget, Optional[requests.Response], Optional[str]) -> None
+        if error is not None or resp is None:
+            self._logger.warn(
+                "Failed to retrieve Pi-hole data for %s: %s" % (target.base_url, error)
+            )
+            return
+
+        if resp.status_code == 304:
+            self._handle_unchanged_payload(target)
+            return
 
         if resp.status_code != 200:
-            self._logger.warn("Failed to retrieve printer data: %s" % (resp.text))
+            self._logger.warn(
+                "Failed to retrieve Pi-hole data for %s: %s" % (target.base_url, resp.text)
+            )
             return
 
-        data = resp.json()
-
-        self._logger.emit_value("pihole.dns_queries_today", data["dns_queries_today"])
-        self._logger.emit_value("pihole.ads_blocked_today", data["ads_blocked_today"])
-        self._logger.emit_value("pihole.ads_percentage_today", round(data["ads_percentage_today"], 1))
-        self._logger.emit_value("pihole.domains_being_blocked", data["domains_being_blocked"])
-        self._logger.emit_value("pihole.queries_cached", data["queries_cached"])
-        self._logger.emit_value("pihole.queries_forwarded", data["queries_forwarded"])
-        self._logger.emit_value("pihole.unique_domains", data["unique_domains"])
-        self._logger.emit_value("pihole.unique_clients", data["unique_clients"])
-        self._logger.emit_value("pihole.status", data["status"])
+        payload_hash = None
+
+        if self.__skip_unchanged_payloads:
+            payload_hash = hashlib.sha1(
+                VOLATILE_PAYLOAD_FIELDS_RE.sub(b"", resp.content)
+            ).hexdigest()
+
+            if payload_hash == target.last_payload_hash:
+                self._handle_unchanged_payload(target)
+                return
+
+        try:
+            data = resp.json()
+        except ValueError as e:
+            # NOTE: We don't store the payload hash and conditional headers for invalid payloads
+            # so the same payload is not treated as unchanged on the next sample
+            target.conditional_headers = {}
+            target.last_payload_hash = None
+
+            self._logger.warn(
+                "Failed to parse Pi-hole data for %s: %s" % (target.base_url, str(e))
+            )
+            return
+
+        if self.__skip_unchanged_payloads:
+            target.conditional_headers = {}
+
+            if resp.headers.get("ETag", None):
+                target.conditional_headers["If-None-Match"] = resp.headers["ETag"]
+
+            if resp.headers.get("Last-Modified", None):
+                target.conditional_headers["If-Modified-Since"] = resp.headers["Last-Modified"]
+
+            target.last_payload_hash = payload_hash
+
+        extra_fields = target.extra_fields
+
+        self._logger.emit_value(
+            "pihole.dns_queries_today", data["dns_queries_today"], extra_fields=extra_fields
+        )
+        self._logger.emit_value(
+            "pihole.ads_blocked_today", data["ads_blocked_today"], extra_fields=extra_fields
+        )
+        self._logger.emit_value(
+            "pihole.ads_percentage_today",
+            round(data["ads_percentage_today"], 1),
+            extra_fields=extra_fields,
+        )
+        self._logger.emit_value(
+            "pihole.domains_being_blocked",
+            data["domains_being_blocked"],
+            extra_fields=extra_fields,
+        )
+        self._logger.emit_value(
+            "pihole.queries_cached", data["queries_cached"], extra_fields=extra_fields
+        )
+        self._logger.emit_value(
+            "pihole.queries_forwarded", data["queries_forwarded"], extra_fields=extra_fields
+        )
+        self._logger.emit_value(
+            "pihole.unique_domains", data["unique_domains"], extra_fields=extra_fields
+        )
+        self._logger.emit_value(
+            "pihole.unique_clients", data["unique_clients"], extra_fields=extra_fields
+        )
+        self._logger.emit_value("pihole.status", data["status"], extra_fields=extra_fields)
+
+        target.last_status = data["status"]
+
+        if not self.__calculate_rates:
+            return
+
+        now_ts = time.time()
+
+        for counter_metric_name, rate_metric_name in COUNTER_RATE_METRIC_NAMES:
+            rate = target.rate_calculator.calculate(
+                counter_metric_name, data[counter_metric_name.split(".", 1)[1]], now_ts
+            )
+
+            if rate is not None:
+                self._logger.emit_value(rate_metric_name, rate, extra_fields=extra_fields)
+
+    def _handle_unchanged_payload(self, target):
+        # type: (PiHoleTarget) -> None
+        # Counters haven't changed so the next rate should only be calculated from now on
+        unchanged_counter_names = target.rate_calculator.mark_unchanged(time.time())
+
+        if not self.__unchanged_payload_heartbeat or target.last_status is None:
+            return
+
+        self._logger.emit_value(
+            "pihole.status", target.last_status, extra_fields=target.extra_fields
+        )
+
+        # Counters really didn't move so we emit zero rates instead of leaving a gap
+        for counter_metric_name, rate_metric_name in COUNTER_RATE_METRIC_NAMES:
+            if counter_metric_name in unchanged_counter_names:
+                self._logger.emit_value(rate_metric_name, 0.0, extra_fields=target.extra_fields)
+
+    def _handle_details_response(self, target, resp, error):
+        # type: (PiHoleTarget, Optional[requests.Response], Optional[str]) -> None
+        if error is None and resp is not None and resp.status_code != 200:
+            error = resp.text
+
+        if error is not None or resp is None:
+            self._logger.warn(
+                "Failed to retrieve Pi-hole detailed data for %s: %s" % (target.base_url, error)
+            )
+            return
+
+        try:
+            data = resp.json()
+        except ValueError as e:
+            self._logger.warn(
+                "Failed to parse Pi-hole detailed data for %s: %s" % (target.base_url, str(e))
+            )
+            return
+
+        # NOTE: Pi-hole returns an empty array if the API token is missing or invalid
+        if not isinstance(data, dict):
+            self._logger.warn(
+                "Failed to retrieve Pi-hole detailed data for %s: invalid or missing API token"
+                % (target.base_url)
+            )
+            return
+
+        if self.__collect_top_items:
+            for key, metric_name in TOP_ITEMS_METRIC_NAMES:
+                buckets = get_top_items_buckets(
+                    data.get(key, None) or {},
+                    self.__top_items_count,
+                    self.__top_items_cardinality_budget,
+                )
+
+                # Buckets which were present in the previous sample, but aren't anymore are
+                # reset to 0
+                for bucket in target.top_items_buckets.get(metric_name, {}):
+                    if bucket not in buckets:
+                        self._emit_changed_value(target, metric_name, 0, {"bucket": bucket})
+
+                for bucket, value in six.iteritems(buckets):
+                    self._emit_changed_value(target, metric_name, value, {"bucket": bucket})
+
+                target.top_items_buckets[metric_name] = buckets
+
+        if self.__collect_query_types:
+            for query_type, value in six.iteritems(data.get("querytypes", None) or {}):
+                self._emit_changed_value(
+                    target,
+                    "pihole.query_types.percentage",
+                    round(value, 2),
+                    {"query_type": query_type},
+                )
+
+        if self.__collect_forward_destinations:
+            for destination, value in six.iteritems(
+                data.get("forward_destinations", None) or {}
+            ):
+                # Destination is in "name|ip" format (e.g. "dns.google#53|8.8.8.8")
+                name, _, ip = destination.partition("|")
+                self._emit_changed_value(
+                    target,
+                    "pihole.forward_destinations.percentage",
+                    round(value, 2),
+                    {"destination": name or ip},
+                )
+
+        if self.__collect_over_time_data:
+            for key, metric_name in OVER_TIME_METRIC_NAMES:
+                for timestamp, value in sorted((data.get(key, None) or {}).items()):
+                    self._emit_changed_value(
+                        target, metric_name, value, {}, timestamp=int(timestamp) * 1000
+                    )
+
+    def _emit_changed_value(self, target, metric_name, value, extra_fields, timestamp=None):
+        # type: (PiHoleTarget, str, Any, Dict[str, str], Optional[int]) -> None
+        """
+        Emit the provided value only if it has changed since it was last emitted for this target.
+        """
+        cache_key = (metric_name, tuple(sorted(extra_fields.items())), timestamp)
+
+        if not target.emitted_values_cache.is_changed(cache_key, value):
+            return
+
+        extra_fields = dict(target.extra_fields, **extra_fields)
+
+        if timestamp is not None:
+            self._logger.emit_value(
+                metric_name, value, extra_fields=extra_fields, timestamp=timestamp
+            )
+        else:
+            self._logger.emit_value(metric_name, value, extra_fields=extra_fields)
@@ -25,15 +25,48 @@ seconds) so the values are actually gathering when those short bursty operations
 
 This of course only holds true for default setups - if you overclocked you RPI or changed idle
 frequencies, that may not be needed.
+
+Metrics which are also exposed by the kernel via sysfs (SoC temperature, ARM clock and throttled
+state) are read directly from sysfs files without spawning a process. File descriptors for those
+files are kept open and re-read on each sample. If those files are not available (e.g. older
+kernel), we fall back to vcgencmd.
+
+By default, remaining values are retrieved in-process using the VideoCore mailbox device (/dev/vcio)
+which is the same interface vcgencmd uses to run commands in the firmware. This way we avoid
+spawning a vcgencmd process for each metric on every sample, which is not cheap on low powered
+devices such as Pi Zero. Agent user needs read and write access to the device (usually a member of
+the "video" group). Old behavior (one process per metric) is still available using
+"collection_mode: per_metric" config option and is also used as a fallback in case the mailbox
+device can't be used. vcgencmd binary is only required for the per metric mode.
+
+To catch short bursts without lowering the sample interval, you can enable high frequency sampling
+using "high_frequency_sampling_rate" config option (e.g. 10 - 50 Hz). In this mode, a background
+thread samples SoC temperature, ARM clock and throttled state from sysfs into a fixed size ring
+buffer and on each sample interval the monitor emits aggregated values (min, max, mean, p95 and
+the fraction of time throttled) for all the samples collected since the previous interval.
+
+Throttled state bit mask is also decoded into a metric per flag (rpi.status.under_voltage,
+rpi.status.under_voltage_occurred, etc.). Since throttled state almost never changes, throttled
+state and flag metrics are only emitted when the value changes and on every full refresh
+interval (see "throttled_state_full_refresh_interval" config option).
 """
 
 if False:
     from typing import List
     from typing import Tuple
     from typing import Callable
+    from typing import Optional
+    from typing import Dict
+    from typing import Any
 
 import os
 import re
+import glob
+import time
+import array
+import fcntl
+import struct
+import threading
 import subprocess
 
 from collections import OrderedDict
@@ -44,14 +77,72 @@ from scalyr_agent import define_config_option
 from scalyr_agent import define_log_field
 from scalyr_agent import define_metric
 
+try:
+    from custom_monitors.monitor_utils import get_percentile
+except ImportError:
+    # Monitor module has been loaded directly from the custom_monitors directory
+    from monitor_utils import get_percentile  # type: ignore
+
 __monitor__ = __name__
 
 define_config_option(
     __monitor__,
     "vcgencmd_path",
-    "Path to /opt/vc/bin/vcgencmd binary. Defaults to /opt/vc/bin/vcgencmd.",
+    "Path to /opt/vc/bin/vcgencmd binary. Binary is only required by the \"per_metric\" "
+    "collection mode and used as a fallback when the mailbox device can't be used. Defaults to "
+    "/opt/vc/bin/vcgencmd.",
     default="/opt/vc/bin/vcgencmd",
 )
+define_config_option(
+    __monitor__,
+    "collection_mode",
+    "How to retrieve vcgencmd values. \"mailbox\" (default) runs the commands in-process using "
+    "the VideoCore mailbox device and \"per_metric\" spawns a new vcgencmd process for each "
+    "metric.",
+    default="mailbox",
+)
+define_config_option(
+    __monitor__,
+    "vcio_path",
+    "Path to the VideoCore mailbox device used by the \"mailbox\" collection mode. Defaults to "
+    "/dev/vcio.",
+    default="/dev/vcio",
+)
+define_config_option(
+    __monitor__,
+    "use_file_sources",
+    "True to read metrics which are available via sysfs directly from sysfs files instead of "
+    "using vcgencmd. Defaults to True.",
+    default=True,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "sysfs_root",
+    "Root directory under which sysfs files are looked up. Defaults to /.",
+    default="/",
+)
+define_config_option(
+    __monitor__,
+    "high_frequency_sampling_rate",
+    "How many times per second (Hz) to sample SoC temperature, ARM clock and throttled state in "
+    "a background thread. Values are aggregated and emitted on each sample interval. Only metrics "
+    "which are available via sysfs are sampled this way. Defaults to 0 (disabled).",
+    default=0,
+    convert_to=int,
+    min_value=0,
+    max_value=50,
+)
+define_config_option(
+    __monitor__,
+    "throttled_state_full_refresh_interval",
+    "Throttled state and flag metrics are only emitted when the value changes. This option "
+    "specifies how often (in seconds) to emit all of those metrics regardless of the change. Set "
+    "it to 0 to emit them on every sample. Defaults to 600.",
+    default=600,
+    convert_to=int,
+    min_value=0,
+)
 
 define_metric(
     __monitor__,
@@ -112,6 +203,72 @@ define_metric(
     "Voltage for SDRAM Phy in Volts",
 )
 
+# Maps throttled state bit to the name of the metric for that flag
+THROTTLED_STATE_FLAGS = OrderedDict([
+    (0, "rpi.status.under_voltage"),
+    (1, "rpi.status.frequency_capped"),
+    (2, "rpi.status.throttled"),
+    (3, "rpi.status.soft_temperature_limit"),
+    (16, "rpi.status.under_voltage_occurred"),
+    (17, "rpi.status.frequency_capped_occurred"),
+    (18, "rpi.status.throttled_occurred"),
+    (19, "rpi.status.soft_temperature_limit_occurred"),
+])
+
+define_metric(
+    __monitor__,
+    "rpi.status.under_voltage",
+    "1 if under-voltage is currently detected, 0 otherwise.",
+)
+define_metric(
+    __monitor__,
+    "rpi.status.frequency_capped",
+    "1 if ARM frequency is currently capped, 0 otherwise.",
+)
+define_metric(
+    __monitor__,
+    "rpi.status.throttled",
+    "1 if the SoC is currently throttled, 0 otherwise.",
+)
+define_metric(
+    __monitor__,
+    "rpi.status.soft_temperature_limit",
+    "1 if the soft temperature limit is currently active, 0 otherwise.",
+)
+define_metric(
+    __monitor__,
+    "rpi.status.under_voltage_occurred",
+    "1 if under-voltage has occurred since the last reboot, 0 otherwise.",
+)
+define_metric(
+    __monitor__,
+    "rpi.status.frequency_capped_occurred",
+    "1 if ARM frequency capping has occurred since the last reboot, 0 otherwise.",
+)
+define_metric(
+    __monitor__,
+    "rpi.status.throttled_occurred",
+    "1 if throttling has occurred since the last reboot, 0 otherwise.",
+)
+define_metric(
+    __monitor__,
+    "rpi.status.soft_temperature_limit_occurred",
+    "1 if the soft temperature limit has been reached since the last reboot, 0 otherwise.",
+)
+
+# Metrics which are only emitted when high frequency sampling is enabled
+define_metric(
+    __monitor__,
+    "rpi.status.throttled_fraction",
+    "Fraction of high frequency samples (0 - 1) in which any of the current throttling flags "
+    "(under-voltage, frequency capped, throttled, soft temperature limit) was set.",
+)
+
+for _metric_name in ["rpi.soc.temperature", "rpi.arm.clock"]:
+    define_metric(__monitor__, _metric_name + ".min", "Minimum high frequency sample value.")
+    define_metric(__monitor__, _metric_name + ".max", "Maximum high frequency sample value.")
+    define_metric(__monitor__, _metric_name + ".p95", "95th percentile high frequency sample value.")
+
 
 def parse_clock(value):
     # type: (str) -> int
@@ -130,23 +287,156 @@ def parse_volts(value):
     return result
 
 
-# Maps Scalyr metric name to vcgencmd command args and result conversion function
+def parse_sysfs_temperature(values):
+    # type: (List[str]) -> float
+    # Value is in millidegrees Celsius, we round it to the same precision as vcgencmd uses
+    return round(int(values[0]) / 1000.0, 1)
+
+
+def parse_sysfs_clock(values):
+    # type: (List[str]) -> int
+    # Values are in kHz. All the ARM cores share the same clock so we report the highest value.
+    return int(max([int(value) for value in values]) / 1000)  # MHz
+
+
+def parse_sysfs_throttled(values):
+    # type: (List[str]) -> str
+    # Value is hex encoded without the 0x prefix
+    return bin(int(values[0], 16)).replace("0b", "")
+
+
+class SysfsFileSource(object):
+    """
+    Metric source which reads the value from one or more sysfs files without spawning a process.
+
+    Files are opened on first use and file descriptors are kept open. Values are then re-read using
+    os.pread() which is a single syscall per file and doesn't require a seek.
+    """
+
+    READ_SIZE = 64
+
+    def __init__(self, path_patterns, parse_func, root="/"):
+        # type: (List[str], Callable, str) -> None
+        self.__path_patterns = path_patterns
+        self.__parse_func = parse_func
+        self.__root = root
+        self.__fds = None  # type: Optional[List[int]]
+
+    def is_available(self):
+        # type: () -> bool
+        return len(self.__get_fds()) > 0
+
+    def read(self, parse_func=None):
+        # type: (Optional[Callable]) -> Any
+        values = [
+            os.pread(fd, self.READ_SIZE, 0).decode("utf-8").strip() for fd in self.__get_fds()
+        ]
+        return (parse_func or self.__parse_func)(values)
+
+    def close(self):
+        # type: () -> None
+        for fd in self.__fds or []:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+        self.__fds = None
+
+    def __get_fds(self):
+        # type: () -> List[int]
+        if self.__fds is not None:
+            return self.__fds
+
+        self.__fds = []
+
+        for path_pattern in self.__path_patterns:
+            for file_path in sorted(glob.glob(os.path.join(self.__root, path_pattern))):
+                try:
+                    self.__fds.append(os.open(file_path, os.O_RDONLY))
+                except OSError:
+                    continue
+
+        return self.__fds
+
+
+class RingBuffer(object):
+    """
+    Fixed size thread safe ring buffer for numeric samples backed by array.array.
+
+    Once the buffer is full, the oldest samples are overwritten.
+    """
+
+    def __init__(self, size):
+        # type: (int) -> None
+        self.__size = size
+        self.__values = array.array("d", [0.0]) * size
+        self.__index = 0
+        self.__count = 0
+        self.__lock = threading.Lock()
+
+    def append(self, value):
+        # type: (float) -> None
+        with self.__lock:
+            self.__values[self.__index] = value
+            self.__index = (self.__index + 1) % self.__size
+            self.__count = min(self.__count + 1, self.__size)
+
+    def drain(self):
+        # type: () -> List[float]
+        """
+        Return all the samples in the buffer (oldest first) and clear the buffer.
+        """
+        with self.__lock:
+            start = (self.__index - self.__count) % self.__size
+
+            if start + self.__count <= self.__size:
+                values = self.__values[start:start + self.__count].tolist()
+            else:
+                values = (self.__values[start:] + self.__values[:self.__index]).tolist()
+
+            self.__count = 0
+
+        return values
+
+
+# Maps Scalyr metric name to vcgencmd command args and result conversion function. Metrics which
+# are also exposed via sysfs declare "file_source" with sysfs path patterns (relative to the sysfs
+# root) and a function which converts raw file values. Metrics marked with "high_frequency" are
+# sampled by the background thread when high frequency sampling is enabled ("sample_parse_func"
+# needs to return a numeric value and defaults to "parse_func").
 COMMAND_ARGS_TO_METRIC_NAME_MAP = OrderedDict([
     ("rpi.status.throttled_state", {
         "args": ["get_throttled"],
-        "parse_func": lambda v: bin(int(v.replace("throttled=", ""), 0)).replace("0b", "")
+        "parse_func": lambda v: bin(int(v.replace("throttled=", ""), 0)).replace("0b", ""),
+        "file_source": {
+            "paths": ["sys/devices/platform/soc/soc:firmware/get_throttled"],
+            "parse_func": parse_sysfs_throttled,
+            "sample_parse_func": lambda values: int(values[0], 16),
+        },
+        "high_frequency": True,
     }),
 
     # SoC related metrics
     ("rpi.soc.temperature", {
         "args": ["measure_temp"],
         "parse_func": lambda v: float(v.replace("temp=", "").replace("'C", "")),
+        "file_source": {
+            "paths": ["sys/class/thermal/thermal_zone0/temp"],
+            "parse_func": parse_sysfs_temperature,
+        },
+        "high_frequency": True,
     }),
 
     # Frequency clock metrics (in MHz)
     ("rpi.arm.clock", {
         "args": ["measure_clock", "arm"],
         "parse_func": parse_clock,
+        "file_source": {
+            "paths": ["sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq"],
+            "parse_func": parse_sysfs_clock,
+        },
+        "high_frequency": True,
     }),
     ("rpi.core.clock", {
         "args": ["measure_clock", "core"],
@@ -186,6 +476,115 @@ COMMAND_ARGS_TO_METRIC_NAME_MAP = OrderedDict([
 
 define_log_field(__monitor__, "monitor", "Always ``raspberry_pi_monitor``.")
 
+COLLECTION_MODES = ["mailbox", "per_metric"]
+
+# VideoCore mailbox property interface ioctl - _IOWR(100, 0, char *)
+IOCTL_MBOX_PROPERTY = (3 << 30) | (struct.calcsize("P") << 16) | (100 << 8) | 0
+
+# Property tag which runs vcgencmd command in the firmware and returns the command output
+MBOX_TAG_GET_GENCMD_RESULT = 0x00030080
+MBOX_GENCMD_MAX_STRING = 1024
+
+# Response code set by the firmware when the property request has been processed successfully
+MBOX_RESPONSE_SUCCESS = 0x80000000
+
+# Size of the mailbox message in bytes (6 header words, command / response string and end tag)
+MBOX_MESSAGE_SIZE = 6 * 4 + MBOX_GENCMD_MAX_STRING + 4
+
+# Throttled state bits which indicate the throttling is currently active (under-voltage, frequency
+# capped, throttled, soft temperature limit)
+THROTTLED_CURRENT_FLAGS_MASK = 0xF
+
+
+class VcgencmdMailboxError(Exception):
+    pass
+
+
+class VcgencmdMailboxCollector(object):
+    """
+    Runs vcgencmd commands in-process using the VideoCore mailbox property interface (/dev/vcio).
+
+    This is the same interface vcgencmd binary uses internally - command string is sent to the
+    firmware using "get gencmd result" property tag and the firmware returns the command output.
+    Device file is opened once and kept open which means no process is spawned for any metric.
+    """
+
+    def __init__(self, device_path="/dev/vcio"):
+        # type: (str) -> None
+        self.__device_path = device_path
+        self.__fd = None  # type: Optional[int]
+
+    def collect(self, commands_args):
+        # type: (List[List[str]]) -> List[Tuple[bool, str]]
+        """
+        Run the provided commands and return (success, output) tuple for each command.
+
+        Raises VcgencmdMailboxError if the mailbox device can't be used.
+        """
+        if not commands_args:
+            return []
+
+        fd = self.__get_fd()
+        return [self.__run_command(fd=fd, command=" ".join(args)) for args in commands_args]
+
+    def close(self):
+        # type: () -> None
+        if self.__fd is None:
+            return
+
+        fd, self.__fd = self.__fd, None
+        os.close(fd)
+
+    def __get_fd(self):
+        # type: () -> int
+        if self.__fd is None:
+            try:
+                self.__fd = os.open(self.__device_path, os.O_RDWR)
+            except (IOError, OSError) as e:
+                raise VcgencmdMailboxError(
+                    "Failed to open mailbox device %s: %s" % (self.__device_path, str(e))
+                )
+
+        return self.__fd
+
+    def __run_command(self, fd, command):
+        # type: (int, str) -> Tuple[bool, str]
+        data = command.encode("utf-8")
+
+        if len(data) >= MBOX_GENCMD_MAX_STRING:
+            return False, "Command is too long"
+
+        # Message consists of total size, request code, tag id, value buffer size, request size,
+        # gencmd error code, NUL terminated command string (replaced by the response) and end tag
+        buf = bytearray(MBOX_MESSAGE_SIZE)
+        struct.pack_into(
+            "=6I", buf, 0, MBOX_MESSAGE_SIZE, 0, MBOX_TAG_GET_GENCMD_RESULT,
+            MBOX_GENCMD_MAX_STRING, 0, 0,
+        )
+        buf[24:24 + len(data)] = data
+
+        try:
+            fcntl.ioctl(fd, IOCTL_MBOX_PROPERTY, buf, True)
+        except (IOError, OSError) as e:
+            self.close()
+            raise VcgencmdMailboxError("Mailbox property request failed: %s" % (str(e)))
+
+        response_code, = struct.unpack_from("=I", buf, 4)
+        error_code, = struct.unpack_from("=I", buf, 20)
+
+        if response_code != MBOX_RESPONSE_SUCCESS:
+            raise VcgencmdMailboxError(
+                "Mailbox property request failed: response_code=0x%x" % (response_code)
+            )
+
+        output = bytes(buf[24:24 + MBOX_GENCMD_MAX_STRING]).split(b"\0", 1)[0]
+        output = output.decode("utf-8", "replace").strip()
+
+        if error_code != 0:
+            return False, "Command failed: error_code=%s,output=%s" % (error_code, output)
+
+        return True, output
+
 
 class RaspberryPiMetricsMonitor(ScalyrMonitor):
     def _initialize(self):
@@ -195,25 +594,308 @@ class RaspberryPiMetricsMonitor(ScalyrMonitor):
             default="/opt/vc/bin/vcgencmd",
             required_field=True,
         )
+        self.__collection_mode = self._config.get(
+            "collection_mode", convert_to=str, default="mailbox",
+        )
+        self.__vcio_path = self._config.get(
+            "vcio_path", convert_to=str, default="/dev/vcio",
+        )
+        self.__use_file_sources = self._config.get(
+            "use_file_sources", convert_to=bool, default=True,
+        )
+        self.__sysfs_root = self._config.get(
+            "sysfs_root", convert_to=str, default="/",
+        )
+        self.__high_frequency_sampling_rate = self._config.get(
+            "high_frequency_sampling_rate", convert_to=int, default=0, min_value=0, max_value=50,
+        )
+        self.__throttled_state_full_refresh_interval = self._config.get(
+            "throttled_state_full_refresh_interval", convert_to=int, default=600, min_value=0,
+        )
+
+        if self.__collection_mode not in COLLECTION_MODES:
+            raise ValueError(
+                "Invalid collection_mode: %s. Valid values are: %s"
+                % (self.__collection_mode, ", ".join(COLLECTION_MODES))
+            )
 
-        if not os.path.isfile(self.__binary_path):
+        # NOTE: In mailbox mode, binary is only needed if we need to fall back to per metric mode
+        if self.__collection_mode == "per_metric" and not os.path.isfile(self.__binary_path):
             raise ValueError("Binary path %s doesn't exist" % (self.__binary_path))
 
+        # False if neither the mailbox device nor the vcgencmd binary can be used
+        self.__vcgencmd_available = True
+
+        # NOTE: Mailbox device is opened lazily on first sample since _initialize() is also called
+        # when stopping the agent.
+        self.__mailbox_collector = VcgencmdMailboxCollector(device_path=self.__vcio_path)
+
+        # Files are also opened lazily on first read
+        self.__file_sources = {}  # type: Dict[str, SysfsFileSource]
+
+        if self.__use_file_sources:
+            for metric_name, values in six.iteritems(COMMAND_ARGS_TO_METRIC_NAME_MAP):
+                if "file_source" not in values:
+                    continue
+
+                self.__file_sources[metric_name] = SysfsFileSource(
+                    path_patterns=values["file_source"]["paths"],
+                    parse_func=values["file_source"]["parse_func"],
+                    root=self.__sysfs_root,
+                )
+
+        # Last emitted value for throttled state and flag metrics
+        self.__last_throttled_values = {}  # type: Dict[str, Any]
+        self.__last_throttled_full_refresh_ts = 0
+
+        # Ring buffers for metrics sampled by the high frequency sampler thread. Buffer can hold
+        # samples for two sample intervals so a delayed gather_sample() doesn't lose any samples.
+        self.__sample_buffers = OrderedDict()  # type: Dict[str, RingBuffer]
+        self.__sampler_thread = None  # type: Optional[threading.Thread]
+        self.__sampler_stop_event = threading.Event()
+
+        if self.__high_frequency_sampling_rate > 0:
+            buffer_size = max(
+                int(self.__high_frequency_sampling_rate * self._sample_interval_secs * 2), 1
+            )
+
+            for metric_name, values in six.iteritems(COMMAND_ARGS_TO_METRIC_NAME_MAP):
+                if not values.get("high_frequency", False):
+                    continue
+
+                if metric_name not in self.__file_sources:
+                    continue
+
+                self.__sample_buffers[metric_name] = RingBuffer(size=buffer_size)
+
+    def stop(self, *args, **kwargs):
+        self.__sampler_stop_event.set()
+
+        if self.__sampler_thread:
+            self.__sampler_thread.join(5)
+
+        self.__mailbox_collector.close()
+
+        for file_source in self.__file_sources.values():
+            file_source.close()
+
+        super(RaspberryPiMetricsMonitor, self).stop(*args, **kwargs)
+
     def gather_sample(self):
         # type: () -> None
-        for metric_name, values in six.iteritems(COMMAND_ARGS_TO_METRIC_NAME_MAP):
-            command_args = values["args"]  # type: List[str]
-            parse_func = values["parse_func"]  # type: Callable
-            success, value = self._gather_value(command_args=command_args)
+        if self.__sample_buffers and not self.__sampler_thread:
+            self.__start_sampler_thread()
+
+        metric_names = list(COMMAND_ARGS_TO_METRIC_NAME_MAP.keys())
+
+        # Metrics which have high frequency samples available are emitted as aggregates
+        samples = OrderedDict()  # type: Dict[str, List[float]]
+        for metric_name, sample_buffer in six.iteritems(self.__sample_buffers):
+            values = sample_buffer.drain()
+
+            if values:
+                samples[metric_name] = values
+                metric_names.remove(metric_name)
+
+        values = self._gather_values(metric_names=metric_names)
+
+        for metric_name in COMMAND_ARGS_TO_METRIC_NAME_MAP.keys():
+            if metric_name in samples:
+                self._emit_aggregated_values(metric_name=metric_name, values=samples[metric_name])
+                continue
+
+            if metric_name not in values:
+                # Value can't be retrieved using any of the available sources
+                continue
+
+            success, value = values[metric_name]
 
             if not success:
                 self._logger.warn("Failed to retrieve value for metric %s: %s" % (metric_name,
                                                                                   value))
                 continue
 
-            metric_value = parse_func(value)
+            if metric_name == "rpi.status.throttled_state":
+                self._emit_throttled_state(throttled_state=int(value, 2))
+                continue
+
+            self._logger.emit_value(metric_name, value)
+
+    def _emit_throttled_state(self, throttled_state):
+        # type: (int) -> None
+        """
+        Emit throttled state and decoded flag metrics which have changed since the last sample.
+        """
+        now_ts = time.time()
+
+        if (
+            self.__last_throttled_full_refresh_ts + self.__throttled_state_full_refresh_interval
+            <= now_ts
+        ):
+            self.__last_throttled_values = {}
+            self.__last_throttled_full_refresh_ts = now_ts
+
+        values = [("rpi.status.throttled_state", bin(throttled_state).replace("0b", ""))]
 
-            self._logger.emit_value(metric_name, metric_value)
+        for bit, metric_name in six.iteritems(THROTTLED_STATE_FLAGS):
+            values.append((metric_name, 1 if throttled_state & (1 << bit) else 0))
+
+        for metric_name, value in values:
+            if self.__last_throttled_values.get(metric_name, None) == value:
+                continue
+
+            self.__last_throttled_values[metric_name] = value
+            self._logger.emit_value(metric_name, value)
+
+    def _emit_aggregated_values(self, metric_name, values):
+        # type: (str, List[float]) -> None
+        """
+        Emit aggregated values for samples collected by the high frequency sampler thread.
+        """
+        if metric_name == "rpi.status.throttled_state":
+            # Throttled state contains flags which were set at any point during this interval
+            throttled_state = 0
+            throttled_count = 0
+
+            for value in values:
+                throttled_state |= int(value)
+
+                if int(value) & THROTTLED_CURRENT_FLAGS_MASK:
+                    throttled_count += 1
+
+            self._emit_throttled_state(throttled_state=throttled_state)
+            self._logger.emit_value(
+                "rpi.status.throttled_fraction", round(float(throttled_count) / len(values), 3)
+            )
+            return
+
+        # NOTE: Mean is reported under the original metric name
+        sorted_values = sorted(values)
+        self._logger.emit_value(metric_name, round(sum(sorted_values) / len(sorted_values), 2))
+        self._logger.emit_value(metric_name + ".min", sorted_values[0])
+        self._logger.emit_value(metric_name + ".max", sorted_values[-1])
+        self._logger.emit_value(metric_name + ".p95", get_percentile(sorted_values, 95))
+
+    def __start_sampler_thread(self):
+        # type: () -> None
+        # Files are opened here (and not lazily by the sampler thread) so both threads don't try
+        # to open them at the same time
+        for metric_name in list(self.__sample_buffers.keys()):
+            if not self.__file_sources[metric_name].is_available():
+                del self.__sample_buffers[metric_name]
+
+        if not self.__sample_buffers:
+            self._logger.warn(
+                "None of the sysfs files are available, high frequency sampling is disabled"
+            )
+            return
+
+        self.__sampler_thread = threading.Thread(
+            target=self.__run_sampler, name="rpi high frequency sampler"
+        )
+        self.__sampler_thread.daemon = True
+        self.__sampler_thread.start()
+
+    def __run_sampler(self):
+        # type: () -> None
+        interval = 1.0 / self.__high_frequency_sampling_rate
+        next_sample_ts = time.time()
+
+        while not self.__sampler_stop_event.is_set():
+            for metric_name, sample_buffer in six.iteritems(self.__sample_buffers):
+                file_source = self.__file_sources[metric_name]
+                parse_func = COMMAND_ARGS_TO_METRIC_NAME_MAP[metric_name]["file_source"].get(
+                    "sample_parse_func", None
+                )
+
+                try:
+                    sample_buffer.append(file_source.read(parse_func=parse_func))
+                except (IOError, OSError, ValueError):
+                    # Errors are reported by gather_sample() which falls back to the regular
+                    # read in case there are no samples available
+                    continue
+
+            # If we fall behind, we skip the missed samples instead of trying to catch up
+            next_sample_ts = max(next_sample_ts + interval, time.time())
+            self.__sampler_stop_event.wait(next_sample_ts - time.time())
+
+    def _gather_values(self, metric_names):
+        # type: (List[str]) -> Dict[str, Tuple[bool, Any]]
+        """
+        Retrieve parsed values for the provided metrics.
+
+        Metrics which have a file source available are read directly from sysfs and the rest are
+        retrieved using vcgencmd.
+        """
+        result = {}  # type: Dict[str, Tuple[bool, Any]]
+        vcgencmd_metric_names = []  # type: List[str]
+
+        for metric_name in metric_names:
+            file_source = self.__file_sources.get(metric_name, None)
+
+            if file_source and file_source.is_available():
+                try:
+                    result[metric_name] = (True, file_source.read())
+                    continue
+                except (IOError, OSError, ValueError) as e:
+                    self._logger.debug(
+                        "Failed to read value for metric %s from sysfs, falling back to "
+                        "vcgencmd: %s" % (metric_name, str(e))
+                    )
+
+            vcgencmd_metric_names.append(metric_name)
+
+        raw_values = self._gather_vcgencmd_values(metric_names=vcgencmd_metric_names)
+
+        if raw_values is None:
+            # Values which are only available via vcgencmd can't be collected
+            return result
+
+        for metric_name, (success, value) in zip(vcgencmd_metric_names, raw_values):
+            if success:
+                parse_func = COMMAND_ARGS_TO_METRIC_NAME_MAP[metric_name]["parse_func"]  # type: Callable
+                value = parse_func(value)
+
+            result[metric_name] = (success, value)
+
+        return result
+
+    def _gather_vcgencmd_values(self, metric_names):
+        # type: (List[str]) -> Optional[List[Tuple[bool, str]]]
+        """
+        Retrieve raw vcgencmd output for the provided metrics using the configured collection mode.
+
+        None is returned if vcgencmd values can't be retrieved using any of the collection modes.
+        """
+        commands_args = [
+            COMMAND_ARGS_TO_METRIC_NAME_MAP[metric_name]["args"] for metric_name in metric_names
+        ]  # type: List[List[str]]
+
+        if self.__collection_mode == "mailbox":
+            try:
+                return self.__mailbox_collector.collect(commands_args=commands_args)
+            except VcgencmdMailboxError as e:
+                # Mailbox device is usually not available because of the permissions (agent user
+                # needs to be a member of the "video" group) so we don't retry it on every sample
+                self.__collection_mode = "per_metric"
+                self.__vcgencmd_available = os.path.isfile(self.__binary_path)
+
+                if self.__vcgencmd_available:
+                    self._logger.warn(
+                        "Failed to retrieve values using mailbox mode, falling back to per metric "
+                        "mode: %s" % (str(e))
+                    )
+                else:
+                    self._logger.warn(
+                        "Failed to retrieve values using mailbox mode and binary path %s doesn't "
+                        "exist so only values which are available via sysfs will be collected: %s"
+                        % (self.__binary_path, str(e))
+                    )
+
+        if not self.__vcgencmd_available:
+            return None
+
+        return [self._gather_value(command_args=command_args) for command_args in commands_args]
 
     def _gather_value(self, command_args):
         # type: (List[str]) -> Tuple[bool, str]
@@ -15,13 +15,50 @@
 """
 Scalyr agent monitor which collects real time electricity usage data (in watts) from Tibber Pulse
 device.
+
+Live measurements are streamed over a websocket by the tibber library. The websocket feed runs on
+a dedicated asyncio event loop in a background thread and measurements are handed off to the
+monitor thread using a thread safe queue. This way "gather_sample()" never blocks (it only drains
+the queue) and "stop()" can deterministically shut down the event loop.
+
+A single monitor instance can collect data for multiple homes ("homes" config option). All the
+home subscriptions run concurrently on the same event loop and metrics for each home include the
+"home" extra field.
+
+Homes are discovered in the event loop thread so agent start up is never blocked on the Tibber
+API. If "metadata_cache_path" config option is set, home metadata and the websocket subscription
+URL are cached on disk and on subsequent starts the live feed is started directly using the cached
+metadata without waiting for the blocking account discovery API call. Keep in mind that the
+tibber library still refreshes the account data asynchronously once the websocket connection has
+been established.
+
+Measurements are aggregated into fixed windows of "sample_write_interval" seconds and each closed
+window is emitted as count, min, max, mean and last value for every live measurement field, plus
+energy (in Wh) which was consumed during that window.
+
+If "spool_path" config option is set, aggregated windows are appended to a local on-disk spool
+(directory with append-only JSON lines segment files and a read cursor file) as soon as they are
+closed and only then emitted with their original timestamps. When the monitor is stopped, windows
+which are still open (including measurements which are still queued) are also written to the
+spool. Cursor is only advanced on the next sample (or when the monitor is stopped) after the
+values have been emitted so windows which have been aggregated but not yet emitted (e.g. agent was
+restarted or killed) are replayed on the next start. Spool size is bounded by "spool_max_size" and
+the oldest segments are evicted first.
 """
 
+import os
+import re
 import time
+import errno
+import hashlib
+import queue
+import asyncio
 import logging
+import threading
 
-# NOTE: Should use feature/exception-handling branch with connection retry fies
-# pip install git+https://github.com/BeatsuDev/tibber.py.git@feature/exception-handling
+# NOTE: Live feed uses TibberHome.start_websocket_loop() coroutine which is available in tibber.py
+# 0.7.1 (start_live_feed() is a blocking wrapper around it which runs its own event loop)
+# pip install tibber.py==0.7.1
 
 import tibber
 
@@ -30,6 +67,8 @@ from scalyr_agent import define_config_option
 from scalyr_agent import define_log_field
 from scalyr_agent import define_metric
 from scalyr_agent import scalyr_logging
+from scalyr_agent import util as scalyr_util
+from scalyr_agent.json_lib import JsonArray
 
 __monitor__ = __name__
 
@@ -38,23 +77,459 @@ define_config_option(
     "access_token",
     "Tibber access token which needs to have home and realtime read permissions.",
 )
+define_config_option(
+    __monitor__,
+    "homes",
+    "Optional list of Tibber home IDs to collect the data for. If not specified, data is "
+    "collected for all the homes on the account which have real time consumption enabled.",
+    convert_to=JsonArray,
+)
 define_config_option(
     __monitor__,
     "sample_write_interval",
     "How often (in seconds) to write sample into the metrics log file. Data is streamed to the "
-    "monitor in real time (every second or so) over a websocket, but we only write it to a file "
-    "every X seconds.",
+    "monitor in real time (every second or so) over a websocket and aggregated into windows of "
+    "this size. Aggregated values are written to a file once per window.",
     default=30,
 )
+define_config_option(
+    __monitor__,
+    "metadata_cache_path",
+    "Optional path to the file where home metadata is cached between agent restarts so the live "
+    "feed can be started without discovering homes using the Tibber API first.",
+)
+define_config_option(
+    __monitor__,
+    "spool_path",
+    "Optional path to the directory where aggregated readings are spooled before they are "
+    "emitted. Spooled readings which haven't been emitted yet are replayed with their original "
+    "timestamps after the agent restart.",
+)
+define_config_option(
+    __monitor__,
+    "spool_max_size",
+    "Maximum size of the spool directory in bytes. When the limit is reached, the oldest spooled "
+    "readings are evicted first.",
+    default=10 * 1024 * 1024,
+    convert_to=int,
+)
 define_metric(
     __monitor__,
     "tibber.consumption",
-    "Current electricity consumption in watts",
+    "Average electricity consumption in watts during the sample window. Minimum, maximum and last "
+    "value are emitted as tibber.consumption.min, tibber.consumption.max and "
+    "tibber.consumption.last. For compatibility with the previous versions, the average value "
+    "includes the last phase 1 voltage in the sample window as voltage_phase extra field.",
+    extra_fields={"voltage_phase": ""},
+)
+define_metric(
+    __monitor__,
+    "tibber.consumption.energy_wh",
+    "Electricity consumed during the sample window in Wh (integrated from the power samples).",
+)
+define_metric(
+    __monitor__,
+    "tibber.production",
+    "Average power production in watts during the sample window (also emitted as .min, .max "
+    "and .last).",
+)
+define_metric(
+    __monitor__,
+    "tibber.current",
+    "Average per phase current in amperes during the sample window (also emitted as .min, .max "
+    "and .last).",
+    extra_fields={"phase": ""},
+)
+define_metric(
+    __monitor__,
+    "tibber.voltage",
+    "Average per phase voltage during the sample window (also emitted as .min, .max and .last).",
+    extra_fields={"phase": ""},
+)
+define_metric(
+    __monitor__,
+    "tibber.accumulated_consumption",
+    "Accumulated electricity consumption since midnight in kWh (last value in the sample window).",
 )
+define_metric(
+    __monitor__,
+    "tibber.measurements",
+    "Number of live measurements received during the sample window.",
+)
+
+USER_AGENT = "ScalyrAgentMonitor/0.0.1"
+
+# Maximum number of live measurements which can be queued for the monitor thread. If the monitor
+# thread falls behind, new measurements are dropped.
+MAX_QUEUE_SIZE = 1000
+
+# How many times the tibber library retries connecting and subscribing to the live feed websocket
+LIVE_FEED_RETRIES = 10
+
+# Delay (in seconds) before the live feed is restarted after an unexpected error
+LIVE_FEED_RESTART_DELAY = 10
+
+# Initial and maximum delay (in seconds) before the event loop thread is restarted after it has
+# died because of an unexpected error. Delay is doubled on each consecutive restart.
+LOOP_THREAD_RESTART_DELAY = 10
+MAX_LOOP_THREAD_RESTART_DELAY = 300
+
+# How long (in seconds) to wait for the event loop thread to finish when stopping the monitor
+LOOP_THREAD_JOIN_TIMEOUT = 5
+
+# Power samples which are further apart than this (in seconds) are not used for energy
+# integration since we don't know what happened in between (e.g. websocket was disconnected)
+MAX_ENERGY_INTEGRATION_GAP = 60
+
+# Maximum size of a single spool segment file in bytes
+SPOOL_SEGMENT_SIZE = 1024 * 1024
+
+# Maximum number of spooled windows which are replayed during a single sample so a large backlog
+# doesn't block the monitor thread
+MAX_SPOOL_REPLAY_RECORDS = 500
+
+# Live measurement fields which are aggregated, in the following format:
+# (field name, metric name, extra fields, emit only last value)
+AGGREGATED_FIELDS = [
+    ("power", "tibber.consumption", {}, False),
+    ("power_production", "tibber.production", {}, False),
+    ("accumulated_consumption", "tibber.accumulated_consumption", {}, True),
+    ("current_l1", "tibber.current", {"phase": "1"}, False),
+    ("current_l2", "tibber.current", {"phase": "2"}, False),
+    ("current_l3", "tibber.current", {"phase": "3"}, False),
+    ("voltage_phase_1", "tibber.voltage", {"phase": "1"}, False),
+    ("voltage_phase_2", "tibber.voltage", {"phase": "2"}, False),
+    ("voltage_phase_3", "tibber.voltage", {"phase": "3"}, False),
+]
+
+# Index of the field which is also emitted as voltage_phase extra field of the consumption value
+VOLTAGE_PHASE_FIELD_INDEX = [field[0] for field in AGGREGATED_FIELDS].index("voltage_phase_1")
+
+# Maps field name to the tibber.LiveMeasurement attribute name for fields where those differ. In
+# tibber.py 0.7.1, per phase current is the only value which is exposed using camelCase property
+# names (currentL1, currentL2, currentL3).
+LIVE_MEASUREMENT_ATTRIBUTE_NAMES = {
+    "current_l1": "currentL1",
+    "current_l2": "currentL2",
+    "current_l3": "currentL3",
+}
 
 
 global_log = scalyr_logging.getLogger(__name__)
 
+
+class FieldAggregate(object):
+    """
+    Streaming aggregate (count, min, max, sum and last value) for a single measurement field.
+    """
+
+    __slots__ = ["count", "min", "max", "sum", "last"]
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.last = value
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return round(self.sum / self.count, 3)
+
+
+class MeasurementWindow(object):
+    """
+    Aggregated live measurements for a single time window [start, end).
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.count = 0
+        self.energy_wh = 0.0
+        self.fields = [FieldAggregate() for _ in AGGREGATED_FIELDS]
+
+
+class MeasurementAggregator(object):
+    """
+    Aggregates live measurements into fixed size time windows using constant memory per window.
+
+    Energy is integrated from the power samples assuming the power stays the same until the next
+    sample is received. The part of the interval which falls after the end of the window is
+    accounted for in the next window.
+    """
+
+    def __init__(self, window_size):
+        self.__window_size = window_size
+        self.__window = None
+        # Value and receive timestamp of the last received power sample
+        self.__previous_power = None
+        self.__previous_power_ts = None
+
+    def add(self, timestamp, data):
+        """
+        Add measurement to the current window and return list of windows which have been closed
+        by this measurement.
+        """
+        closed_windows = []
+
+        if self.__window and timestamp >= self.__window.end:
+            closed_windows = self.close_expired(timestamp)
+
+        if not self.__window:
+            start = timestamp - (timestamp % self.__window_size)
+            self.__window = MeasurementWindow(start, start + self.__window_size)
+
+        window = self.__window
+        window.count += 1
+
+        for index, (field_name, _, _, _) in enumerate(AGGREGATED_FIELDS):
+            attribute_name = LIVE_MEASUREMENT_ATTRIBUTE_NAMES.get(field_name, field_name)
+            value = getattr(data, attribute_name, None)
+
+            if value is None:
+                continue
+
+            window.fields[index].add(value)
+
+        power = getattr(data, "power", None)
+
+        if power is not None:
+            self.__integrate_energy(window.start, timestamp)
+            self.__previous_power = power
+            self.__previous_power_ts = timestamp
+
+        return closed_windows
+
+    def close_expired(self, now):
+        """
+        Close current window if it has ended before the provided timestamp and return list with
+        the closed window (if any).
+        """
+        window = self.__window
+
+        if not window or now < window.end:
+            return []
+
+        # NOTE: We don't move previous power timestamp to the window end since gaps between the
+        # power samples need to be measured from the last received sample
+        self.__integrate_energy(window.start, window.end)
+
+        self.__window = None
+        return [window]
+
+    def flush(self):
+        """
+        Close current window even if it hasn't ended yet and return list with the closed window
+        (if any).
+        """
+        window = self.__window
+        self.__window = None
+
+        return [window] if window else []
+
+    def __integrate_energy(self, start, end):
+        if self.__previous_power_ts is None:
+            return
+
+        start = max(start, self.__previous_power_ts)
+
+        if end <= start or end - self.__previous_power_ts > MAX_ENERGY_INTEGRATION_GAP:
+            return
+
+        self.__window.energy_wh += self.__previous_power * (end - start) / 3600.0
+
+
+class MeasurementSpool(object):
+    """
+    Append-only spool for aggregated readings which is stored on disk.
+
+    Spool is a directory with segment files (one JSON encoded record per line) and a cursor file
+    which stores position (segment number and byte offset) of the first record which hasn't been
+    consumed yet. Segments which have been fully consumed are deleted and if the spool grows over
+    the size limit, the oldest segments are evicted even if they haven't been consumed.
+    """
+
+    SEGMENT_FILE_NAME_RE = re.compile(r"^segment-(\d+)\.jsonl$")
+
+    def __init__(self, path, max_size, segment_size=SPOOL_SEGMENT_SIZE):
+        self.__path = path
+        self.__max_size = max_size
+        self.__segment_size = min(segment_size, max(max_size // 4, 1))
+
+        # Maps segment number to the segment size in bytes
+        self.__segments = None
+        # [segment number, offset] of the first record which hasn't been consumed yet
+        self.__cursor = None
+        # Segment which we currently append to
+        self.__write_segment = None
+
+    def append(self, records):
+        """
+        Append records to the spool and return number of segments which have been evicted because
+        the size limit has been reached.
+        """
+        self.__load()
+
+        if not records:
+            return 0
+
+        if (
+            self.__write_segment is None
+            or self.__segments.get(self.__write_segment, 0) >= self.__segment_size
+        ):
+            self.__write_segment = max(list(self.__segments.keys()) + [self.__cursor[0]]) + 1
+            self.__segments[self.__write_segment] = 0
+
+        data = b"".join(
+            scalyr_util.json_encode(record).encode("utf-8") + b"\n" for record in records
+        )
+
+        with open(self.__get_segment_path(self.__write_segment), "ab") as fp:
+            fp.write(data)
+
+        self.__segments[self.__write_segment] += len(data)
+
+        return self.__evict()
+
+    def read(self, max_records):
+        """
+        Return list with up to max_records records which haven't been consumed yet and cursor
+        which needs to be passed to commit() once those records have been processed.
+        """
+        self.__load()
+
+        records = []
+        segment, offset = self.__cursor
+
+        for number in sorted(self.__segments.keys()):
+            if number < segment:
+                continue
+
+            if number > segment:
+                segment, offset = number, 0
+
+            with open(self.__get_segment_path(number), "rb") as fp:
+                fp.seek(offset)
+
+                while len(records) < max_records:
+                    line = fp.readline()
+
+                    if not line.endswith(b"\n"):
+                        # End of the segment or a partially written record
+                        break
+
+                    offset += len(line)
+
+                    try:
+                        records.append(scalyr_util.json_decode(line.decode("utf-8")))
+                    except ValueError:
+                        # Corrupted record, skip it
+                        pass
+
+            if len(records) >= max_records:
+                break
+
+        return records, [segment, offset]
+
+    def commit(self, cursor):
+        """
+        Mark all the records before the provided cursor as consumed.
+        """
+        self.__load()
+
+        # NOTE: Cursor could have already been moved past the provided one if the segments have
+        # been evicted in the mean time
+        if cursor <= self.__cursor:
+            return
+
+        self.__cursor = cursor
+
+        for number in list(self.__segments.keys()):
+            if number < cursor[0]:
+                self.__delete_segment(number)
+
+        self.__persist_cursor()
+
+    def __evict(self):
+        evicted = 0
+
+        while sum(self.__segments.values()) > self.__max_size and len(self.__segments) > 1:
+            number = min(self.__segments.keys())
+            self.__delete_segment(number)
+            evicted += 1
+
+            if self.__cursor[0] <= number:
+                self.__cursor = [number + 1, 0]
+
+        if evicted:
+            self.__persist_cursor()
+
+        return evicted
+
+    def __delete_segment(self, number):
+        self.__segments.pop(number, None)
+
+        try:
+            os.unlink(self.__get_segment_path(number))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def __persist_cursor(self):
+        cursor_path = os.path.join(self.__path, "cursor.json")
+        tmp_path = cursor_path + ".tmp"
+
+        with open(tmp_path, "w") as fp:
+            fp.write(scalyr_util.json_encode(self.__cursor))
+
+        os.replace(tmp_path, cursor_path)
+
+    def __get_segment_path(self, number):
+        return os.path.join(self.__path, "segment-%012d.jsonl" % (number))
+
+    def __load(self):
+        # NOTE: Spool is loaded lazily on first use since _initialize() is also called when
+        # stopping the agent
+        if self.__segments is not None:
+            return
+
+        if not os.path.isdir(self.__path):
+            os.makedirs(self.__path)
+
+        self.__segments = {}
+
+        for file_name in os.listdir(self.__path):
+            match = self.SEGMENT_FILE_NAME_RE.match(file_name)
+
+            if match:
+                number = int(match.group(1))
+                self.__segments[number] = os.path.getsize(self.__get_segment_path(number))
+
+        self.__cursor = [min(self.__segments.keys()) if self.__segments else 0, 0]
+
+        try:
+            with open(os.path.join(self.__path, "cursor.json"), "r") as fp:
+                self.__cursor = list(scalyr_util.json_decode(fp.read()))
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            # Corrupted cursor file, we replay all the spooled records
+            pass
+
+
 class TibberPulselectricityConsumptionMonitor(ScalyrMonitor):
     def _initialize(self):
         self.__access_token = self._config.get(
@@ -68,15 +543,176 @@ class TibberPulselectricityConsumptionMonitor(ScalyrMonitor):
             required_field=True,
         )
 
+        self.__home_ids = list(
+            self._config.get(
+                "homes", convert_to=JsonArray, required_field=False, default=JsonArray(),
+            )
+        )
+        self.__metadata_cache_path = self._config.get(
+            "metadata_cache_path",
+            convert_to=str,
+            required_field=False,
+        )
+
+        spool_path = self._config.get(
+            "spool_path",
+            convert_to=str,
+            required_field=False,
+        )
+        spool_max_size = self._config.get(
+            "spool_max_size",
+            convert_to=int,
+            default=10 * 1024 * 1024,
+            min_value=1024,
+        )
+
         self._setup_logging()
 
-        self._account = tibber.Account(self.__access_token)
-        self._home = self._account.homes[0]
+        # NOTE: Homes are discovered lazily in the event loop thread so we don't block agent
+        # start up on the Tibber API calls
+        self._homes = None
 
         self._stopped = False
         self._callbacks_added = False
 
-        self._last_sample_ts = 0
+        # Maps home ID to the aggregator for that home
+        self._aggregators = {}
+        self._spool = None
+        # Spool cursor for the records which have been emitted, but not committed yet
+        self._spool_emitted_cursor = None
+
+        if spool_path:
+            self._spool = MeasurementSpool(path=spool_path, max_size=spool_max_size)
+
+        # Live measurements (home ID, receive timestamp, measurement) handed off from the event
+        # loop thread
+        self._queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+
+        # NOTE: Event loop thread is started on first sample since _initialize() is also called
+        # when stopping the agent
+        self._loop = None
+        self._loop_thread = None
+        self._live_feed_task = None
+        self._stop_event = threading.Event()
+
+        # Number of consecutive event loop thread restarts and the time of the next allowed restart
+        self._loop_thread_restarts = 0
+        self._loop_thread_restart_ts = 0
+
+    def _discover_homes(self):
+        """
+        Return homes to collect the data for.
+
+        If home metadata is available in the metadata cache, homes are created from the cached
+        metadata without making the account discovery API call.
+        """
+        metadata = self._read_metadata_cache()
+
+        if metadata:
+            account = tibber.Account(
+                self.__access_token, user_agent=USER_AGENT, immediate_update=False
+            )
+
+            # NOTE: Live feed reads websocket subscription URL from the account viewer data so we
+            # need to populate account cache and not only create the homes
+            account.update_cache(
+                {
+                    "viewer": {
+                        "websocketSubscriptionUrl": metadata["websocket_subscription_url"],
+                        "homes": metadata["homes"],
+                    }
+                }
+            )
+
+            try:
+                return self._select_homes(account.homes)
+            except ValueError:
+                # Cache is stale (e.g. homes config option has been changed), fall back to the
+                # account discovery
+                pass
+
+        account = tibber.Account(self.__access_token, user_agent=USER_AGENT)
+        homes = self._select_homes(account.homes)
+        self._write_metadata_cache(account)
+
+        return homes
+
+    def _read_metadata_cache(self):
+        if not self.__metadata_cache_path:
+            return None
+
+        try:
+            with open(self.__metadata_cache_path, "r") as fp:
+                metadata = scalyr_util.json_decode(fp.read())
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+            return None
+        except ValueError:
+            # Corrupted cache file, we discover homes using the API
+            return None
+
+        # Cached metadata is only valid for the account it was retrieved for
+        if metadata.get("access_token_hash", None) != self._get_access_token_hash():
+            return None
+
+        if not metadata.get("homes", None) or not metadata.get("websocket_subscription_url", None):
+            return None
+
+        return metadata
+
+    def _write_metadata_cache(self, account):
+        if not self.__metadata_cache_path:
+            return
+
+        websocket_subscription_url = account.viewer.websocket_subscription_url
+
+        if not websocket_subscription_url:
+            return
+
+        metadata = {
+            "access_token_hash": self._get_access_token_hash(),
+            "websocket_subscription_url": websocket_subscription_url,
+            "homes": [home.cache for home in account.homes],
+        }
+
+        tmp_path = self.__metadata_cache_path + ".tmp"
+
+        with open(tmp_path, "w") as fp:
+            fp.write(scalyr_util.json_encode(metadata))
+
+        os.replace(tmp_path, self.__metadata_cache_path)
+
+    def _get_access_token_hash(self):
+        return hashlib.sha256(self.__access_token.encode("utf-8")).hexdigest()
+
+    def _select_homes(self, account_homes):
+        home_ids = self.__home_ids
+
+        if not home_ids:
+            homes = [
+                home
+                for home in account_homes
+                if home.features.real_time_consumption_enabled
+            ]
+
+            if not homes:
+                raise ValueError(
+                    "None of the homes on this account has real time consumption enabled"
+                )
+
+            return homes
+
+        homes_by_id = dict((home.id, home) for home in account_homes)
+        unknown_home_ids = [home_id for home_id in home_ids if home_id not in homes_by_id]
+
+        if unknown_home_ids:
+            raise ValueError(
+                "Homes %s don't exist on this account" % (", ".join(unknown_home_ids))
+            )
+
+        return [homes_by_id[home_id] for home_id in home_ids]
 
     def _setup_logging(self):
         # Silence default very noisy loggers
@@ -88,54 +724,274 @@ class TibberPulselectricityConsumptionMonitor(ScalyrMonitor):
             "gql"
         ]
 
-        for logger_name in logging.root.manager.loggerDict:
-            for silenced_logger_name in silenced_loggers:
-                if logger_name.startswith(silenced_logger_name) and "tibber_pulse_monitor" not in logger_name:
-                    logging.getLogger(logger_name).setLevel(logging.CRITICAL)
+        # NOTE: Child loggers inherit the level from the parent logger so we don't need to walk
+        # all the registered loggers
+        for logger_name in silenced_loggers:
+            logging.getLogger(logger_name).setLevel(logging.CRITICAL)
 
     def _add_callbacks(self):
         if self._callbacks_added:
             return
 
-        def when_to_stop(data):
-            return self._stopped or not self._run_state.is_running()
+        for home in self._homes:
+            self._add_home_callback(home)
 
-        @self._home.event("live_measurement")
+        self._callbacks_added = True
+
+    def _add_home_callback(self, home):
+        home_id = home.id
+
+        @home.event("live_measurement")
         async def handle_sample(data):
-            now_ts = int(time.time())
+            # NOTE: This runs in the event loop thread so we only hand off the measurement
+            try:
+                self._queue.put_nowait((home_id, time.time(), data))
+            except queue.Full:
+                pass
 
-            if self._last_sample_ts + self.__sample_write_interval < now_ts:
-                extra_fields = {
-                    "home": self._home.id,
-                    "voltage_phase": data.voltage_phase_1,
-                }
-                self._logger.emit_value("tibber.consumption", data.power, extra_fields=extra_fields)
+    def _start_loop_thread(self):
+        if self._loop_thread and self._loop_thread.is_alive():
+            return
 
-                self._last_sample_ts = now_ts
+        if self._loop_thread:
+            # Event loop thread has died because of an unexpected error so we restart it with an
+            # exponential back off
+            now = time.time()
 
-        self._home.start_live_feed(user_agent="ScalyrAgentMonitor/0.0.1",
-                                   connection_retries=10, query_retries=10,
-                                   exit_condition=when_to_stop)
+            if not self._loop_thread_restart_ts:
+                delay = min(
+                    LOOP_THREAD_RESTART_DELAY * 2 ** self._loop_thread_restarts,
+                    MAX_LOOP_THREAD_RESTART_DELAY,
+                )
+                self._loop_thread_restart_ts = now + delay
+                self._loop_thread_restarts += 1
 
-        self._callbacks_added = True
+                self._logger.warn(
+                    "Tibber live feed event loop thread has died, restarting it in %s seconds"
+                    % (delay)
+                )
+
+            if now < self._loop_thread_restart_ts:
+                return
+
+            self._loop_thread_restart_ts = 0
+
+        self._stop_event.clear()
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self._run_loop, name="TibberLiveFeedEventLoop"
+        )
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+
+        try:
+            while self._homes is None and not self._stop_event.is_set():
+                try:
+                    self._homes = self._discover_homes()
+                except Exception:
+                    global_log.exception("Failed to discover Tibber homes")
+                    self._stop_event.wait(LIVE_FEED_RESTART_DELAY)
+
+            if self._homes is None or self._stop_event.is_set():
+                return
+
+            self._add_callbacks()
+            self._live_feed_task = self._loop.create_task(self._run_live_feeds())
+
+            try:
+                self._loop.run_until_complete(self._live_feed_task)
+            except asyncio.CancelledError:
+                pass
+        except Exception:
+            global_log.exception("Tibber live feed event loop thread has died unexpectedly")
+        finally:
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+
+    async def _run_live_feeds(self):
+        await asyncio.gather(*[self._run_live_feed(home) for home in self._homes])
+
+    async def _run_live_feed(self, home):
+        def when_to_stop(data):
+            return self._stopped or self._stop_event.is_set() or not self._run_state.is_running()
+
+        while not self._stop_event.is_set():
+            try:
+                await home.start_websocket_loop(when_to_stop, retries=LIVE_FEED_RETRIES)
+            except Exception:
+                # There are multiple bugs in the underlying libraries which can result in
+                # uncaught exceptions which stop the live feed. In case like this, we restart
+                # the live feed after a short delay
+                global_log.exception(
+                    "Received an exception when waiting for data for home %s in an async loop"
+                    % (home.id)
+                )
+
+            await asyncio.sleep(LIVE_FEED_RESTART_DELAY)
+
+    def _stop_loop_thread(self):
+        self._stop_event.set()
+
+        if not self._loop_thread:
+            return
+
+        def cancel_live_feed():
+            if self._live_feed_task:
+                self._live_feed_task.cancel()
+
+        try:
+            self._loop.call_soon_threadsafe(cancel_live_feed)
+        except RuntimeError:
+            # Event loop has already been closed
+            pass
+
+        self._loop_thread.join(LOOP_THREAD_JOIN_TIMEOUT)
+        self._loop_thread = None
 
     def stop(self, *args, **kwargs):
         self._stopped = True
+        self._stop_loop_thread()
         super(TibberPulselectricityConsumptionMonitor, self).stop(*args, **kwargs)
 
+        if not self._spool:
+            return
+
+        # Values from the last sample have been emitted so we can commit them. Windows which are
+        # still open and measurements which haven't been aggregated yet are written to the spool
+        # so they are replayed on the next start
+        if self._spool_emitted_cursor:
+            self._spool.commit(self._spool_emitted_cursor)
+            self._spool_emitted_cursor = None
+
+        records = self._aggregate_queued_measurements()
+
+        for home_id, aggregator in self._aggregators.items():
+            for window in aggregator.flush():
+                records.append(self._get_window_record(home_id, window))
+
+        self._append_to_spool(records)
+
     def gather_sample(self):
         # type: () -> None
-        # This monitor is async and uses callback so gather_sample is a no-op.
-        if not self._callbacks_added:
-            # We add callbacks on first iteration since "_initialize()" is called before we call
-            # parent constructor so not all the thread related state is available yet. Keep in mind
-            # that this method is blocking since it calls underlying blocking library method.
+        # We start event loop thread on first iteration since "_initialize()" is called before we
+        # call parent constructor so not all the thread related state is available yet.
+        self._start_loop_thread()
+
+        # Records which have been emitted during the previous sample are committed now so they
+        # are replayed if the agent is killed before the values are written out
+        if self._spool and self._spool_emitted_cursor:
+            self._spool.commit(self._spool_emitted_cursor)
+            self._spool_emitted_cursor = None
+
+        records = self._aggregate_queued_measurements()
+
+        now = time.time()
+
+        for home_id, aggregator in self._aggregators.items():
+            for window in aggregator.close_expired(now):
+                records.append(self._get_window_record(home_id, window))
+
+        if not self._spool:
+            for record in records:
+                self._emit_record(record)
+
+            return
+
+        self._append_to_spool(records)
+
+        spooled_records, cursor = self._spool.read(max_records=MAX_SPOOL_REPLAY_RECORDS)
+
+        for record in spooled_records:
+            self._emit_record(record)
+
+        self._spool_emitted_cursor = cursor
+
+    def _aggregate_queued_measurements(self):
+        """
+        Drain all the measurements received since the previous sample, aggregate them and return
+        records for the windows which have been closed.
+        """
+        records = []
+
+        while True:
             try:
-                self._add_callbacks()
-            except Exception:
-                # There are multiple bugs in the underlying libraries which can result in
-                # uncaught exceptions which stop the loop. In case like this, we set
-                # _callbacks_added to False to they get re-added and live feed + async loop
-                # re-started on the next gather sample call
-                global_log.exception("Received an exception when waiting for data in an async loop")
-                self._callbacks_added = False
+                home_id, received_ts, data = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            # Live feed is working so the next event loop thread restart (if any) uses the
+            # initial delay
+            self._loop_thread_restarts = 0
+
+            aggregator = self._aggregators.get(home_id, None)
+
+            if aggregator is None:
+                aggregator = MeasurementAggregator(window_size=self.__sample_write_interval)
+                self._aggregators[home_id] = aggregator
+
+            for window in aggregator.add(received_ts, data):
+                records.append(self._get_window_record(home_id, window))
+
+        return records
+
+    def _append_to_spool(self, records):
+        evicted = self._spool.append(records)
+
+        if evicted:
+            self._logger.warn(
+                "Spool size limit has been reached, evicted %s oldest spool segment(s)" % (evicted)
+            )
+
+    def _emit_record(self, record):
+        for name, value, extra_fields in record["values"]:
+            self._logger.emit_value(
+                name, value, extra_fields=extra_fields, timestamp=record["timestamp"]
+            )
+
+    def _get_window_record(self, home_id, window):
+        """
+        Return record with all the values for the provided aggregated window which can be stored
+        in the spool.
+        """
+        home_fields = {"home": home_id}
+        values = [("tibber.measurements", window.count, home_fields)]
+
+        # Last phase 1 voltage which is included with the consumption value as voltage_phase extra
+        # field for compatibility with the previous versions
+        voltage_phase = window.fields[VOLTAGE_PHASE_FIELD_INDEX]
+
+        for (_, metric_name, field_extra_fields, last_only), aggregate in zip(
+            AGGREGATED_FIELDS, window.fields
+        ):
+            if aggregate.count == 0:
+                continue
+
+            extra_fields = dict(home_fields)
+            extra_fields.update(field_extra_fields)
+
+            if last_only:
+                values.append((metric_name, aggregate.last, extra_fields))
+            else:
+                mean_extra_fields = extra_fields
+
+                if metric_name == "tibber.consumption" and voltage_phase.count > 0:
+                    mean_extra_fields = dict(extra_fields, voltage_phase=voltage_phase.last)
+
+                values.extend(
+                    [
+                        (metric_name, aggregate.mean, mean_extra_fields),
+                        (metric_name + ".min", aggregate.min, extra_fields),
+                        (metric_name + ".max", aggregate.max, extra_fields),
+                        (metric_name + ".last", aggregate.last, extra_fields),
+                    ]
+                )
+
+        if window.fields[0].count > 0:
+            values.append(
+                ("tibber.consumption.energy_wh", round(window.energy_wh, 4), home_fields)
+            )
+
+        return {"timestamp": int(window.end * 1000), "values": values}
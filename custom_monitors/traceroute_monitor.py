@@ -18,153 +18,1953 @@ destination address.
 
 It's based on top of fast-mda-traceroute library.
 
+Multiple destinations can be traced using "destinations" config option. Traceroutes for all the
+destinations run concurrently (up to "max_parallel_traceroutes" at once) and metrics for each
+destination are emitted as soon as the traceroute for that destination completes (with
+"docker_exec" executor, traceroutes for all the destinations run using a single "docker exec"
+invocation and metrics are emitted once all of them have completed).
+
+By default, a new fast-mda-traceroute docker container is started for each traceroute. Container
+start up is expensive (it can take seconds and a lot of CPU before any probe is sent) so monitor
+also supports "docker_exec" executor which keeps a single long-lived container running and
+executes all the traceroutes inside it and "local" executor which runs locally installed
+fast-mda-traceroute binary directly.
+
+Traceroute output (scamper-json format) is parsed incrementally, line by line, while the process
+is running. Records other than "tracelb" are skipped without being JSON decoded.
+
+For each hop, RTT statistics (min, avg, max, standard deviation) and packet loss are calculated from
+all the probes and replies MDA traceroute has sent and received for that hop. When a node has
+multiple (load balanced) links, each responding address is reported as a separate hop with its
+own statistics. Hops without any replies are still included (with empty values) so per hop values
+always stay aligned with the hop list.
+
+Paths rarely change so monitor keeps a cache of the last path fingerprint (hash of the hop list)
+for each destination. Full hop list and per hop values are only included in the "traceroute.hops"
+metric when the path changes (in which case "traceroute.path_changed" metric is also emitted) and
+compact samples with only the total RTT and the path fingerprint are emitted otherwise. Per hop
+values can be included in every sample using "always_include_hop_stats" config option. Cache can
+optionally be persisted to disk using "path_cache_path" config option so path changes are also
+detected across agent restarts.
+
+For destinations where we only need end-to-end RTT and packet loss, monitor also supports a
+lightweight in-process ICMP echo probe mode ("probe_mode" config option). In this mode, a single
+ICMP socket (unprivileged datagram ICMP socket if allowed by "net.ipv4.ping_group_range" sysctl,
+raw socket otherwise) is used to probe all the destinations concurrently and replies are
+multiplexed using select. On each sample, monitor emits RTT min, avg, percentiles and max and
+packet loss for each destination. When used together with the full traceroute
+("icmp_and_traceroute" probe mode), traceroutes can run on a slower cadence using
+"traceroute_interval" config option.
+
+Destination host names are resolved to IPv4 addresses in a background thread so DNS lookups never
+block sample gathering and DNS changes are picked up without an agent restart. Each host name is
+resolved again once the TTL of its DNS record expires (bounded by "dns_min_refresh_interval" and
+"dns_refresh_interval"). TTL is retrieved by sending an "A" query to the first nameserver from
+/etc/resolv.conf and if that fails, host name is resolved again every "dns_refresh_interval"
+seconds. Destinations which haven't been resolved yet are skipped.
+Resolution time is reported using "traceroute.dns.resolution_time_ms" metric and a change of the
+destination address is reported as a path change.
+
+MDA traceroutes are expensive so monitor can also adaptively schedule traceroutes using
+"adaptive_scheduling" config option. Each time the path and total RTT for a destination are stable,
+the interval between traceroutes for that destination is doubled (up to "max_backoff_multiplier"
+times the sample interval). As soon as the path changes, total RTT deviates from the baseline by
+more than "rtt_deviation_threshold" or the traceroute fails, the interval is reset to the sample
+interval. Total number of probes sent by the traceroutes across all the destinations can also be
+bounded using "probe_budget_per_minute" config option.
+
 NOTE: This monitor is Python 3.8+ only
 """
 
 from typing import Dict
 from typing import Any
+from typing import Callable
+from typing import IO
+from typing import Iterable
+from typing import List
+from typing import Tuple
 from typing import Optional
 from typing import cast
 
+import os
+import math
+import shlex
+import errno
+import select
+import struct
 import socket
+import hashlib
+import signal
 import time
 import string
 import random
+import tempfile
+import threading
 import subprocess
 
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
 import six
 
 from scalyr_agent import util as scalyr_util
 from scalyr_agent import ScalyrMonitor
 from scalyr_agent import define_config_option
 from scalyr_agent import define_log_field
+from scalyr_agent import define_metric
+from scalyr_agent.json_lib import JsonArray
+
+try:
+    from custom_monitors.monitor_utils import get_percentile
+except ImportError:
+    # Monitor module has been loaded directly from the custom_monitors directory
+    from monitor_utils import get_percentile  # type: ignore
 
 __monitor__ = __name__
 
 define_log_field(__monitor__, "monitor", "Always ``traceroute_monitor``.")
 
 define_config_option(
-    __monitor__, "destination", "Destination IPv4 address for the traceroute.",
+    __monitor__,
+    "destination",
+    "Destination IPv4 address for the traceroute. Required unless \"destinations\" option is "
+    "used.",
+)
+define_config_option(
+    __monitor__, "label", "Optional label which is added to the metric for this destination.",
+)
+define_config_option(
+    __monitor__,
+    "destinations",
+    "Optional list of destinations to trace concurrently. Each item is either a destination "
+    "address string or an object with \"destination\" and optional \"label\" keys.",
+    convert_to=JsonArray,
+)
+define_config_option(
+    __monitor__,
+    "executor",
+    "How to run fast-mda-traceroute. \"docker_run\" (default) starts a new container for each "
+    "traceroute, \"docker_exec\" starts a single long-lived container and runs all the "
+    "traceroutes inside it and \"local\" runs locally installed fast-mda-traceroute binary.",
+    default="docker_run",
+)
+define_config_option(
+    __monitor__,
+    "docker_image",
+    "Docker image used by the docker executors.",
+    default="ghcr.io/dioptra-io/fast-mda-traceroute",
+)
+define_config_option(
+    __monitor__,
+    "traceroute_binary_path",
+    "Path to the fast-mda-traceroute binary used by the local executor.",
+    default="fast-mda-traceroute",
+)
+define_config_option(
+    __monitor__,
+    "max_parallel_traceroutes",
+    "Maximum number of traceroutes to run concurrently. Defaults to 8.",
+    default=8,
+    convert_to=int,
+    min_value=1,
+)
+define_config_option(
+    __monitor__,
+    "traceroute_timeout",
+    "Maximum time (in seconds) a single traceroute can take. Defaults to 120.",
+    default=120,
+    convert_to=float,
+)
+define_config_option(
+    __monitor__,
+    "path_change_detection",
+    "True to only include full hop list in the metric when the path changes and emit compact "
+    "samples otherwise. Defaults to True.",
+    default=True,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "always_include_hop_stats",
+    "True to include per hop RTT and loss values (hop_rtts, hop_rtts_min, hop_rtts_max, "
+    "hop_rtts_stddev and hop_loss) in every sample. By default, those values are only included "
+    "together with the full hop list. Defaults to False.",
+    default=False,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "path_cache_path",
+    "Optional path to the file where the last path fingerprint for each destination is persisted "
+    "so path changes are also detected across agent restarts.",
 )
 
+define_config_option(
+    __monitor__,
+    "probe_mode",
+    "What kind of probes to run. \"traceroute\" (default) runs full MDA traceroute, \"icmp\" "
+    "only sends ICMP echo probes and emits RTT and packet loss metrics and "
+    "\"icmp_and_traceroute\" does both.",
+    default="traceroute",
+)
+define_config_option(
+    __monitor__,
+    "traceroute_interval",
+    "How often (in seconds) to run full traceroute for each destination. Defaults to the sample "
+    "interval.",
+    convert_to=float,
+)
+define_config_option(
+    __monitor__,
+    "icmp_probe_count",
+    "Number of ICMP echo probes to send to each destination on each sample. Defaults to 5.",
+    default=5,
+    convert_to=int,
+    min_value=1,
+)
+define_config_option(
+    __monitor__,
+    "icmp_probe_interval",
+    "Interval (in seconds) between ICMP echo probes. Defaults to 0.2.",
+    default=0.2,
+    convert_to=float,
+)
+define_config_option(
+    __monitor__,
+    "icmp_probe_timeout",
+    "How long (in seconds) to wait for replies after the last ICMP echo probe has been sent. "
+    "Defaults to 2.",
+    default=2,
+    convert_to=float,
+)
+define_config_option(
+    __monitor__,
+    "dns_refresh_interval",
+    "Maximum time (in seconds) after which destination host names are resolved again, even if "
+    "the TTL of the DNS record is longer. Also used when the TTL can't be retrieved. Defaults to "
+    "300.",
+    default=300,
+    convert_to=float,
+    min_value=1,
+)
+define_config_option(
+    __monitor__,
+    "dns_min_refresh_interval",
+    "Minimum time (in seconds) after which destination host names are resolved again, even if "
+    "the TTL of the DNS record is shorter. Defaults to 30.",
+    default=30,
+    convert_to=float,
+    min_value=1,
+)
+define_config_option(
+    __monitor__,
+    "adaptive_scheduling",
+    "True to back off traceroute frequency for destinations with stable path and RTT. Defaults to "
+    "False.",
+    default=False,
+    convert_to=bool,
+)
+define_config_option(
+    __monitor__,
+    "max_backoff_multiplier",
+    "Maximum interval between traceroutes for a stable destination expressed as a multiple of the "
+    "sample interval (adaptive scheduling only). Defaults to 8.",
+    default=8,
+    convert_to=int,
+    min_value=1,
+)
+define_config_option(
+    __monitor__,
+    "rtt_deviation_threshold",
+    "Relative deviation of total RTT from the baseline (e.g. 0.25 for 25%) which is considered a "
+    "change and resets the interval (adaptive scheduling only). Defaults to 0.25.",
+    default=0.25,
+    convert_to=float,
+)
+define_config_option(
+    __monitor__,
+    "probe_budget_per_minute",
+    "Maximum number of probes traceroutes can send per minute across all the destinations. "
+    "Each traceroute is charged the number of probes it has actually sent (a single MDA "
+    "traceroute can send hundreds of probes) and destinations over the budget are deferred to "
+    "the next sample. 0 means no limit. Defaults to 0.",
+    default=0,
+    convert_to=float,
+)
 
-class TracerouteMonitor(ScalyrMonitor):
-    def _initialize(self) -> None:
-        self.__destination = self._config.get(
-            "destination", convert_to=six.text_type, required_field=True,
+define_metric(
+    __monitor__,
+    "traceroute.hops",
+    "Number of hops to the destination. Full hop list is only included when the path changes.",
+)
+define_metric(
+    __monitor__,
+    "traceroute.path_changed",
+    "Emitted with value 1 when the path to the destination has changed since the previous sample.",
+)
+define_metric(
+    __monitor__,
+    "traceroute.dns.resolution_time_ms",
+    "Time it took to resolve destination host name in milliseconds.",
+)
+define_metric(
+    __monitor__,
+    "traceroute.probe.loss",
+    "Ratio of ICMP echo probes without a reply (icmp probe modes only).",
+)
+
+for _stat_name in ["min", "avg", "p50", "p90", "p99", "max"]:
+    define_metric(
+        __monitor__,
+        "traceroute.probe.rtt." + _stat_name,
+        "ICMP echo RTT %s in milliseconds (icmp probe modes only)." % (_stat_name),
+    )
+
+EXECUTORS = ["docker_run", "docker_exec", "local"]
+
+PROBE_MODES = ["traceroute", "icmp", "icmp_and_traceroute"]
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+# ICMP echo header (type, code, checksum, identifier, sequence number)
+ICMP_ECHO_HEADER = struct.Struct("!BBHHH")
+
+# Percentiles which are emitted for ICMP echo probe RTTs
+ICMP_PROBE_RTT_PERCENTILES = [50, 90, 99]
+
+TRACEROUTE_ARGS = [
+    "--format",
+    "scamper-json",
+    "--max-round",
+    "10",
+    "--wait",
+    "3000",
+]
+
+
+# scamper-json output contains one JSON record per line and we only care about the "tracelb"
+# record. This allows us to cheaply skip other records without needing to JSON decode them.
+TRACELB_RECORD_MARKER = b'"tracelb"'
+
+# Used to retrieve TTL of the DNS record for the destination host names
+RESOLV_CONF_PATH = "/etc/resolv.conf"
+
+DNS_PORT = 53
+DNS_QUERY_TIMEOUT = 2
+DNS_HEADER = struct.Struct("!HHHHHH")
+DNS_RECORD_HEADER = struct.Struct("!HHIH")
+DNS_TYPE_A = 1
+DNS_TYPE_CNAME = 5
+DNS_CLASS_IN = 1
+DNS_FLAG_RECURSION_DESIRED = 0x0100
+
+# Prefix for the header lines which separate output for different destinations in the batch output
+BATCH_HEADER_MARKER = b"#traceroute-batch"
+
+# Extra time (in seconds) "docker exec" process for a batch can take on top of the traceroute
+# timeouts before it's killed
+BATCH_TIMEOUT_GRACE = 10
+
+# Exit code of "timeout -s KILL" when the command has been killed
+TIMEOUT_KILLED_EXIT_CODE = 137
+
+# Shell script which runs inside the worker container and runs traceroutes for all the destinations
+# passed in as arguments (up to "$1" at once). Output of each traceroute is written to a temporary
+# file and printed once all of them have completed, each one preceded by a header line with the
+# destination and exit code and followed by stderr (also preceded by a header line). This way the
+# output can be split per destination even though the traceroutes run concurrently.
+BATCH_SCRIPT_TEMPLATE = """
+parallel=$1
+shift
+dir=$(mktemp -d)
+i=0
+for destination; do
+    {{ {command} "$destination" > "$dir/$destination.out" 2> "$dir/$destination.err";
+      echo $? > "$dir/$destination.rc"; }} &
+    i=$((i + 1))
+    if [ $((i % parallel)) -eq 0 ]; then wait; fi
+done
+wait
+for destination; do
+    echo
+    echo "{marker} stdout $destination $(cat "$dir/$destination.rc")"
+    cat "$dir/$destination.out"
+    echo
+    echo "{marker} stderr $destination"
+    cat "$dir/$destination.err"
+done
+rm -rf "$dir"
+"""
+
+
+def read_tracelb_record(lines: Iterable[bytes]) -> Optional[Dict[str, Any]]:
+    """
+    Read scamper-json output line by line and return the first "tracelb" record (or None if the
+    output doesn't contain it).
+
+    Other records are skipped without being JSON decoded and the output is never buffered in
+    memory as a whole.
+    """
+    for line in lines:
+        if TRACELB_RECORD_MARKER not in line:
+            continue
+
+        item = scalyr_util.json_decode(line.decode("utf-8"))
+
+        if isinstance(item, dict) and item.get("type", None) == "tracelb":
+            return item
+
+    return None
+
+
+def get_hop_stats(node: Dict[str, Any]) -> List[Tuple[str, Optional[Dict[str, float]]]]:
+    """
+    Return list of (hop address, stats) tuples for the provided tracelb node.
+
+    Replies for probes on a link come from the link target so we return one hop for each link
+    target address (in the order of the links). This way RTTs for different load balanced links
+    are never attributed to the same address. Node without any links is returned as a single hop
+    without stats.
+    """
+    return get_path_hop_stats([node])
+
+
+def get_path_hop_stats(
+    nodes: List[Dict[str, Any]]
+) -> List[Tuple[str, Optional[Dict[str, float]]]]:
+    """
+    Return deduplicated list of (hop address, stats) tuples for all the provided tracelb nodes.
+
+    With multiple load balanced paths, the same address can be a link target of more than one node
+    (e.g. the last hop of a diamond). Probes on all the links to that address are combined into a
+    single hop. Node without any links (e.g. the destination) is only returned as a hop without
+    stats if its address is not already a link target.
+    """
+    # Maps hop address to the probes on all the links to that address (None for nodes without
+    # links). Dictionary preserves insertion order so hops are returned in the path order.
+    probes_by_hop: Dict[str, Optional[List[Dict[str, Any]]]] = {}
+
+    for node in nodes:
+        links = [link for link_set in node.get("links", None) or [] for link in link_set]
+
+        if not links:
+            probes_by_hop.setdefault(node["addr"], None)
+            continue
+
+        for link in links:
+            probes = probes_by_hop.get(link["addr"], None)
+
+            if probes is None:
+                probes = probes_by_hop[link["addr"]] = []
+
+            probes.extend(link.get("probes", None) or [])
+
+    return [
+        (hop, get_probes_stats(probes) if probes is not None else None)
+        for hop, probes in probes_by_hop.items()
+    ]
+
+
+def get_probes_count(record: Dict[str, Any]) -> int:
+    """
+    Return number of probes sent by the traceroute for the provided tracelb record.
+
+    "probec" value is used if available and otherwise probes on all the links are counted.
+    """
+    if record.get("probec", None) is not None:
+        return int(record["probec"])
+
+    return sum(
+        [
+            len(link.get("probes", None) or [])
+            for node in record.get("nodes", None) or []
+            for link_set in node.get("links", None) or []
+            for link in link_set
+        ]
+    )
+
+
+def get_probes_stats(probes: List[Dict[str, Any]]) -> Optional[Dict[str, float]]:
+    """
+    Return stats for the provided tracelb probes.
+
+    Stats include "min", "avg", "max" and "stddev" RTT (only if at least one reply has been
+    received) and "loss" (ratio of probes without a reply). If there are no probes, stats are None.
+    """
+    rtts = array("d")
+    probes_count = 0
+    replied_probes_count = 0
+
+    for probe in probes:
+        probes_count += 1
+
+        replies = [reply for reply in probe.get("replies", None) or [] if "rtt" in reply]
+
+        if replies:
+            replied_probes_count += 1
+            rtts.extend([reply["rtt"] for reply in replies])
+
+    if not probes_count:
+        return None
+
+    stats = {"loss": round(1 - (replied_probes_count / probes_count), 3)}
+
+    if rtts:
+        avg = sum(rtts) / len(rtts)
+        stats["min"] = min(rtts)
+        stats["max"] = max(rtts)
+        stats["avg"] = round(avg, 3)
+        stats["stddev"] = round(math.sqrt(sum([(rtt - avg) ** 2 for rtt in rtts]) / len(rtts)), 3)
+
+    return stats
+
+
+def format_hop_values(hops_stats: List[Optional[Dict[str, float]]], key: str) -> str:
+    """
+    Return comma delimited string with the provided stat value for each hop. Missing values are
+    represented with an empty string so values stay aligned with the hop list.
+    """
+    return ",".join(
+        [str(stats[key]) if stats and key in stats else "" for stats in hops_stats]
+    )
+
+
+def get_icmp_checksum(data: bytes) -> int:
+    """
+    Return Internet checksum (RFC 1071) for the provided data in host byte order.
+    """
+    if len(data) % 2:
+        data += b"\x00"
+
+    checksum = sum(struct.unpack("!%sH" % (len(data) // 2), data))
+    checksum = (checksum >> 16) + (checksum & 0xFFFF)
+    checksum += checksum >> 16
+
+    return ~checksum & 0xFFFF
+
+
+def get_nameserver(resolv_conf_path: str = RESOLV_CONF_PATH) -> Optional[str]:
+    """
+    Return first IPv4 nameserver from the provided resolv.conf file (or None if there is none).
+    """
+    try:
+        with open(resolv_conf_path, "r") as fp:
+            for line in fp:
+                parts = line.split()
+
+                if len(parts) >= 2 and parts[0] == "nameserver" and is_ipv4_address(parts[1]):
+                    return parts[1]
+    except (IOError, OSError):
+        pass
+
+    return None
+
+
+def get_dns_query(query_id: int, name: str) -> bytes:
+    """
+    Return DNS query packet for the "A" record of the provided host name.
+    """
+    header = DNS_HEADER.pack(query_id, DNS_FLAG_RECURSION_DESIRED, 1, 0, 0, 0)
+    question = b"".join(
+        [
+            struct.pack("!B", len(label)) + label
+            for label in name.rstrip(".").encode("idna").split(b".")
+        ]
+    )
+
+    return header + question + struct.pack("!BHH", 0, DNS_TYPE_A, DNS_CLASS_IN)
+
+
+def _skip_dns_name(data: bytes, offset: int) -> int:
+    # Name is either a sequence of labels terminated with an empty label or a pointer (possibly
+    # after some labels) to a name somewhere else in the packet
+    while True:
+        length = data[offset]
+
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+
+        if length == 0:
+            return offset + 1
+
+        offset += length + 1
+
+
+def get_dns_response_ttl(data: bytes, query_id: int) -> Optional[int]:
+    """
+    Return TTL for the provided DNS response or None if the response doesn't contain any "A"
+    records.
+
+    With CNAME chains, address is only valid for as long as all the records in the chain are so
+    the shortest TTL of all the "A" and "CNAME" records is returned.
+    """
+    response_id, _, questions_count, answers_count, _, _ = DNS_HEADER.unpack_from(data)
+
+    if response_id != query_id:
+        return None
+
+    offset = DNS_HEADER.size
+
+    for _ in range(0, questions_count):
+        offset = _skip_dns_name(data, offset) + 4
+
+    ttls = []
+    has_address = False
+
+    for _ in range(0, answers_count):
+        offset = _skip_dns_name(data, offset)
+        record_type, _, ttl, length = DNS_RECORD_HEADER.unpack_from(data, offset)
+        offset += DNS_RECORD_HEADER.size + length
+
+        if record_type in (DNS_TYPE_A, DNS_TYPE_CNAME):
+            ttls.append(ttl)
+            has_address = has_address or record_type == DNS_TYPE_A
+
+    if not has_address:
+        return None
+
+    return min(ttls)
+
+
+def get_dns_ttl(
+    name: str, nameserver: Optional[str] = None, timeout: float = DNS_QUERY_TIMEOUT
+) -> Optional[int]:
+    """
+    Return TTL of the "A" record for the provided host name by querying the provided nameserver
+    (first nameserver from /etc/resolv.conf by default) or None if it can't be retrieved.
+    """
+    nameserver = nameserver or get_nameserver()
+
+    if not nameserver:
+        return None
+
+    query_id = random.randint(0, 0xFFFF)
+
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect((nameserver, DNS_PORT))
+            sock.send(get_dns_query(query_id, name))
+            return get_dns_response_ttl(sock.recv(4096), query_id)
+    except (socket.error, UnicodeError, struct.error, IndexError):
+        return None
+
+
+class IcmpProber(object):
+    """
+    Sends ICMP echo probes to multiple destinations concurrently using a single socket.
+
+    Unprivileged datagram ICMP socket is used if allowed (kernel takes care of the identifier and
+    only delivers replies for our requests to the socket), otherwise we fall back to a raw socket
+    which requires CAP_NET_RAW.
+    """
+
+    def __init__(self, count: int = 5, interval: float = 0.2, timeout: float = 2) -> None:
+        self.__count = count
+        self.__interval = interval
+        self.__timeout = timeout
+
+        self.__sock: Optional[socket.socket] = None
+        self.__is_raw_socket = False
+        self.__identifier = random.randint(0, 0xFFFF)
+        self.__sequence = 0
+
+    def open(self) -> None:
+        if self.__sock:
+            return
+
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.__is_raw_socket = False
+        except (PermissionError, OSError):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.__is_raw_socket = True
+
+        sock.setblocking(False)
+        self.__sock = sock
+
+    def close(self) -> None:
+        if self.__sock:
+            self.__sock.close()
+            self.__sock = None
+
+    def probe(self, destinations: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Probe all the provided destination IPv4 addresses and return a dictionary which maps
+        destination to a dictionary with number of "sent" probes and "rtts" array with RTTs (in
+        milliseconds) for the received replies.
+        """
+        self.open()
+        sock = cast(socket.socket, self.__sock)
+
+        results: Dict[str, Dict[str, Any]] = dict(
+            [(destination, {"sent": 0, "rtts": array("d")}) for destination in destinations]
         )
 
-        self.__label = self._config.get(
-            "label", convert_to=six.text_type, required_field=False,
+        # Maps sequence number of the probes we are still waiting a reply for to the (destination,
+        # send time) tuple
+        in_flight: Dict[int, Tuple[str, float]] = {}
+
+        rounds_sent = 0
+        next_send_ts = time.monotonic()
+        deadline_ts: Optional[float] = None
+
+        while True:
+            now = time.monotonic()
+
+            if rounds_sent < self.__count and now >= next_send_ts:
+                for destination in results.keys():
+                    self.__send_probe(sock, destination, in_flight)
+                    results[destination]["sent"] += 1
+
+                rounds_sent += 1
+                next_send_ts = now + self.__interval
+
+                if rounds_sent == self.__count:
+                    deadline_ts = now + self.__timeout
+
+            if deadline_ts is not None and (now >= deadline_ts or not in_flight):
+                break
+
+            wait_until_ts = deadline_ts if deadline_ts is not None else next_send_ts
+            readable, _, _ = select.select([sock], [], [], max(wait_until_ts - now, 0))
+
+            if readable:
+                self.__receive_replies(sock, in_flight, results)
+
+        return results
+
+    def __send_probe(
+        self, sock: socket.socket, destination: str, in_flight: Dict[int, Tuple[str, float]]
+    ) -> None:
+        self.__sequence = (self.__sequence + 1) & 0xFFFF
+        payload = struct.pack("!d", time.time())
+
+        header = ICMP_ECHO_HEADER.pack(
+            ICMP_ECHO_REQUEST, 0, 0, self.__identifier, self.__sequence
+        )
+        checksum = get_icmp_checksum(header + payload)
+        header = ICMP_ECHO_HEADER.pack(
+            ICMP_ECHO_REQUEST, 0, checksum, self.__identifier, self.__sequence
         )
 
-        # We only support IPv4 so we manually resolve it to IPv4 address otherwise the underlying
-        # library may resolve it to IPv6 address and it won't work
-        self.__destination_ipv4 = socket.gethostbyname(self.__destination)
+        try:
+            sock.sendto(header + payload, (destination, 0))
+        except OSError:
+            # E.g. network is unreachable, probe is counted as lost
+            return
 
-    def gather_sample(self) -> None:
-        result = self.__run_traceroute_and_parse_output()
+        in_flight[self.__sequence] = (destination, time.monotonic())
 
-        if not result:
-            return None
+    def __receive_replies(
+        self,
+        sock: socket.socket,
+        in_flight: Dict[int, Tuple[str, float]],
+        results: Dict[str, Dict[str, Any]],
+    ) -> None:
+        while True:
+            try:
+                data, address = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
 
-        extra_fields = {
-            "destination": result["destination"],
-            "destination_original": self.__destination,
-            "label": self.__label or "",
-            "hops": ",".join(result["hops"]),
-            "hop_rtts": ",".join([str(value) for value in result["hop_rtts"]]),
-            "total_rtt": round(sum(result["hop_rtts"]), 2),
-            "method": result["method"]
-        }
-        self._logger.emit_value("traceroute.hops", result["hops_count"], extra_fields=extra_fields)
+            received_ts = time.monotonic()
+
+            # Raw sockets also return IP header
+            if self.__is_raw_socket:
+                data = data[(data[0] & 0x0F) * 4 :]
+
+            if len(data) < ICMP_ECHO_HEADER.size:
+                continue
+
+            icmp_type, _, _, identifier, sequence = ICMP_ECHO_HEADER.unpack_from(data)
+
+            if icmp_type != ICMP_ECHO_REPLY:
+                continue
+
+            # NOTE: For datagram sockets, kernel replaces identifier with the socket port and only
+            # delivers replies for our requests
+            if self.__is_raw_socket and identifier != self.__identifier:
+                continue
+
+            destination, sent_ts = in_flight.get(sequence, (None, 0.0))
+
+            if destination is None or destination != address[0]:
+                continue
+
+            del in_flight[sequence]
+            results[destination]["rtts"].append(round((received_ts - sent_ts) * 1000, 3))
+
+
+def get_path_fingerprint(hops: List[str]) -> str:
+    return hashlib.sha1(",".join(hops).encode("utf-8")).hexdigest()[:16]
+
+
+class PathFingerprintCache(object):
+    """
+    Cache of the last path (fingerprint and hop list) for each destination which is optionally
+    persisted to disk.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.__path = path
+        self.__paths: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.__get_paths().get(key, None)
+
+    def set(self, key: str, fingerprint: str, hops: List[str]) -> None:
+        """
+        Store the path for the provided key and persist the cache to disk (if enabled).
+        """
+        self.__get_paths()[key] = {"fingerprint": fingerprint, "hops": hops}
+        self.__persist()
+
+    def delete(self, key: str) -> None:
+        if self.__get_paths().pop(key, None) is not None:
+            self.__persist()
+
+    def __persist(self) -> None:
+        if not self.__path:
+            return
+
+        tmp_path = self.__path + ".tmp"
+
+        with open(tmp_path, "w") as fp:
+            fp.write(scalyr_util.json_encode(self.__paths))
+
+        os.replace(tmp_path, self.__path)
+
+    def __get_paths(self) -> Dict[str, Dict[str, Any]]:
+        # NOTE: Cache is loaded lazily on first use since _initialize() is also called when
+        # stopping the agent
+        if self.__paths is None:
+            self.__paths = {}
+
+            if self.__path:
+                try:
+                    with open(self.__path, "r") as fp:
+                        self.__paths = scalyr_util.json_decode(fp.read())
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                except ValueError:
+                    # Corrupted cache file, we start with an empty cache
+                    pass
+
+        return self.__paths
+
+
+class TracerouteScheduler(object):
+    """
+    Decides which destinations are due for a traceroute.
+
+    If adaptive scheduling is enabled, interval between traceroutes for each destination is
+    doubled every time the path and total RTT for that destination are stable and reset back to
+    the base interval as soon as they change. Number of probes sent by the traceroutes is also
+    bounded by the probe budget using a token bucket.
+
+    Probe count is only known once the traceroute has completed so the destination is charged
+    the probe count of its previous traceroute when it's scheduled and the difference to the
+    actual probe count once the result is available. Token bucket can go into debt this way in
+    which case no destinations are due until it has been refilled.
+    """
+
+    # Weight of the latest total RTT for the exponentially weighted moving average baseline
+    RTT_BASELINE_WEIGHT = 0.3
+
+    def __init__(
+        self,
+        base_interval: float,
+        sample_interval: Optional[float] = None,
+        adaptive: bool = False,
+        max_backoff_multiplier: int = 8,
+        rtt_deviation_threshold: float = 0.25,
+        probe_budget_per_minute: float = 0,
+    ) -> None:
+        self.__base_interval = base_interval
+        self.__sample_interval = sample_interval or base_interval
+        self.__adaptive = adaptive
+        self.__max_backoff_multiplier = max_backoff_multiplier
+        self.__rtt_deviation_threshold = rtt_deviation_threshold
+        self.__probe_budget_per_minute = probe_budget_per_minute
+
+        # Maps destination to a dictionary with schedule state for that destination
+        self.__states: Dict[str, Dict[str, Any]] = {}
+
+        self.__budget_tokens = max(probe_budget_per_minute, 1)
+        self.__budget_updated_ts: Optional[float] = None
+
+    def get_multiplier(self, key: str) -> int:
+        return self.__get_state(key)["multiplier"]
+
+    def reset(self, key: str) -> None:
+        """
+        Reset schedule for the provided destination so it's due on the next sample.
+        """
+        self.__states.pop(key, None)
+
+    def get_due_targets(
+        self, targets: List["TracerouteTarget"], now: float
+    ) -> List["TracerouteTarget"]:
+        """
+        Return a list of targets which are due for a traceroute, most overdue first.
+        """
+        due_targets = [
+            target
+            for target in targets
+            if self.__get_state(target.destination)["next_run_ts"] <= now
+        ]
+        due_targets.sort(key=lambda target: self.__get_state(target.destination)["next_run_ts"])
+
+        if not self.__probe_budget_per_minute:
+            return due_targets
+
+        # Refill the token bucket
+        if self.__budget_updated_ts is not None:
+            self.__budget_tokens = min(
+                self.__budget_tokens
+                + ((now - self.__budget_updated_ts) * self.__probe_budget_per_minute / 60),
+                max(self.__probe_budget_per_minute, 1),
+            )
+
+        self.__budget_updated_ts = now
+
+        allowed_targets = []
+
+        for target in due_targets:
+            state = self.__get_state(target.destination)
+            estimated_probes_count = state["probes_count"] or 1
+
+            # NOTE: Traceroute which needs more probes than the bucket can hold is allowed once the
+            # bucket is full, otherwise it would never run
+            if self.__budget_tokens < min(
+                estimated_probes_count, max(self.__probe_budget_per_minute, 1)
+            ):
+                break
+
+            self.__budget_tokens -= estimated_probes_count
+            state["charged_probes_count"] = estimated_probes_count
+            allowed_targets.append(target)
+
+        return allowed_targets
+
+    def update(
+        self,
+        key: str,
+        fingerprint: Optional[str],
+        total_rtt: Optional[float],
+        now: float,
+        probes_count: Optional[int] = None,
+    ) -> None:
+        """
+        Update schedule for the provided destination based on the traceroute result (fingerprint,
+        total RTT and probes count are None if the traceroute has failed).
+        """
+        state = self.__get_state(key)
+
+        # Charge the difference between the actual and the estimated probe count
+        if probes_count is not None:
+            if self.__probe_budget_per_minute:
+                self.__budget_tokens -= probes_count - state["charged_probes_count"]
+
+            state["probes_count"] = probes_count
+
+        state["charged_probes_count"] = 0
+
+        # Without adaptive scheduling, destination is due on every sample unless base interval
+        # is longer than the sample interval
+        if not self.__adaptive:
+            if self.__base_interval > self.__sample_interval:
+                state["next_run_ts"] = now + self.__base_interval - (self.__sample_interval / 2)
+            else:
+                state["next_run_ts"] = now
+
+            return
+
+        if fingerprint is None or total_rtt is None:
+            stable = False
+        else:
+            baseline = state["rtt_baseline"]
+            stable = (
+                fingerprint == state["fingerprint"]
+                and baseline is not None
+                and abs(total_rtt - baseline) <= baseline * self.__rtt_deviation_threshold
+            )
+
+            if baseline is None or fingerprint != state["fingerprint"]:
+                state["rtt_baseline"] = total_rtt
+            else:
+                state["rtt_baseline"] = (
+                    (1 - self.RTT_BASELINE_WEIGHT) * baseline
+                    + self.RTT_BASELINE_WEIGHT * total_rtt
+                )
+
+            state["fingerprint"] = fingerprint
+
+        if stable:
+            state["multiplier"] = min(state["multiplier"] * 2, self.__max_backoff_multiplier)
+        else:
+            state["multiplier"] = 1
+
+        # NOTE: We subtract half of the sample interval so the destination is due on the sample
+        # which runs approximately "multiplier" base intervals from now
+        state["next_run_ts"] = (
+            now + (state["multiplier"] * self.__base_interval) - (self.__sample_interval / 2)
+        )
+
+    def __get_state(self, key: str) -> Dict[str, Any]:
+        if key not in self.__states:
+            self.__states[key] = {
+                "next_run_ts": 0,
+                "multiplier": 1,
+                "fingerprint": None,
+                "rtt_baseline": None,
+                "probes_count": None,
+                "charged_probes_count": 0,
+            }
+
+        return self.__states[key]
+
+
+def is_ipv4_address(value: str) -> bool:
+    try:
+        socket.inet_aton(value)
+    except (OSError, ValueError):
+        return False
+
+    return value.count(".") == 3
+
+
+class TracerouteTarget(object):
+    def __init__(self, destination: str, label: Optional[str] = None) -> None:
+        self.destination = destination
+        self.label = label
+
+        # NOTE: Host names are resolved in the background by the DestinationResolver
+        self.destination_ipv4: Optional[str] = (
+            destination if is_ipv4_address(destination) else None
+        )
+
+
+class DestinationResolver(object):
+    """
+    Resolves destination host names to IPv4 addresses in a background thread and refreshes them
+    once the TTL of the DNS record expires.
+
+    TTL is bounded by the minimum and maximum refresh interval. Maximum refresh interval is also
+    used when the TTL can't be retrieved and minimum refresh interval when resolution fails.
+
+    We only support IPv4 so we manually resolve it to IPv4 address otherwise the underlying
+    library may resolve it to IPv6 address and it won't work.
+
+    Resolution results are queued as events which are consumed by the monitor thread.
+    """
+
+    def __init__(
+        self,
+        targets: List[TracerouteTarget],
+        refresh_interval: float,
+        logger,
+        min_refresh_interval: Optional[float] = None,
+    ) -> None:
+        self.__targets = [target for target in targets if not is_ipv4_address(target.destination)]
+        self.__refresh_interval = refresh_interval
+        self.__min_refresh_interval = min(
+            min_refresh_interval or refresh_interval, refresh_interval
+        )
+        self.__logger = logger
+
+        # Maps host name to the time when it needs to be resolved again
+        self.__next_refresh_ts: Dict[str, float] = {}
+
+        self.__lock = threading.Lock()
+        self.__events: List[Dict[str, Any]] = []
+
+        self.__stop_event = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.__thread or not self.__targets:
+            return
+
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(
+            target=self.__run, name="TracerouteDestinationResolver"
+        )
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+
+        if self.__thread:
+            self.__thread.join(1)
+            self.__thread = None
+
+    def get_events(self) -> List[Dict[str, Any]]:
+        """
+        Return and clear all the resolution events since the last call.
+
+        Each event is a dictionary with "target", "resolution_time_ms", "previous_ipv4" and
+        "ipv4" keys.
+        """
+        with self.__lock:
+            events = self.__events
+            self.__events = []
+
+        return events
+
+    def resolve(self, now: float) -> float:
+        """
+        Resolve destination host names which are due for a refresh, update the targets and return
+        the time when the next host name needs to be resolved.
+        """
+        resolved: Dict[str, Tuple[str, float]] = {}
+        failed = set()
+
+        for target in self.__targets:
+            if target.destination in failed:
+                continue
+
+            # NOTE: Multiple targets can use the same host name
+            if (
+                target.destination not in resolved
+                and self.__next_refresh_ts.get(target.destination, 0) > now
+            ):
+                continue
+
+            if target.destination not in resolved:
+                start_ts = time.monotonic()
+
+                try:
+                    ipv4 = socket.gethostbyname(target.destination)
+                except (socket.error, UnicodeError) as e:
+                    # NOTE: We keep using the previously resolved address (if any)
+                    self.__logger.warn(f"Failed to resolve {target.destination}: {e}")
+                    failed.add(target.destination)
+                    self.__next_refresh_ts[target.destination] = now + self.__min_refresh_interval
+                    continue
+
+                resolved[target.destination] = (
+                    ipv4,
+                    round((time.monotonic() - start_ts) * 1000, 3),
+                )
+                self.__next_refresh_ts[target.destination] = now + self.__get_refresh_interval(
+                    get_dns_ttl(target.destination)
+                )
+
+            ipv4, resolution_time_ms = resolved[target.destination]
+            previous_ipv4 = target.destination_ipv4
+            target.destination_ipv4 = ipv4
+
+            with self.__lock:
+                self.__events.append(
+                    {
+                        "target": target,
+                        "resolution_time_ms": resolution_time_ms,
+                        "previous_ipv4": previous_ipv4,
+                        "ipv4": ipv4,
+                    }
+                )
+
+        return min(self.__next_refresh_ts.values())
+
+    def __get_refresh_interval(self, ttl: Optional[int]) -> float:
+        if ttl is None:
+            return self.__refresh_interval
+
+        return min(max(ttl, self.__min_refresh_interval), self.__refresh_interval)
+
+    def __run(self) -> None:
+        while not self.__stop_event.is_set():
+            next_refresh_ts = self.resolve(time.monotonic())
+            self.__stop_event.wait(max(next_refresh_ts - time.monotonic(), 0))
+
+
+class TracerouteWorker(object):
+    """
+    Runs fast-mda-traceroute using the configured executor.
+
+    With "docker_exec" executor, a single long-lived container is started on first use and all
+    the traceroutes are executed inside it using "docker exec". This way we only pay the container
+    start up cost once and not for every traceroute.
+
+    Long-lived container uses a deterministic name so a container which has been left behind by
+    the previous agent process (e.g. agent was killed) is removed when the worker is started.
+
+    To also avoid paying "docker exec" overhead for each destination, traceroutes for multiple
+    destinations can run using a single "docker exec" invocation (see "run_batch()").
+    """
+
+    def __init__(
+        self,
+        executor: str,
+        docker_image: str,
+        binary_path: str,
+        worker_container_name: str = "fast-mda-traceroute-worker",
+    ) -> None:
+        self.__executor = executor
+        self.__docker_image = docker_image
+        self.__binary_path = binary_path
+        self.__worker_container_name = worker_container_name
+
+        self.__container_name: Optional[str] = None
+
+    def start(self) -> None:
+        if self.__executor != "docker_exec" or self.__container_name:
+            return
+
+        container_name = self.__worker_container_name
+
+        # Container from the previous run may still be running if the agent has been killed
+        subprocess.call(
+            ["docker", "rm", "--force", container_name],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
 
-    def __run_traceroute_and_parse_output(self) -> Optional[Dict[str, Any]]:
-        # TODO: Add info on how to configure Docker monitor to exclude fetching log from this
-        # container
-        ts_now = int(time.time())
-        random_value = "".join(random.choice(string.ascii_lowercase) for _ in range(6))
         cmd = [
             "docker",
             "run",
+            "--detach",
             "--rm",
             "--name",
-            f"fast-mda-traceroute-{ts_now}-{random_value}",
-            "ghcr.io/dioptra-io/fast-mda-traceroute",
-            "--format",
-            "scamper-json",
-            "--max-round",
-            "10",
-            "--wait",
-            "3000",
-            self.__destination_ipv4,
+            container_name,
+            "--entrypoint",
+            "sleep",
+            self.__docker_image,
+            "infinity",
         ]
 
+        subprocess.check_output(cmd, stderr=subprocess.PIPE)
+        self.__container_name = container_name
+
+    def stop(self) -> None:
+        if not self.__container_name:
+            return
+
+        subprocess.call(
+            ["docker", "rm", "--force", self.__container_name],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.__container_name = None
+
+    def get_command(
+        self,
+        destination_ipv4: str,
+        timeout: Optional[float] = None,
+        container_name: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Return command which runs traceroute for the provided destination.
+
+        With "docker_exec" executor, traceroute is wrapped with "timeout" inside the container
+        since killing the "docker exec" process doesn't kill the process inside the container.
+        With "docker_run" executor, the container uses the provided name.
+        """
+        if self.__executor == "local":
+            return [self.__binary_path] + TRACEROUTE_ARGS + [destination_ipv4]
+        elif self.__executor == "docker_exec":
+            timeout_cmd = []
+
+            if timeout:
+                timeout_cmd = ["timeout", "-s", "KILL", str(int(math.ceil(timeout)))]
+
+            return (
+                ["docker", "exec", cast(str, self.__container_name)]
+                + timeout_cmd
+                + ["fast-mda-traceroute"]
+                + TRACEROUTE_ARGS
+                + [destination_ipv4]
+            )
+
+        # TODO: Add info on how to configure Docker monitor to exclude fetching log from this
+        # container
+        return (
+            [
+                "docker",
+                "run",
+                "--rm",
+                "--name",
+                container_name or "fast-mda-traceroute-%s" % (_get_random_suffix()),
+                self.__docker_image,
+            ]
+            + TRACEROUTE_ARGS
+            + [destination_ipv4]
+        )
+
+    def get_batch_command(
+        self, destinations_ipv4: List[str], timeout: float, max_parallel: int
+    ) -> List[str]:
+        """
+        Return "docker exec" command which runs traceroutes for all the provided destinations
+        inside the worker container (up to "max_parallel" at once).
+        """
+        traceroute_cmd = [
+            "timeout",
+            "-s",
+            "KILL",
+            str(int(math.ceil(timeout))),
+            "fast-mda-traceroute",
+        ] + TRACEROUTE_ARGS
+        script = BATCH_SCRIPT_TEMPLATE.format(
+            command=" ".join([shlex.quote(arg) for arg in traceroute_cmd]),
+            marker=BATCH_HEADER_MARKER.decode("utf-8"),
+        )
+
+        return (
+            ["docker", "exec", cast(str, self.__container_name), "sh", "-c", script, "sh"]
+            + [str(max_parallel)]
+            + destinations_ipv4
+        )
+
+    def run(
+        self, destination_ipv4: str, timeout: float
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Run traceroute for the provided destination and return (tracelb record, error) tuple.
+
+        Output is parsed incrementally while the process is running.
+        """
+        # NOTE: With "docker_run" executor we need to know the container name so we can kill the
+        # container on timeout
+        container_name = None
+
+        if self.__executor == "docker_run":
+            container_name = "fast-mda-traceroute-%s" % (_get_random_suffix())
+
+        cmd = self.get_command(destination_ipv4, timeout=timeout, container_name=container_name)
+
+        def read_output(stdout: IO[bytes]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+            try:
+                return read_tracelb_record(stdout), None
+            except ValueError as e:
+                return None, "Failed to parse output: %s" % (str(e))
+
         try:
-            output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
-            self._logger.warn(f"Failed to perform traceroute for desination {self.__destination}: {e.stderr}")
-            return None
+            (record, error), returncode, stderr = self.__run_process(
+                cmd, timeout, read_output, container_name=container_name
+            )
+        except OSError as e:
+            return None, str(e)
 
-        result = self.__parse_output(output=output)
-        return result
+        if returncode is None:
+            return None, "Timed out after %s seconds" % (timeout)
+
+        if returncode != 0:
+            return None, stderr.decode("utf-8", "replace")
+
+        if error is not None:
+            return None, error
+
+        if record is None:
+            return None, "Output is missing tracelb record"
+
+        return record, None
+
+    def run_batch(
+        self, destinations_ipv4: List[str], timeout: float, max_parallel: int
+    ) -> Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+        """
+        Run traceroutes for all the provided destinations using a single "docker exec" invocation
+        and return a dictionary which maps destination to (tracelb record, error) tuple.
+
+        Only supported by the "docker_exec" executor. Output is parsed incrementally and split
+        per destination using the header lines printed by the batch script.
+        """
+        if self.__executor != "docker_exec":
+            raise ValueError("Batches are only supported by the docker_exec executor")
+
+        # NOTE: Multiple targets can resolve to the same address
+        destinations_ipv4 = list(dict.fromkeys(destinations_ipv4))
+
+        cmd = self.get_batch_command(destinations_ipv4, timeout, max_parallel)
+
+        # Traceroutes run in batches of up to "max_parallel" destinations inside the container
+        batch_timeout = (
+            timeout * math.ceil(len(destinations_ipv4) / max_parallel) + BATCH_TIMEOUT_GRACE
+        )
+
+        def read_output(stdout: IO[bytes]) -> Dict[str, Dict[str, Any]]:
+            results: Dict[str, Dict[str, Any]] = {}
+            result: Dict[str, Any] = {}
+
+            for line in stdout:
+                if line.startswith(BATCH_HEADER_MARKER):
+                    header = line.decode("utf-8", "replace").split()
+                    result = results.setdefault(
+                        header[2], {"record": None, "error": None, "stderr": b""}
+                    )
+                    result["section"] = header[1]
+
+                    if header[1] == "stdout":
+                        result["returncode"] = int(header[3]) if header[3:] else None
+                elif result.get("section", None) == "stderr":
+                    result["stderr"] += line
+                elif result and result["record"] is None and result["error"] is None:
+                    try:
+                        result["record"] = read_tracelb_record([line])
+                    except ValueError as e:
+                        result["error"] = "Failed to parse output: %s" % (str(e))
+
+            return results
+
+        try:
+            results, returncode, stderr = self.__run_process(cmd, batch_timeout, read_output)
+        except OSError as e:
+            return dict([(destination, (None, str(e))) for destination in destinations_ipv4])
+
+        batch_results: Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]] = {}
+
+        for destination in destinations_ipv4:
+            result = results.get(destination, None)
+
+            if returncode is None:
+                batch_results[destination] = (None, "Timed out after %s seconds" % (batch_timeout))
+            elif result is None:
+                batch_results[destination] = (
+                    None,
+                    stderr.decode("utf-8", "replace") or "Output is missing destination results",
+                )
+            elif result.get("returncode", None) == TIMEOUT_KILLED_EXIT_CODE:
+                batch_results[destination] = (None, "Timed out after %s seconds" % (timeout))
+            elif result.get("returncode", None) != 0:
+                batch_results[destination] = (
+                    None,
+                    result["stderr"].decode("utf-8", "replace").strip(),
+                )
+            elif result["error"] is not None:
+                batch_results[destination] = (None, result["error"])
+            elif result["record"] is None:
+                batch_results[destination] = (None, "Output is missing tracelb record")
+            else:
+                batch_results[destination] = (result["record"], None)
+
+        return batch_results
+
+    def __run_process(
+        self,
+        cmd: List[str],
+        timeout: float,
+        read_output_func: Callable[[IO[bytes]], Any],
+        container_name: Optional[str] = None,
+    ) -> Tuple[Any, Optional[int], bytes]:
+        """
+        Run the provided command and return (value returned by "read_output_func", return code,
+        stderr) tuple.
+
+        "read_output_func" is called with process stdout while the process is running. Process
+        (and container with the provided name) is killed if it doesn't complete in "timeout"
+        seconds in which case return code is None.
+        """
+        # NOTE: stderr is written to a temporary file so the process can't block on a full stderr
+        # pipe while we are reading stdout
+        with tempfile.TemporaryFile() as stderr_fp:
+            # NOTE: Process is started in a new session so we can also kill any child processes
+            # which may otherwise keep stdout open on timeout
+            process = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=stderr_fp, start_new_session=True
+            )
+
+            timed_out = threading.Event()
+
+            def kill_process() -> None:
+                timed_out.set()
+
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+                # Killing docker CLI process doesn't stop the container
+                if container_name:
+                    subprocess.call(
+                        ["docker", "kill", container_name],
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+
+            timer = threading.Timer(timeout, kill_process)
+            timer.start()
+
+            try:
+                stdout = cast(IO[bytes], process.stdout)
+                output = read_output_func(stdout)
+
+                # Drain remaining output (e.g. "cycle-stop" record) so the process can exit
+                for _ in stdout:
+                    pass
+
+                returncode = process.wait()
+            finally:
+                timer.cancel()
+                # NOTE: Make sure the container has been killed before returning on timeout
+                timer.join()
+                cast(IO[bytes], process.stdout).close()
 
-    def __parse_output(self, output: bytes) -> Optional[Dict[str, Any]]:
-        output = output.decode("utf-8")
+            if timed_out.is_set():
+                return output, None, b""
 
-        parsed_data = []
-        for line in output.splitlines():
-            line = line.strip()
+            stderr_fp.seek(0)
+            stderr = stderr_fp.read()
 
-            if not line:
+        # Worker container has died, it will be started again on next sample
+        if (
+            returncode != 0
+            and self.__executor == "docker_exec"
+            and (b"No such container" in stderr or b"is not running" in stderr)
+        ):
+            self.__container_name = None
+
+        return output, returncode, stderr
+
+
+def _get_random_suffix() -> str:
+    ts_now = int(time.time())
+    random_value = "".join(random.choice(string.ascii_lowercase) for _ in range(6))
+    return f"{ts_now}-{random_value}"
+
+
+class TracerouteMonitor(ScalyrMonitor):
+    def _initialize(self) -> None:
+        destination = self._config.get(
+            "destination", convert_to=six.text_type, required_field=False,
+        )
+        label = self._config.get(
+            "label", convert_to=six.text_type, required_field=False,
+        )
+        destinations = self._config.get(
+            "destinations", convert_to=JsonArray, required_field=False, default=JsonArray(),
+        )
+
+        executor = self._config.get(
+            "executor", convert_to=six.text_type, default="docker_run",
+        )
+        docker_image = self._config.get(
+            "docker_image",
+            convert_to=six.text_type,
+            default="ghcr.io/dioptra-io/fast-mda-traceroute",
+        )
+        binary_path = self._config.get(
+            "traceroute_binary_path", convert_to=six.text_type, default="fast-mda-traceroute",
+        )
+        self.__executor_name = executor
+        self.__max_parallel_traceroutes = self._config.get(
+            "max_parallel_traceroutes", convert_to=int, default=8, min_value=1,
+        )
+        self.__traceroute_timeout = self._config.get(
+            "traceroute_timeout", convert_to=float, default=120,
+        )
+
+        self.__path_change_detection = self._config.get(
+            "path_change_detection", convert_to=bool, default=True,
+        )
+        self.__always_include_hop_stats = self._config.get(
+            "always_include_hop_stats", convert_to=bool, default=False,
+        )
+        path_cache_path = self._config.get(
+            "path_cache_path", convert_to=six.text_type, required_field=False,
+        )
+        adaptive_scheduling = self._config.get(
+            "adaptive_scheduling", convert_to=bool, default=False,
+        )
+        max_backoff_multiplier = self._config.get(
+            "max_backoff_multiplier", convert_to=int, default=8, min_value=1,
+        )
+        rtt_deviation_threshold = self._config.get(
+            "rtt_deviation_threshold", convert_to=float, default=0.25,
+        )
+        probe_budget_per_minute = self._config.get(
+            "probe_budget_per_minute", convert_to=float, default=0,
+        )
+        self.__probe_mode = self._config.get(
+            "probe_mode", convert_to=six.text_type, default="traceroute",
+        )
+        traceroute_interval = self._config.get(
+            "traceroute_interval", convert_to=float, required_field=False,
+        )
+        icmp_probe_count = self._config.get(
+            "icmp_probe_count", convert_to=int, default=5, min_value=1,
+        )
+        icmp_probe_interval = self._config.get(
+            "icmp_probe_interval", convert_to=float, default=0.2,
+        )
+        icmp_probe_timeout = self._config.get(
+            "icmp_probe_timeout", convert_to=float, default=2,
+        )
+        dns_refresh_interval = self._config.get(
+            "dns_refresh_interval", convert_to=float, default=300, min_value=1,
+        )
+        dns_min_refresh_interval = self._config.get(
+            "dns_min_refresh_interval", convert_to=float, default=30, min_value=1,
+        )
+
+        if self.__probe_mode not in PROBE_MODES:
+            raise ValueError(
+                "Invalid probe_mode: %s. Valid values are: %s"
+                % (self.__probe_mode, ", ".join(PROBE_MODES))
+            )
+
+        if executor not in EXECUTORS:
+            raise ValueError(
+                "Invalid executor: %s. Valid values are: %s" % (executor, ", ".join(EXECUTORS))
+            )
+
+        self.__path_cache = PathFingerprintCache(path=path_cache_path)
+        self.__scheduler = TracerouteScheduler(
+            base_interval=max(traceroute_interval or 0, self._sample_interval_secs),
+            sample_interval=self._sample_interval_secs,
+            adaptive=adaptive_scheduling,
+            max_backoff_multiplier=max_backoff_multiplier,
+            rtt_deviation_threshold=rtt_deviation_threshold,
+            probe_budget_per_minute=probe_budget_per_minute,
+        )
+
+        self.__targets: List[TracerouteTarget] = []
+
+        if destination:
+            self.__targets.append(TracerouteTarget(destination=destination, label=label))
+
+        for item in destinations:
+            if isinstance(item, six.string_types):
+                self.__targets.append(TracerouteTarget(destination=six.text_type(item)))
                 continue
 
-            item = scalyr_util.json_decode(line)
-            parsed_data.append(item)
+            if not item.get("destination", None):
+                raise ValueError("Each destinations item needs to contain destination")
 
-        if len(parsed_data) == 0:
-            self._logger.warn(f"Parsed data is empty")
-            self._logger.warn(f"Output: {output}")
-            return None
+            item_label = item.get("label", None)
+            self.__targets.append(
+                TracerouteTarget(
+                    destination=six.text_type(item["destination"]),
+                    label=six.text_type(item_label) if item_label else None,
+                )
+            )
 
-        items = [item for item in parsed_data if item["type"] == "tracelb"]
+        if not self.__targets:
+            raise ValueError("Either destination or destinations need to be specified")
 
-        if len(items) != 1:
-            self._logger.warn("Parsed data is missing or having more than one tracelb item")
-            self._logger.warn(f"Output: {output}")
-            return None
+        self.__worker = TracerouteWorker(
+            executor=executor,
+            docker_image=docker_image,
+            binary_path=binary_path,
+            worker_container_name="fast-mda-traceroute-worker-%s" % (self.short_hash),
+        )
+
+        # NOTE: Resolver thread is started on first sample since _initialize() is also called when
+        # stopping the agent
+        self.__resolver = DestinationResolver(
+            targets=self.__targets,
+            refresh_interval=dns_refresh_interval,
+            min_refresh_interval=dns_min_refresh_interval,
+            logger=self._logger,
+        )
+
+        # NOTE: Socket is opened on first sample since _initialize() is also called when stopping
+        # the agent
+        self.__icmp_prober = IcmpProber(
+            count=icmp_probe_count, interval=icmp_probe_interval, timeout=icmp_probe_timeout
+        )
+
+        # NOTE: Thread pool is created lazily on first sample since _initialize() is also called
+        # when stopping the agent
+        self.__executor: Optional[ThreadPoolExecutor] = None
+
+    def stop(self, *args, **kwargs):
+        if self.__executor:
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
+
+        self.__worker.stop()
+        self.__icmp_prober.close()
+        self.__resolver.stop()
+
+        super(TracerouteMonitor, self).stop(*args, **kwargs)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if not self.__executor:
+            self.__executor = ThreadPoolExecutor(
+                max_workers=min(len(self.__targets), self.__max_parallel_traceroutes)
+            )
+
+        return self.__executor
+
+    def gather_sample(self) -> None:
+        self.__resolver.start()
+        self.__handle_resolver_events()
+
+        # Destinations which haven't been resolved yet are skipped
+        targets = [target for target in self.__targets if target.destination_ipv4]
+
+        if not targets:
+            return
+
+        if self.__probe_mode in ["icmp", "icmp_and_traceroute"]:
+            self.__gather_icmp_probe_sample(targets)
 
-        data: Dict[str, Any] = items[0]
+        if self.__probe_mode in ["traceroute", "icmp_and_traceroute"]:
+            self.__gather_traceroute_sample(targets)
 
+    def __handle_resolver_events(self) -> None:
+        for event in self.__resolver.get_events():
+            target = event["target"]
+            extra_fields = {
+                "destination": event["ipv4"],
+                "destination_original": target.destination,
+                "label": target.label or "",
+            }
+
+            self._logger.emit_value(
+                "traceroute.dns.resolution_time_ms",
+                event["resolution_time_ms"],
+                extra_fields=extra_fields,
+            )
+
+            if not event["previous_ipv4"] or event["previous_ipv4"] == event["ipv4"]:
+                continue
+
+            # Destination address has changed which means the path has changed as well. Cached
+            # path and schedule are reset so the next traceroute includes full hop list and runs
+            # on the next sample
+            extra_fields["previous_destination"] = event["previous_ipv4"]
+            extra_fields["reason"] = "destination_changed"
+            self._logger.emit_value("traceroute.path_changed", 1, extra_fields=extra_fields)
+
+            self.__scheduler.reset(target.destination)
+
+            try:
+                self.__path_cache.delete(target.destination)
+            except (IOError, OSError) as e:
+                self._logger.warn(f"Failed to persist path cache: {e}")
+
+    def __gather_icmp_probe_sample(self, targets: List[TracerouteTarget]) -> None:
+        try:
+            results = self.__icmp_prober.probe(
+                list(set([cast(str, target.destination_ipv4) for target in targets]))
+            )
+        except OSError as e:
+            self._logger.warn(f"Failed to send ICMP echo probes: {e}")
+            return
+
+        for target in targets:
+            result = results[cast(str, target.destination_ipv4)]
+            rtts = sorted(result["rtts"])
+
+            extra_fields = {
+                "destination": target.destination_ipv4,
+                "destination_original": target.destination,
+                "label": target.label or "",
+            }
+
+            self._logger.emit_value(
+                "traceroute.probe.loss",
+                round(1 - (len(rtts) / result["sent"]), 3) if result["sent"] else 1.0,
+                extra_fields=extra_fields,
+            )
+
+            if not rtts:
+                continue
+
+            values = [
+                ("min", rtts[0]),
+                ("avg", round(sum(rtts) / len(rtts), 3)),
+            ]
+            values += [
+                ("p%s" % (percentile), get_percentile(rtts, percentile))
+                for percentile in ICMP_PROBE_RTT_PERCENTILES
+            ]
+            values += [("max", rtts[-1])]
+
+            for stat_name, value in values:
+                self._logger.emit_value(
+                    "traceroute.probe.rtt." + stat_name, value, extra_fields=extra_fields
+                )
+
+    def __gather_traceroute_sample(self, targets: List[TracerouteTarget]) -> None:
+        try:
+            self.__worker.start()
+        except subprocess.CalledProcessError as e:
+            self._logger.warn(f"Failed to start traceroute worker container: {e.stderr}")
+            return
+        except OSError as e:
+            self._logger.warn(f"Failed to start traceroute worker container: {e}")
+            return
+
+        targets = self.__scheduler.get_due_targets(targets, time.time())
+
+        if not targets:
+            return
+
+        # NOTE: With "docker_exec" executor, all the traceroutes run using a single "docker exec"
+        # invocation
+        if self.__executor_name == "docker_exec" and len(targets) > 1:
+            results = self.__worker.run_batch(
+                [cast(str, target.destination_ipv4) for target in targets],
+                self.__traceroute_timeout,
+                self.__max_parallel_traceroutes,
+            )
+
+            for target in targets:
+                self.__handle_traceroute_result(
+                    target, *results[cast(str, target.destination_ipv4)]
+                )
+
+            return
+
+        if len(targets) == 1:
+            target = targets[0]
+            self.__handle_traceroute_result(
+                target,
+                *self.__worker.run(cast(str, target.destination_ipv4), self.__traceroute_timeout),
+            )
+            return
+
+        # NOTE: Traceroutes for all the destinations run concurrently and we emit metrics for
+        # each destination as soon as the traceroute for it completes
+        executor = self._get_executor()
+        futures = dict(
+            [
+                (
+                    executor.submit(
+                        self.__worker.run,
+                        cast(str, target.destination_ipv4),
+                        self.__traceroute_timeout,
+                    ),
+                    target,
+                )
+                for target in targets
+            ]
+        )
+
+        for future in as_completed(futures):
+            target = futures[future]
+            self.__handle_traceroute_result(target, *future.result())
+
+    def __handle_traceroute_result(
+        self, target: TracerouteTarget, record: Optional[Dict[str, Any]], error: Optional[str]
+    ) -> None:
+        result = None
+
+        if error is not None or record is None:
+            self._logger.warn(
+                f"Failed to perform traceroute for desination {target.destination}: {error}"
+            )
+        else:
+            result = self.__parse_tracelb_record(data=record)
+
+        if result:
+            self.__emit_traceroute_result(target, result)
+
+        self.__scheduler.update(
+            target.destination,
+            fingerprint=result["path_fingerprint"] if result else None,
+            total_rtt=result["total_rtt"] if result else None,
+            now=time.time(),
+            probes_count=result["probes_count"] if result else None,
+        )
+
+    def __emit_traceroute_result(self, target: TracerouteTarget, result: Dict[str, Any]) -> None:
+        hops_stats = result["hops_stats"]
+
+        extra_fields = {
+            "destination": result["destination"],
+            "destination_original": target.destination,
+            "label": target.label or "",
+            "total_rtt": result["total_rtt"],
+            "method": result["method"]
+        }
+
+        # Per hop values are only included together with the full hop list unless configured
+        # otherwise
+        hop_stats_fields = {
+            "hop_rtts": format_hop_values(hops_stats, "avg"),
+            "hop_rtts_min": format_hop_values(hops_stats, "min"),
+            "hop_rtts_max": format_hop_values(hops_stats, "max"),
+            "hop_rtts_stddev": format_hop_values(hops_stats, "stddev"),
+            "hop_loss": format_hop_values(hops_stats, "loss"),
+        }
+
+        if self.__always_include_hop_stats:
+            extra_fields.update(hop_stats_fields)
+
+        if not self.__path_change_detection:
+            extra_fields["hops"] = ",".join(result["hops"])
+            extra_fields.update(hop_stats_fields)
+            self._logger.emit_value(
+                "traceroute.hops", result["hops_count"], extra_fields=extra_fields
+            )
+            return
+
+        fingerprint = result["path_fingerprint"]
+        extra_fields["path_fingerprint"] = fingerprint
+
+        try:
+            previous_path = self.__path_cache.get(target.destination)
+        except (IOError, OSError) as e:
+            self._logger.warn(f"Failed to load path cache: {e}")
+            previous_path = None
+
+        if previous_path and previous_path["fingerprint"] == fingerprint:
+            # Path hasn't changed, emit compact sample
+            self._logger.emit_value(
+                "traceroute.hops", result["hops_count"], extra_fields=extra_fields
+            )
+            return
+
+        extra_fields["hops"] = ",".join(result["hops"])
+        extra_fields.update(hop_stats_fields)
+        self._logger.emit_value("traceroute.hops", result["hops_count"], extra_fields=extra_fields)
+
+        if previous_path:
+            self._logger.emit_value(
+                "traceroute.path_changed",
+                1,
+                extra_fields={
+                    "destination": result["destination"],
+                    "destination_original": target.destination,
+                    "label": target.label or "",
+                    "path_fingerprint": fingerprint,
+                    "previous_path_fingerprint": previous_path["fingerprint"],
+                    "hops": ",".join(result["hops"]),
+                    "previous_hops": ",".join(previous_path["hops"]),
+                    "reason": "hops_changed",
+                },
+            )
+
+        try:
+            self.__path_cache.set(target.destination, fingerprint, result["hops"])
+        except (IOError, OSError) as e:
+            self._logger.warn(f"Failed to persist path cache: {e}")
+
+    def __parse_tracelb_record(self, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         hops = []
-        hop_rtts = []
+        hops_stats = []
 
         if not data.get("nodes", None):
             self._logger.warn("Parsed data is missing nodes key (wait argument may be too low)")
-            self._logger.warn(f"Output: {output}")
+            self._logger.warn(f"Record: {data}")
             return None
 
-        # Parse RTTs from the result
-        for node in data["nodes"]:
-            hop = node["addr"]
-            hop = node["links"][-1][-1]["addr"]
+        for hop, stats in get_path_hop_stats(data["nodes"]):
             hops.append(hop)
-            # NOTE: We only use the last packet
-            try:
-                node_rtt = node["links"][-1][-1]["probes"][-1]["replies"][-1]["rtt"]
-            except KeyError:
-                continue
-                #self._logger.warn(f"Failed to parse node links", exc_info=True)
-                #self._logger.warn(f"Output: {node['links'][-1][-1]}")
-                continue
-
-            hop_rtts.append(node_rtt)
+            hops_stats.append(stats)
 
         result = {
             "destination": data["dst"],
-            "hops_count": data["nodec"],
+            # Based on the deduplicated hops since "nodec" doesn't match the number of hops (link
+            # targets) on multi path routes
+            "hops_count": len(hops),
             "method": data["method"],
-            "hop_rtts": hop_rtts,
+            "hops_stats": hops_stats,
             "hops": hops,
+            "path_fingerprint": get_path_fingerprint(hops),
+            "probes_count": get_probes_count(data),
+            "total_rtt": round(
+                sum([stats["avg"] for stats in hops_stats if stats and "avg" in stats]), 2
+            ),
         }
         return result
@@ -0,0 +1,143 @@
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark which compares different RaspberryPiMetricsMonitor collection modes using mock vcgencmd
+binary, mock sysfs files and simulated VideoCore mailbox device.
+
+Mailbox device is simulated (tests/unit/utils/mailbox_stub.py) by replacing fcntl.ioctl with a
+function which answers "get gencmd result" property requests using the same output as the mock
+vcgencmd binary. On a real device the commands are executed by the VideoCore firmware (same as
+when running vcgencmd) so the reported CPU time only includes the agent side cost which is what
+differs between the collection modes.
+
+Usage:
+
+    python tests/benchmarks/benchmark_raspberry_pi_monitor.py [iterations]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+import mock
+
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(BASE_DIR, "../fixtures")
+
+sys.path.insert(0, os.path.join(BASE_DIR, "../../"))
+
+from custom_monitors.raspberry_pi_monitor import RaspberryPiMetricsMonitor  # NOQA
+
+# NOTE: Mailbox device is simulated using the same helper as the unit tests
+sys.path.insert(0, os.path.join(BASE_DIR, "../unit"))
+
+from utils.mailbox_stub import MockMailbox  # NOQA
+
+
+def get_cpu_time():
+    # type: () -> float
+    """
+    Return CPU time (user + system) used by this process and all the child processes.
+    """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return (
+        usage_self.ru_utime
+        + usage_self.ru_stime
+        + usage_children.ru_utime
+        + usage_children.ru_stime
+    )
+
+
+def run_benchmark(monitor_config, iterations):
+    mock_logger = mock.Mock()
+    monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+
+    # Warm up run so we don't include one-off costs such as opening the device files
+    monitor.gather_sample()
+
+    start_time = time.time()
+    start_cpu_time = get_cpu_time()
+
+    for _ in range(0, iterations):
+        monitor.gather_sample()
+
+    duration = time.time() - start_time
+
+    monitor.stop(wait_on_join=False)
+    cpu_time = get_cpu_time() - start_cpu_time
+
+    assert mock_logger.warn.call_count == 0
+
+    return duration, cpu_time
+
+
+def main(iterations=50):
+    vcgencmd_path = os.path.join(FIXTURES_DIR, "mock_vcgencmd")
+
+    print("Running %s iterations for each collection mode" % (iterations))
+    print("")
+
+    sysfs_root = os.path.join(FIXTURES_DIR, "sysfs")
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        # Any file which can be opened for reading and writing works with the simulated mailbox
+        vcio_path = os.path.join(tmp_dir, "vcio")
+        open(vcio_path, "w").close()
+
+        for name, collection_mode, use_file_sources in [
+            ("per_metric", "per_metric", False),
+            ("per_metric+sysfs", "per_metric", True),
+            ("mailbox", "mailbox", False),
+            ("mailbox+sysfs", "mailbox", True),
+        ]:
+            monitor_config = {
+                "module": "raspberry_pi_monitor",
+                "vcgencmd_path": vcgencmd_path,
+                "collection_mode": collection_mode,
+                "vcio_path": vcio_path,
+                "use_file_sources": use_file_sources,
+                "sysfs_root": sysfs_root,
+            }
+
+            with mock.patch(
+                "custom_monitors.raspberry_pi_monitor.fcntl.ioctl", MockMailbox().ioctl
+            ):
+                duration, cpu_time = run_benchmark(
+                    monitor_config=monitor_config, iterations=iterations
+                )
+
+            print(
+                "%-16s wall time per sample: %7.2f ms, cpu time per sample: %7.2f ms"
+                % (
+                    name,
+                    (duration / iterations) * 1000,
+                    (cpu_time / iterations) * 1000,
+                )
+            )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(iterations=int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,121 @@
+# Copyright 2023 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark which measures TibberPulselectricityConsumptionMonitor start up time with and without
+the home metadata cache.
+
+Tibber API is stubbed locally using a fake "tibber" module (tests/unit/utils/tibber_stub.py) which
+simulates API latency so the benchmark doesn't need network access or Tibber account.
+
+Usage:
+
+    python tests/benchmarks/benchmark_tibber_pulse_monitor_startup.py [iterations]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import mock
+
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(BASE_DIR, "../../"))
+
+# NOTE: Tibber API is stubbed using the same stub module as the unit tests
+sys.path.insert(0, os.path.join(BASE_DIR, "../unit"))
+
+from utils import tibber_stub  # NOQA
+
+sys.modules.update(tibber_stub.get_stub_modules())
+
+from custom_monitors.tibber_pulse_monitor import (  # NOQA
+    TibberPulselectricityConsumptionMonitor,
+)
+
+
+def run_benchmark(monitor_config):
+    mock_logger = mock.Mock()
+
+    start_time = time.time()
+
+    monitor = TibberPulselectricityConsumptionMonitor(monitor_config, mock_logger)
+    monitor._run_state = mock.Mock()
+    monitor._run_state.is_running.return_value = True
+    monitor.gather_sample()
+
+    startup_duration = time.time() - start_time
+
+    # Wait for the first live measurement to be handed off to the monitor thread
+    while monitor._queue.empty():
+        time.sleep(0.001)
+
+    first_measurement_duration = time.time() - start_time
+
+    monitor.stop(wait_on_join=False)
+
+    return startup_duration, first_measurement_duration
+
+
+def main(iterations=5):
+    print("Running %s iterations for each start up mode" % (iterations))
+    print("Simulated account discovery API latency: %s ms" % (int(tibber_stub.API_LATENCY * 1000)))
+    print("")
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        metadata_cache_path = os.path.join(tmp_dir, "tibber_metadata.json")
+
+        for name, use_metadata_cache in [("cold", False), ("cached", True)]:
+            monitor_config = {
+                "module": "custom_monitors.tibber_pulse_monitor",
+                "access_token": "token",
+                "sample_write_interval": 30,
+            }
+
+            if use_metadata_cache:
+                monitor_config["metadata_cache_path"] = metadata_cache_path
+
+                # Populate the cache
+                run_benchmark(monitor_config=monitor_config)
+
+            startup_total, first_measurement_total = 0.0, 0.0
+
+            for _ in range(0, iterations):
+                startup_duration, first_measurement_duration = run_benchmark(
+                    monitor_config=monitor_config
+                )
+                startup_total += startup_duration
+                first_measurement_total += first_measurement_duration
+
+            print(
+                "%-7s start up time: %7.2f ms, time to first measurement: %7.2f ms"
+                % (
+                    name,
+                    (startup_total / iterations) * 1000,
+                    (first_measurement_total / iterations) * 1000,
+                )
+            )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(iterations=int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,256 @@
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import mock
+
+from scalyr_agent import ScalyrMonitor
+from scalyr_agent.test_base import ScalyrTestCase
+from scalyr_agent.test_base import ScalyrMockHttpServerTestCase
+
+from custom_monitors.http_polling_monitor import CircuitBreaker
+from custom_monitors.http_polling_monitor import HTTPPollingMonitorMixin
+from custom_monitors.http_polling_monitor import HTTPPollingTarget
+from custom_monitors.http_polling_monitor import get_backoff_delay
+
+FLAKY_VIEW_CALL_COUNT = [0]
+
+
+def mock_flaky_view_func():
+    # First request fails with a server error and the retry succeeds
+    FLAKY_VIEW_CALL_COUNT[0] += 1
+
+    if FLAKY_VIEW_CALL_COUNT[0] % 2 == 1:
+        return ("", 503, {})
+
+    return "ok"
+
+
+def mock_not_found_view_func():
+    return ("", 404, {})
+
+
+class MockHTTPPollingMonitor(HTTPPollingMonitorMixin, ScalyrMonitor):
+    metric_prefix = "mock"
+
+    def _initialize(self):
+        self._initialize_http_polling()
+        self._set_targets(
+            [HTTPPollingTarget(base_url=self._config.get("base_url"))],
+            default_extra_field="instance",
+        )
+        self.results = []
+
+    def _get_jobs(self):
+        return [(target, self._fetch_data, (), self._handle_data) for target in self._targets]
+
+    def _fetch_data(self, target):
+        return self._request(target, "/api")
+
+    def _handle_data(self, target, result):
+        resp, error = result
+        self.results.append(error if resp is None else resp.status_code)
+
+
+class MockMultiTargetHTTPPollingMonitor(MockHTTPPollingMonitor):
+    def _initialize(self):
+        self._initialize_http_polling()
+        self._set_targets(
+            [HTTPPollingTarget(base_url=base_url) for base_url in self._config.get("base_urls")],
+            default_extra_field="instance",
+        )
+        self.results = []
+
+    def _handle_data(self, target, result):
+        if "broken" in target.base_url:
+            raise ValueError("Failed to parse response")
+
+        super(MockMultiTargetHTTPPollingMonitor, self)._handle_data(target, result)
+
+
+class HTTPPollingMonitorTestCase(ScalyrMockHttpServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(HTTPPollingMonitorTestCase, cls).setUpClass()
+
+        cls.mock_http_server_thread.app.add_url_rule("/flaky/api", view_func=mock_flaky_view_func)
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/not_found/api", view_func=mock_not_found_view_func
+        )
+
+        cls.base_url = "http://%s:%s/" % (
+            cls.mock_http_server_thread.host,
+            cls.mock_http_server_thread.port,
+        )
+
+    def test_request_is_retried_on_server_error(self):
+        FLAKY_VIEW_CALL_COUNT[0] = 0
+
+        monitor_config = {
+            "module": "http_polling_monitor",
+            "base_url": self.base_url + "flaky/",
+            "retry_backoff": 0.01,
+            "emit_request_metrics": True,
+        }
+        mock_logger = mock.Mock()
+        monitor = MockHTTPPollingMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(monitor.results, [200])
+        self.assertEqual(mock_logger.warn.call_count, 0)
+
+        emitted_values = dict(
+            [(call_args[0][0], call_args[0][1]) for call_args in mock_logger.emit_value.call_args_list]
+        )
+        self.assertEqual(emitted_values["mock.http.request.errors"], 1)
+        self.assertTrue(emitted_values["mock.http.request.latency_ms"] >= 0)
+
+    def test_retry_backoff_is_interrupted_on_stop(self):
+        FLAKY_VIEW_CALL_COUNT[0] = 0
+
+        monitor_config = {
+            "module": "http_polling_monitor",
+            "base_url": self.base_url + "flaky/",
+            "retry_backoff": 60,
+        }
+        mock_logger = mock.Mock()
+        monitor = MockHTTPPollingMonitor(monitor_config, mock_logger)
+        monitor._run_state.stop()
+
+        start_ts = time.time()
+        monitor.gather_sample()
+        duration = time.time() - start_ts
+        monitor.stop(wait_on_join=False)
+
+        # Monitor has been stopped so the request is not retried
+        self.assertTrue(duration < 5, "Sample took %s seconds" % (duration))
+        self.assertEqual(monitor.results, [503])
+
+    def test_client_errors_are_not_retried(self):
+        monitor_config = {
+            "module": "http_polling_monitor",
+            "base_url": self.base_url + "not_found/",
+            "circuit_breaker_threshold": 1,
+        }
+        mock_logger = mock.Mock()
+        monitor = MockHTTPPollingMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        # Target is reachable so the circuit breaker stays closed
+        self.assertEqual(monitor.results, [404, 404])
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+    def test_circuit_breaker_skips_dead_target(self):
+        monitor_config = {
+            "module": "http_polling_monitor",
+            # Nothing is listening on this port
+            "base_url": "http://127.0.0.1:1/",
+            "connect_timeout": 0.5,
+            "max_retries": 0,
+            "circuit_breaker_threshold": 2,
+            "circuit_breaker_cooldown": 60,
+        }
+        mock_logger = mock.Mock()
+        monitor = MockHTTPPollingMonitor(monitor_config, mock_logger)
+
+        for _ in range(0, 4):
+            monitor.gather_sample()
+
+        monitor.stop(wait_on_join=False)
+
+        # Circuit breaker opened after the second failure so the target isn't polled anymore
+        self.assertEqual(len(monitor.results), 2)
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("not polling it" in mock_logger.warn.call_args_list[0][0][0])
+
+    def test_handler_error_doesnt_affect_other_targets(self):
+        monitor_config = {
+            "module": "http_polling_monitor",
+            "base_urls": [
+                self.base_url + "not_found/",
+                self.base_url + "not_found/?broken",
+                self.base_url + "not_found/?other",
+            ],
+            "emit_request_metrics": True,
+        }
+        mock_logger = mock.Mock()
+        monitor = MockMultiTargetHTTPPollingMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        # Results for other targets are still handled and request stats for all the targets are
+        # emitted
+        self.assertEqual(monitor.results, [404, 404])
+        self.assertEqual(mock_logger.exception.call_count, 1)
+        self.assertTrue("not_found/?broken" in mock_logger.exception.call_args_list[0][0][0])
+
+        emitted_metric_names = [
+            call_args[0][0] for call_args in mock_logger.emit_value.call_args_list
+        ]
+        self.assertEqual(emitted_metric_names.count("mock.http.request.latency_ms"), 3)
+
+    def test_get_jobs_is_required(self):
+        class IncompleteHTTPPollingMonitor(HTTPPollingMonitorMixin, ScalyrMonitor):
+            def _initialize(self):
+                pass
+
+        self.assertRaises(
+            TypeError,
+            IncompleteHTTPPollingMonitor,
+            {"module": "http_polling_monitor"},
+            mock.Mock(),
+        )
+
+
+class CircuitBreakerTestCase(ScalyrTestCase):
+    def test_get_backoff_delay(self):
+        for attempt, expected_delay in [(0, 1), (1, 2), (2, 4), (10, 30)]:
+            delay = get_backoff_delay(attempt, 1, 30)
+            self.assertTrue(expected_delay / 2.0 <= delay <= expected_delay)
+
+    def test_circuit_breaker(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=2, cooldown=10, max_cooldown=100)
+
+        self.assertEqual(circuit_breaker.record_failure(1000), None)
+        self.assertTrue(circuit_breaker.allow_request(1000))
+
+        cooldown = circuit_breaker.record_failure(1000)
+        self.assertTrue(5 <= cooldown <= 10)
+        self.assertFalse(circuit_breaker.allow_request(1001))
+        self.assertTrue(circuit_breaker.allow_request(1010))
+
+        # Target is still down so the cool down period is longer
+        cooldown = circuit_breaker.record_failure(1010)
+        self.assertTrue(10 <= cooldown <= 20)
+        self.assertFalse(circuit_breaker.allow_request(1015))
+
+        circuit_breaker.record_success()
+        self.assertTrue(circuit_breaker.allow_request(1015))
+        self.assertEqual(circuit_breaker.record_failure(1015), None)
+
+    def test_circuit_breaker_disabled(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=0, cooldown=10, max_cooldown=100)
+
+        for _ in range(0, 10):
+            self.assertEqual(circuit_breaker.record_failure(1000), None)
+
+        self.assertTrue(circuit_breaker.allow_request(1000))
@@ -0,0 +1,30 @@
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from scalyr_agent.test_base import ScalyrTestCase
+
+from custom_monitors.monitor_utils import get_percentile
+
+
+class MonitorUtilsTestCase(ScalyrTestCase):
+    def test_get_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(get_percentile(values, 50), 50)
+        self.assertEqual(get_percentile(values, 95), 95)
+        self.assertEqual(get_percentile(values, 99), 99)
+        self.assertEqual(get_percentile(values, 100), 100)
+        self.assertEqual(get_percentile(values, 0), 1)
+        self.assertEqual(get_percentile([1.5], 95), 1.5)
+        self.assertEqual(get_percentile([1, 2, 3, 4], 50), 2)
@@ -13,13 +13,21 @@
 # limitations under the License.
 
 import os
+import json
+import time
+import threading
 
 import mock
+import requests
 from flask import request
+from flask import Response
 
+from scalyr_agent.test_base import ScalyrTestCase
 from scalyr_agent.test_base import ScalyrMockHttpServerTestCase
 
 from custom_monitors.octoprint_monitor import OctoPrintMonitor
+from custom_monitors.octoprint_monitor import OctoPrintPushClient
+from custom_monitors.octoprint_monitor import OctoPrintTarget
 
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
 FIXTURES_DIR = os.path.join(BASE_DIR, "../fixtures/octoprint")
@@ -27,6 +35,12 @@ FIXTURES_DIR = os.path.join(BASE_DIR, "../fixtures/octoprint")
 with open(os.path.join(FIXTURES_DIR, "api_printer.json")) as fp:
     MOCK_200_RESPONSE = fp.read()
 
+with open(os.path.join(FIXTURES_DIR, "api_job.json")) as fp:
+    MOCK_JOB_200_RESPONSE = fp.read()
+
+# Query params for the last /api/printer request
+PRINTER_REQUEST_ARGS = {}
+
 
 EXPECTED_VALUES = [
     ("state", "Printing", {'cancelling': 'False', 'closedOrError': 'False', 'error': 'False', 'finishing': 'False', 'operational': 'True', 'paused': 'False', 'pausing': 'False', 'printing': 'True', 'ready': 'False', 'resuming': 'False', 'sdReady': 'False'}),
@@ -39,6 +53,8 @@ EXPECTED_VALUES = [
 
 def mock_invalid_auth_view_func():
     headers = dict(request.headers)
+    PRINTER_REQUEST_ARGS.clear()
+    PRINTER_REQUEST_ARGS.update(request.args)
 
     if request.headers["X-Api-Key"] == "valid":
         return MOCK_200_RESPONSE
@@ -46,6 +62,77 @@ def mock_invalid_auth_view_func():
     return ("", 401, {})
 
 
+def mock_job_view_func():
+    if request.headers["X-Api-Key"] == "valid":
+        return MOCK_JOB_200_RESPONSE
+
+    return ("", 401, {})
+
+
+def mock_slow_view_func():
+    time.sleep(1)
+    return mock_invalid_auth_view_func()
+
+
+# Mock OctoPrint push API (SockJS xhr_streaming transport)
+PUSH_AUTH_MESSAGES = []
+PUSH_AUTHENTICATED_EVENT = threading.Event()
+PUSH_MESSAGES_SENT_EVENT = threading.Event()
+
+PUSH_STATE = {
+    "text": "Printing",
+    "flags": {"operational": True, "printing": True, "error": False},
+}
+PUSH_MESSAGES = [
+    {"connected": {"version": "1.5.2"}},
+    {"current": {"state": PUSH_STATE, "temps": [
+        {"time": 1609520331, "bed": {"actual": 59.0, "target": 60.0},
+         "tool0": {"actual": 205.0, "target": 210.0}},
+    ]}},
+    {"current": {"state": PUSH_STATE, "temps": [
+        {"time": 1609520332, "bed": {"actual": 60.5, "target": 60.0},
+         "tool0": {"actual": 210.0, "target": 210.0}},
+        {"time": 1609520333, "bed": {"actual": 61.0, "target": 60.0},
+         "tool0": {"actual": 212.0, "target": 215.0}},
+    ]}},
+]
+
+
+def mock_login_view_func():
+    if request.headers["X-Api-Key"] != "valid" or not request.get_json()["passive"]:
+        return ("", 403, {})
+
+    return json.dumps({"name": "user", "session": "session1"})
+
+
+def mock_xhr_streaming_view_func(server_id, session_id):
+    def generate():
+        yield "h" * 2048 + "\n"
+        yield "o\n"
+
+        if not PUSH_AUTHENTICATED_EVENT.wait(5):
+            return
+
+        for message in PUSH_MESSAGES:
+            yield "a" + json.dumps([json.dumps(message)]) + "\n"
+
+        PUSH_MESSAGES_SENT_EVENT.set()
+
+        for _ in range(0, 50):
+            time.sleep(0.1)
+            yield "h\n"
+
+    return Response(generate(), mimetype="application/javascript")
+
+
+def mock_xhr_send_view_func(server_id, session_id):
+    for message in json.loads(request.get_data()):
+        PUSH_AUTH_MESSAGES.append(json.loads(message))
+
+    PUSH_AUTHENTICATED_EVENT.set()
+    return ("", 204, {})
+
+
 class OctoPrintMonitorTestCase(ScalyrMockHttpServerTestCase):
     @classmethod
     def setUpClass(cls):
@@ -55,6 +142,23 @@ class OctoPrintMonitorTestCase(ScalyrMockHttpServerTestCase):
         cls.mock_http_server_thread.app.add_url_rule(
             "/api/printer", view_func=mock_invalid_auth_view_func
         )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/slow/api/printer", view_func=mock_slow_view_func
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/api/job", view_func=mock_job_view_func
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/api/login", view_func=mock_login_view_func, methods=["POST"]
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/sockjs/<server_id>/<session_id>/xhr_streaming",
+            view_func=mock_xhr_streaming_view_func, methods=["POST"]
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/sockjs/<server_id>/<session_id>/xhr_send",
+            view_func=mock_xhr_send_view_func, methods=["POST"]
+        )
 
         cls.base_url = "http://%s:%s/" % (
             cls.mock_http_server_thread.host,
@@ -102,3 +206,253 @@ class OctoPrintMonitorTestCase(ScalyrMockHttpServerTestCase):
             self.assertEqual(expected_metric_value, actual_metric_value)
             self.assertEqual(expected_extra_fields, actual_extra_fields)
             index += 1
+
+    def test_gather_sample_session_is_reused(self):
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "base_url": self.base_url,
+            "api_key": "valid"
+        }
+        mock_logger = mock.Mock()
+        monitor = OctoPrintMonitor(monitor_config, mock_logger)
+
+        with mock.patch("requests.Session", wraps=requests.Session) as mock_session_cls:
+            monitor.gather_sample()
+            monitor.gather_sample()
+
+        self.assertEqual(mock_session_cls.call_count, 1)
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 10)
+        monitor.stop(wait_on_join=False)
+
+    def test_gather_sample_read_timeout(self):
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "base_url": self.base_url + "slow/",
+            "api_key": "valid",
+            "read_timeout": 0.2,
+        }
+        mock_logger = mock.Mock()
+        monitor = OctoPrintMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("timed out" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+    def test_gather_sample_printer_exclude(self):
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "base_url": self.base_url,
+            "api_key": "valid",
+        }
+        monitor = OctoPrintMonitor(monitor_config, mock.Mock())
+        monitor.gather_sample()
+        self.assertEqual(PRINTER_REQUEST_ARGS, {"exclude": "sd"})
+
+        monitor_config["printer_exclude"] = "sd,state"
+        monitor = OctoPrintMonitor(monitor_config, mock.Mock())
+        monitor.gather_sample()
+        self.assertEqual(PRINTER_REQUEST_ARGS, {"exclude": "sd,state"})
+
+    def test_gather_sample_collect_job_data(self):
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "base_url": self.base_url,
+            "api_key": "valid",
+            "collect_job_data": True,
+        }
+        mock_logger = mock.Mock()
+        monitor = OctoPrintMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 10)
+
+        emitted_values = dict(
+            [
+                ((call_args[0][0], call_args[1]["extra_fields"].get("tool", None)), call_args[0][1])
+                for call_args in mock_logger.emit_value.call_args_list
+            ]
+        )
+        self.assertEqual(emitted_values[("octoprint.job.completion", None)], 22.98)
+        self.assertEqual(emitted_values[("octoprint.job.print_time", None)], 2760)
+        self.assertEqual(emitted_values[("octoprint.job.print_time_left", None)], 6120)
+        self.assertEqual(emitted_values[("octoprint.job.filament.length", "tool0")], 810.5)
+        self.assertEqual(emitted_values[("octoprint.job.filament.volume", "tool0")], 5.36)
+        self.assertEqual(emitted_values[("octoprint.bed.temperature.actual", None)], 59.97)
+
+    def test_gather_sample_multiple_targets(self):
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "targets": [
+                {"base_url": self.base_url, "api_key": "valid",
+                 "extra_fields": {"printer": "printer1"}},
+                {"base_url": self.base_url + "slow/", "api_key": "valid",
+                 "extra_fields": {"printer": "printer2"}},
+                {"base_url": self.base_url + "slow/", "api_key": "valid", "timeout": 0.2,
+                 "extra_fields": {"printer": "printer3"}},
+                {"base_url": self.base_url, "api_key": "invalid"},
+            ]
+        }
+        mock_logger = mock.Mock()
+        monitor = OctoPrintMonitor(monitor_config, mock_logger)
+
+        start_ts = time.time()
+        monitor.gather_sample()
+        duration = time.time() - start_ts
+        monitor.stop(wait_on_join=False)
+
+        # Targets are polled concurrently so the duration is bounded by the slowest target
+        self.assertTrue(duration < 1.8, "Sample took %s seconds" % (duration))
+
+        # printer3 timed out and the last target uses invalid API key
+        self.assertEqual(mock_logger.warn.call_count, 2)
+        self.assertEqual(mock_logger.emit_value.call_count, 10)
+
+        printers = set()
+        for call_args in mock_logger.emit_value.call_args_list:
+            extra_fields = call_args[1]["extra_fields"]
+            printers.add(extra_fields["printer"])
+
+            if call_args[0][0] == "octoprint.tool.temperature.actual":
+                self.assertEqual(extra_fields["tool"], "tool0")
+
+        self.assertEqual(printers, set(["printer1", "printer2"]))
+
+    def test_invalid_config(self):
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "base_url": self.base_url,
+        }
+
+        with self.assertRaises(ValueError):
+            OctoPrintMonitor(monitor_config, mock.Mock())
+
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "targets": [{"base_url": self.base_url}],
+        }
+
+        with self.assertRaises(ValueError):
+            OctoPrintMonitor(monitor_config, mock.Mock())
+
+    def test_gather_sample_push_collection_mode(self):
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "base_url": self.base_url,
+            "api_key": "valid",
+            "collection_mode": "push",
+        }
+        mock_logger = mock.Mock()
+        monitor = OctoPrintMonitor(monitor_config, mock_logger)
+        self.addCleanup(monitor.stop, wait_on_join=False)
+
+        # First sample starts the push client
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+        self.assertTrue(PUSH_MESSAGES_SENT_EVENT.wait(5))
+        self.assertEqual(PUSH_AUTH_MESSAGES, [{"auth": "user:session1"}])
+        time.sleep(0.2)
+
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.warn.call_count, 0)
+
+        emitted_values = dict(
+            [
+                ((call_args[0][0], call_args[1]["extra_fields"].get("tool", None)), call_args[0][1])
+                for call_args in mock_logger.emit_value.call_args_list
+            ]
+        )
+        self.assertEqual(emitted_values, {
+            ("state", None): "Printing",
+            ("octoprint.bed.temperature.actual", None): 60.17,
+            ("octoprint.bed.temperature.actual.min", None): 59.0,
+            ("octoprint.bed.temperature.actual.max", None): 61.0,
+            ("octoprint.bed.temperature.target", None): 60.0,
+            ("octoprint.tool.temperature.actual", "tool0"): 209.0,
+            ("octoprint.tool.temperature.actual.min", "tool0"): 205.0,
+            ("octoprint.tool.temperature.actual.max", "tool0"): 212.0,
+            ("octoprint.tool.temperature.target", "tool0"): 215.0,
+        })
+        self.assertEqual(mock_logger.emit_value.call_args_list[0][1]["extra_fields"],
+                         {"operational": "True", "printing": "True", "error": "False"})
+
+        # Values are reset after each sample
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+    @mock.patch("custom_monitors.octoprint_monitor.PUSH_STOP_TIMEOUT", 0.5)
+    def test_stop_push_clients_uses_single_deadline(self):
+        monitor_config = {
+            "module": "octoprint_monitor",
+            "base_url": self.base_url,
+            "api_key": "valid",
+            "collection_mode": "push",
+        }
+        monitor = OctoPrintMonitor(monitor_config, mock.Mock())
+
+        # Push client threads which don't finish in time
+        calls = []
+
+        def get_push_client(index):
+            push_client = mock.Mock()
+            push_client.stop.side_effect = lambda: calls.append(("stop", index))
+
+            def join(timeout):
+                calls.append(("join", index))
+                time.sleep(max(timeout, 0))
+
+            push_client.join.side_effect = join
+            return push_client
+
+        monitor._OctoPrintMonitor__push_clients = [get_push_client(index) for index in range(3)]
+
+        start_ts = time.time()
+        monitor.stop(wait_on_join=False)
+        duration = time.time() - start_ts
+
+        # All the clients are signalled to stop before we wait for any of them
+        self.assertEqual(
+            calls,
+            [("stop", 0), ("stop", 1), ("stop", 2), ("join", 0), ("join", 1), ("join", 2)],
+        )
+        self.assertTrue(duration < 1.0, "Stop took %s seconds" % (duration))
+
+
+class OctoPrintPushClientTestCase(ScalyrTestCase):
+    def test_reconnect_back_off(self):
+        client = OctoPrintPushClient(
+            target=OctoPrintTarget(base_url="http://printer1", api_key="key1"),
+            session=mock.Mock(),
+            connect_timeout=1,
+            logger=mock.Mock(),
+        )
+
+        def consume():
+            # Stream is closed by the server without any messages twice, then we receive a
+            # message before the stream is closed and then the connection fails
+            if mock_consume.call_count == 3:
+                client.handle_message({"connected": {"version": "1.5.2"}})
+            elif mock_consume.call_count == 4:
+                raise Exception("failed")
+
+        mock_consume = mock.Mock(side_effect=consume)
+        client._OctoPrintPushClient__consume = mock_consume
+
+        mock_stop_event = mock.Mock()
+        mock_stop_event.is_set.side_effect = [False] * 5 + [True]
+        client._OctoPrintPushClient__stop_event = mock_stop_event
+
+        client._OctoPrintPushClient__run()
+
+        self.assertEqual(mock_consume.call_count, 4)
+
+        # We always wait before reconnecting and back off is only reset after a message has
+        # been received
+        delays = [call_args[0][0] for call_args in mock_stop_event.wait.call_args_list]
+        self.assertEqual(delays, [2, 4, 1, 2])
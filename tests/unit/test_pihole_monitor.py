@@ -13,13 +13,18 @@
 # limitations under the License.
 
 import os
+import time
 
 import mock
+import requests
 from flask import request
 
 from scalyr_agent.test_base import ScalyrMockHttpServerTestCase
 
 from custom_monitors.pihole_monitor import PiHoleMonitor
+from custom_monitors.pihole_monitor import CounterRateCalculator
+from custom_monitors.pihole_monitor import EmittedValuesCache
+from custom_monitors.pihole_monitor import get_top_items_buckets
 
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
 FIXTURES_DIR = os.path.join(BASE_DIR, "../fixtures/pihole")
@@ -27,6 +32,9 @@ FIXTURES_DIR = os.path.join(BASE_DIR, "../fixtures/pihole")
 with open(os.path.join(FIXTURES_DIR, "api.json")) as fp:
     MOCK_200_RESPONSE = fp.read()
 
+with open(os.path.join(FIXTURES_DIR, "api_details.json")) as fp:
+    MOCK_DETAILS_200_RESPONSE = fp.read()
+
 
 EXPECTED_VALUES = [
     ("pihole.dns_queries_today", 64207, {}),
@@ -50,6 +58,53 @@ def mock_invalid_auth_view_func():
     return ("", 401, {})
 
 
+def mock_etag_view_func():
+    if request.headers.get("If-None-Match", None) == '"v1"':
+        return ("", 304, {})
+
+    return (MOCK_200_RESPONSE, 200, {"ETag": '"v1"'})
+
+
+VOLATILE_VIEW_CALL_COUNT = [0]
+
+
+def mock_volatile_view_func():
+    # Relative gravity update time changes even if the counters don't
+    VOLATILE_VIEW_CALL_COUNT[0] += 1
+    return MOCK_200_RESPONSE.replace('"minutes": 38', '"minutes": %s' % (VOLATILE_VIEW_CALL_COUNT[0]))
+
+
+# (dns_queries_today, ads_blocked_today) values returned by the counter view, last one is a reset
+COUNTER_VIEW_VALUES = [(64207, 2409), (64807, 2469), (100, 5)]
+COUNTER_VIEW_CALL_COUNT = [0]
+
+
+def mock_counter_view_func():
+    dns_queries, ads_blocked = COUNTER_VIEW_VALUES[COUNTER_VIEW_CALL_COUNT[0]]
+    COUNTER_VIEW_CALL_COUNT[0] += 1
+    return MOCK_200_RESPONSE.replace('"dns_queries_today": 64207', '"dns_queries_today": %s' % (dns_queries)).replace('"ads_blocked_today": 2409', '"ads_blocked_today": %s' % (ads_blocked))
+
+
+def mock_details_view_func():
+    if "topItems" not in request.args:
+        return MOCK_200_RESPONSE
+
+    # Pi-hole returns an empty array when API token is invalid
+    if request.args.get("auth", None) != "token":
+        return "[]"
+
+    return MOCK_DETAILS_200_RESPONSE
+
+
+def mock_malformed_view_func():
+    return ('{"dns_queries_today": 64207', 200, {"ETag": '"malformed"'})
+
+
+def mock_slow_view_func():
+    time.sleep(1)
+    return mock_invalid_auth_view_func()
+
+
 class PiHoleMonitorTestCase(ScalyrMockHttpServerTestCase):
     @classmethod
     def setUpClass(cls):
@@ -59,6 +114,24 @@ class PiHoleMonitorTestCase(ScalyrMockHttpServerTestCase):
         cls.mock_http_server_thread.app.add_url_rule(
             "/admin/api.php", view_func=mock_invalid_auth_view_func
         )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/slow/admin/api.php", view_func=mock_slow_view_func
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/etag/admin/api.php", view_func=mock_etag_view_func
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/volatile/admin/api.php", view_func=mock_volatile_view_func
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/counter/admin/api.php", view_func=mock_counter_view_func
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/details/admin/api.php", view_func=mock_details_view_func
+        )
+        cls.mock_http_server_thread.app.add_url_rule(
+            "/malformed/admin/api.php", view_func=mock_malformed_view_func
+        )
 
         cls.base_url = "http://%s:%s/" % (
             cls.mock_http_server_thread.host,
@@ -104,3 +177,386 @@ class PiHoleMonitorTestCase(ScalyrMockHttpServerTestCase):
             self.assertEqual(expected_metric_name, actual_metric_name)
             self.assertEqual(expected_metric_value, actual_metric_value)
             index += 1
+
+    def test_gather_sample_session_is_reused(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url,
+            "basic_auth": "valid:valid"
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        with mock.patch("requests.Session", wraps=requests.Session) as mock_session_cls:
+            monitor.gather_sample()
+            monitor.gather_sample()
+
+        self.assertEqual(mock_session_cls.call_count, 1)
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        # Payload hasn't changed so only the heartbeat and zero rates are emitted for the second
+        # sample
+        self.assertEqual(mock_logger.emit_value.call_count, 12)
+        monitor.stop(wait_on_join=False)
+
+    def test_gather_sample_read_timeout(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url + "slow/",
+            "basic_auth": "valid:valid",
+            "read_timeout": 0.2,
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("timed out" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+    def test_gather_sample_unchanged_payload_etag(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url + "etag/",
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.emit_value.call_count, 9)
+
+        mock_logger.reset_mock()
+
+        with mock.patch("requests.models.Response.json") as mock_json:
+            monitor.gather_sample()
+
+        self.assertEqual(mock_json.call_count, 0)
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(
+            [call_args[0] for call_args in mock_logger.emit_value.call_args_list],
+            [
+                ("pihole.status", "enabled"),
+                ("pihole.dns_queries_per_second", 0.0),
+                ("pihole.ads_blocked_per_second", 0.0),
+            ],
+        )
+
+    def test_gather_sample_unchanged_payload_hash(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url + "volatile/",
+            "unchanged_payload_heartbeat": False,
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.emit_value.call_count, 9)
+
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+    def test_gather_sample_malformed_payload_is_not_treated_as_unchanged(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url + "malformed/",
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.gather_sample()
+
+        self.assertEqual(mock_logger.warn.call_count, 2)
+        for call_args in mock_logger.warn.call_args_list:
+            self.assertTrue("Failed to parse Pi-hole data" in call_args[0][0])
+
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+    def test_gather_sample_skip_unchanged_payloads_disabled(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url + "etag/",
+            "skip_unchanged_payloads": False,
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.gather_sample()
+        # 9 metrics for each sample and 2 rates for the second one
+        self.assertEqual(mock_logger.emit_value.call_count, 20)
+
+    @mock.patch("custom_monitors.pihole_monitor.time")
+    def test_gather_sample_counter_rates(self, mock_time):
+        mock_time.time.side_effect = [1000, 1060, 1120]
+
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url + "counter/",
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        # No previous sample so no rates
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.emit_value.call_count, 9)
+
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        mock_logger.emit_value.assert_any_call(
+            "pihole.dns_queries_per_second", 10.0, extra_fields={}
+        )
+        mock_logger.emit_value.assert_any_call(
+            "pihole.ads_blocked_per_second", 1.0, extra_fields={}
+        )
+
+        # Counters have been reset at midnight
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        mock_logger.emit_value.assert_any_call(
+            "pihole.dns_queries_per_second", 1.667, extra_fields={}
+        )
+        mock_logger.emit_value.assert_any_call(
+            "pihole.ads_blocked_per_second", 0.083, extra_fields={}
+        )
+
+    def test_gather_sample_multiple_targets(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "targets": [
+                {"base_url": self.base_url, "basic_auth": "valid:valid", "instance": "pihole1"},
+                {"base_url": self.base_url + "slow/", "basic_auth": "valid:valid",
+                 "instance": "pihole2"},
+                {"base_url": self.base_url + "slow/", "basic_auth": "valid:valid",
+                 "timeout": 0.2, "instance": "pihole3"},
+                {"base_url": self.base_url, "basic_auth": "invalid:invalid"},
+            ]
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        start_ts = time.time()
+        monitor.gather_sample()
+        duration = time.time() - start_ts
+        monitor.stop(wait_on_join=False)
+
+        # Targets are polled concurrently so the duration is bounded by the slowest target
+        self.assertTrue(duration < 1.8, "Sample took %s seconds" % (duration))
+
+        # pihole3 timed out and the last target uses invalid credentials
+        self.assertEqual(mock_logger.warn.call_count, 2)
+        self.assertEqual(mock_logger.emit_value.call_count, 18)
+
+        instances = set()
+        for call_args in mock_logger.emit_value.call_args_list:
+            instances.add(call_args[1]["extra_fields"]["instance"])
+
+        self.assertEqual(instances, set(["pihole1", "pihole2"]))
+
+    def test_gather_sample_multiple_targets_slow_target_is_skipped(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "sample_interval": 0.3,
+            "targets": [
+                {"base_url": self.base_url, "basic_auth": "valid:valid", "instance": "fast"},
+                {"base_url": self.base_url + "slow/", "basic_auth": "valid:valid",
+                 "instance": "slow"},
+            ]
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        # Slow target doesn't delay the sample for the fast one and we only wait for the
+        # responses for a fraction of the sample interval
+        start_ts = time.time()
+        monitor.gather_sample()
+        duration = time.time() - start_ts
+        self.assertTrue(duration < 0.3, "Sample took %s seconds" % (duration))
+        self.assertEqual(mock_logger.emit_value.call_count, 9)
+        self.assertEqual(mock_logger.emit_value.call_args_list[0][1]["extra_fields"],
+                         {"instance": "fast"})
+
+        # Request for the slow target is still in progress so it's skipped
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("still in progress" in mock_logger.warn.call_args_list[0][0][0])
+
+        # Pending request is handled once it completes
+        time.sleep(1)
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+
+        instances = set()
+        for call_args in mock_logger.emit_value.call_args_list:
+            instances.add(call_args[1]["extra_fields"]["instance"])
+
+        self.assertEqual(instances, set(["fast", "slow"]))
+
+    def test_gather_sample_detailed_data(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url + "details/",
+            "api_token": "token",
+            "collect_top_items": True,
+            "collect_query_types": True,
+            "collect_forward_destinations": True,
+            "collect_over_time_data": True,
+            "top_items_count": 5,
+            "top_items_cardinality_budget": 4,
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.warn.call_count, 0)
+
+        values = {}
+        for call_args in mock_logger.emit_value.call_args_list:
+            values.setdefault(call_args[0][0], []).append((call_args[0][1], call_args[1]))
+
+        self.assertEqual(len(values["pihole.dns_queries_today"]), 1)
+
+        # Only top 5 items are counted and they are hashed into at most 4 buckets
+        for metric_name, expected_sum in [
+            ("pihole.top_queries.count", 4523 + 3210 + 2988 + 1876 + 1504),
+            ("pihole.top_ads.count", 612 + 401 + 299),
+            ("pihole.top_clients.count", 20112 + 15032 + 9001 + 4210 + 1022),
+        ]:
+            buckets = [kwargs["extra_fields"]["bucket"] for _, kwargs in values[metric_name]]
+            self.assertTrue(len(buckets) <= 4)
+            self.assertTrue(set(buckets).issubset(set(["0", "1", "2", "3"])))
+            self.assertEqual(sum([value for value, _ in values[metric_name]]), expected_sum)
+
+        query_types = dict(
+            [
+                (kwargs["extra_fields"]["query_type"], value)
+                for value, kwargs in values["pihole.query_types.percentage"]
+            ]
+        )
+        self.assertEqual(len(query_types), 7)
+        self.assertEqual(query_types["AAAA (IPv6)"], 30.11)
+
+        destinations = dict(
+            [
+                (kwargs["extra_fields"]["destination"], value)
+                for value, kwargs in values["pihole.forward_destinations.percentage"]
+            ]
+        )
+        self.assertEqual(
+            destinations,
+            {"blocklist": 3.75, "cache": 25.45, "dns.google#53": 40.3, "1.1.1.1": 30.5},
+        )
+
+        self.assertEqual(
+            values["pihole.over_time.dns_queries"],
+            [
+                (412, {"extra_fields": {}, "timestamp": 1609542600000}),
+                (398, {"extra_fields": {}, "timestamp": 1609543200000}),
+                (120, {"extra_fields": {}, "timestamp": 1609543800000}),
+            ],
+        )
+        self.assertEqual(len(values["pihole.over_time.ads_blocked"]), 3)
+
+        # Nothing has changed so only the summary heartbeat and zero rates are emitted
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 3)
+        self.assertEqual(mock_logger.emit_value.call_args_list[0][0], ("pihole.status", "enabled"))
+
+        # All the detailed data values should be emitted again on full refresh
+        mock_logger.reset_mock()
+        with mock.patch("time.time", return_value=time.time() + 601):
+            monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        metric_names = [call_args[0][0] for call_args in mock_logger.emit_value.call_args_list]
+        self.assertEqual(metric_names.count("pihole.query_types.percentage"), 7)
+        self.assertEqual(metric_names.count("pihole.forward_destinations.percentage"), 4)
+        self.assertEqual(metric_names.count("pihole.over_time.dns_queries"), 3)
+
+    def test_gather_sample_detailed_data_invalid_api_token(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+            "base_url": self.base_url + "details/",
+            "api_token": "invalid",
+            "collect_top_items": True,
+        }
+        mock_logger = mock.Mock()
+        monitor = PiHoleMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("invalid or missing API token" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertEqual(mock_logger.emit_value.call_count, 9)
+
+    def test_invalid_config(self):
+        monitor_config = {
+            "module": "pihole_monitor",
+        }
+
+        with self.assertRaises(ValueError):
+            PiHoleMonitor(monitor_config, mock.Mock())
+
+        monitor_config = {
+            "module": "pihole_monitor",
+            "targets": [{"basic_auth": "valid:valid"}],
+        }
+
+        with self.assertRaises(ValueError):
+            PiHoleMonitor(monitor_config, mock.Mock())
+
+    def test_counter_rate_calculator_mark_unchanged(self):
+        calculator = CounterRateCalculator()
+
+        self.assertEqual(calculator.mark_unchanged(900), [])
+        self.assertEqual(calculator.calculate("queries", 100, 1000), None)
+        self.assertEqual(calculator.mark_unchanged(1090), ["queries"])
+        self.assertEqual(calculator.calculate("queries", 130, 1100), 3.0)
+        self.assertEqual(calculator.calculate("queries", 130, 1100), None)
+
+    def test_get_top_items_buckets(self):
+        items = {"a.com": 10, "b.com": 5, "c.com": 3, "d.com": 1}
+
+        buckets = get_top_items_buckets(items, 3, 1)
+        self.assertEqual(buckets, {"0": 18})
+
+        buckets = get_top_items_buckets(items, 10, 1000)
+        self.assertEqual(sorted(buckets.values()), [1, 3, 5, 10])
+
+        # Bucket assignment is stable
+        self.assertEqual(buckets, get_top_items_buckets(items, 10, 1000))
+
+    def test_emitted_values_cache(self):
+        cache = EmittedValuesCache(max_size=2)
+
+        self.assertTrue(cache.is_changed(("a",), 1))
+        self.assertFalse(cache.is_changed(("a",), 1))
+        self.assertTrue(cache.is_changed(("a",), 2))
+        self.assertTrue(cache.is_changed(("b",), 1))
+
+        # Least recently used item is evicted
+        self.assertTrue(cache.is_changed(("c",), 1))
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.is_changed(("a",), 2))
+        self.assertFalse(cache.is_changed(("c",), 1))
+
+        # All the values are treated as changed on full refresh
+        with mock.patch("time.time", return_value=time.time() + 601):
+            self.assertTrue(cache.is_changed(("c",), 1))
+            self.assertFalse(cache.is_changed(("c",), 1))
+
+        # Values are always treated as changed if full refresh is disabled
+        cache = EmittedValuesCache(max_size=2, full_refresh_interval=0)
+        self.assertTrue(cache.is_changed(("a",), 1))
+        self.assertTrue(cache.is_changed(("a",), 1))
@@ -13,12 +13,19 @@
 # limitations under the License.
 
 import os
+import shutil
+import tempfile
+import time
+import subprocess
 
 from scalyr_agent.test_base import ScalyrTestCase
 
 import mock
 
 from custom_monitors.raspberry_pi_monitor import RaspberryPiMetricsMonitor
+from custom_monitors.raspberry_pi_monitor import RingBuffer
+
+from utils import mailbox_stub
 
 __all__ = ["RaspberryPiMetricsMonitor"]
 
@@ -26,8 +33,19 @@ __all__ = ["RaspberryPiMetricsMonitor"]
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
 FIXTURES_DIR = os.path.join(BASE_DIR, "../fixtures")
 
-EXPECTED_VALUES = [
+EXPECTED_THROTTLED_VALUES = [
     ("rpi.status.throttled_state", "0"),
+    ("rpi.status.under_voltage", 0),
+    ("rpi.status.frequency_capped", 0),
+    ("rpi.status.throttled", 0),
+    ("rpi.status.soft_temperature_limit", 0),
+    ("rpi.status.under_voltage_occurred", 0),
+    ("rpi.status.frequency_capped_occurred", 0),
+    ("rpi.status.throttled_occurred", 0),
+    ("rpi.status.soft_temperature_limit_occurred", 0),
+]
+
+EXPECTED_NON_THROTTLED_VALUES = [
     ("rpi.soc.temperature", 49),
     ("rpi.arm.clock", 1800),
     ("rpi.core.clock", 500),
@@ -40,22 +58,338 @@ EXPECTED_VALUES = [
     ("rpi.sdram_p.volts", 1.1),
 ]
 
+EXPECTED_VALUES = EXPECTED_THROTTLED_VALUES + EXPECTED_NON_THROTTLED_VALUES
+
 
 class RaspberryPiMonitorTestCase(ScalyrTestCase):
+    def setUp(self):
+        super(RaspberryPiMonitorTestCase, self).setUp()
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        # Any file which can be opened for reading and writing works with the simulated mailbox
+        self.vcio_path = os.path.join(tmp_dir, "vcio")
+        open(self.vcio_path, "w").close()
+
+        self.mock_mailbox = mailbox_stub.MockMailbox()
+        patcher = mock.patch(
+            "custom_monitors.raspberry_pi_monitor.fcntl.ioctl", self.mock_mailbox.ioctl
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_gather_sample(self):
         monitor_config = {
             "module": "raspberry_pi_monitor",
-            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd")
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd"),
+            "vcio_path": self.vcio_path,
+            "sysfs_root": os.path.join(FIXTURES_DIR, "sysfs_empty"),
         }
         mock_logger = mock.Mock()
         monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
 
         self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+        with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as mock_popen:
+            monitor.gather_sample()
+
+        # All the values are retrieved using the mailbox without spawning any processes
+        self.assertEqual(mock_popen.call_count, 0)
+        self.assertEqual(len(self.mock_mailbox.commands), 11)
+        self.assertEqual(mock_logger.emit_value.call_count, 19)
+        self._assert_emitted_values(mock_logger)
+
+        # Mailbox device should be kept open for subsequent samples. Throttled state hasn't
+        # changed so it's not emitted again.
+        mock_logger.reset_mock()
+
+        with mock.patch("os.open") as mock_os_open:
+            monitor.gather_sample()
+
+        self.assertEqual(mock_os_open.call_count, 0)
+        self.assertEqual(len(self.mock_mailbox.commands), 22)
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 10)
+        self._assert_emitted_values(mock_logger, EXPECTED_NON_THROTTLED_VALUES)
+        monitor.stop(wait_on_join=False)
+
+    def test_gather_sample_per_metric_collection_mode(self):
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd"),
+            "collection_mode": "per_metric",
+            "use_file_sources": False,
+        }
+        mock_logger = mock.Mock()
+        monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+
+        with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as mock_popen:
+            monitor.gather_sample()
+
+        self.assertEqual(mock_popen.call_count, 11)
+        self.assertEqual(mock_logger.emit_value.call_count, 19)
+        self._assert_emitted_values(mock_logger)
+
+    def test_gather_sample_mailbox_mode_falls_back_to_per_metric_mode(self):
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd"),
+            "vcio_path": self.vcio_path + ".doesnt_exist",
+            "sysfs_root": os.path.join(FIXTURES_DIR, "sysfs_empty"),
+        }
+        mock_logger = mock.Mock()
+        monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+
         monitor.gather_sample()
+
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("falling back" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertEqual(mock_logger.emit_value.call_count, 19)
+        self._assert_emitted_values(mock_logger)
+
+        # Mailbox mode is not retried on subsequent samples
+        mock_logger.reset_mock()
+
+        with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as mock_popen:
+            monitor.gather_sample()
+
+        self.assertEqual(mock_popen.call_count, 11)
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(len(self.mock_mailbox.commands), 0)
+        monitor.stop(wait_on_join=False)
+
+    def test_gather_sample_mailbox_mode_without_vcgencmd_binary(self):
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "doesnt_exist"),
+            "vcio_path": self.vcio_path,
+            "sysfs_root": os.path.join(FIXTURES_DIR, "sysfs_empty"),
+        }
+        mock_logger = mock.Mock()
+        monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 19)
+        self._assert_emitted_values(mock_logger)
+
+    def test_gather_sample_mailbox_mode_fallback_without_vcgencmd_binary(self):
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "doesnt_exist"),
+            "vcio_path": self.vcio_path + ".doesnt_exist",
+            "sysfs_root": os.path.join(FIXTURES_DIR, "sysfs"),
+        }
+        mock_logger = mock.Mock()
+        monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+
+        # Only throttled state, temperature and ARM clock are available via sysfs
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("doesn't exist" in mock_logger.warn.call_args_list[0][0][0])
         self.assertEqual(mock_logger.emit_value.call_count, 11)
+        self._assert_emitted_values(mock_logger, EXPECTED_VALUES[:11])
+
+        # Missing values are not logged again on subsequent samples
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 2)
+
+    def test_gather_sample_mailbox_command_failure(self):
+        output = dict(mailbox_stub.MOCK_VCGENCMD_OUTPUT)
+        del output["measure_volts sdram_p"]
+        self.mock_mailbox.output = output
+
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd"),
+            "vcio_path": self.vcio_path,
+            "sysfs_root": os.path.join(FIXTURES_DIR, "sysfs_empty"),
+        }
+        mock_logger = mock.Mock()
+        monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        # Only the value for the failed command is missing
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("rpi.sdram_p.volts" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertTrue("error_code=1" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertEqual(mock_logger.emit_value.call_count, 18)
+        self._assert_emitted_values(mock_logger, EXPECTED_VALUES[:-1])
+
+    def test_gather_sample_file_sources(self):
+        sysfs_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sysfs_root)
+        shutil.rmtree(sysfs_root)
+        shutil.copytree(os.path.join(FIXTURES_DIR, "sysfs"), sysfs_root)
+
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd"),
+            "vcio_path": self.vcio_path,
+            "sysfs_root": sysfs_root,
+        }
+        mock_logger = mock.Mock()
+        monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+
+        with mock.patch(
+            "custom_monitors.raspberry_pi_monitor.VcgencmdMailboxCollector.collect",
+            wraps=monitor._RaspberryPiMetricsMonitor__mailbox_collector.collect,
+        ) as mock_collect:
+            monitor.gather_sample()
+
+        # Throttled state, temperature and ARM clock are read from sysfs
+        self.assertEqual(len(mock_collect.call_args[1]["commands_args"]), 8)
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 19)
+        self._assert_emitted_values(mock_logger)
+
+        # Files should be kept open and re-read on subsequent samples
+        with open(os.path.join(sysfs_root, "sys/class/thermal/thermal_zone0/temp"), "w") as fp:
+            fp.write("51349\n")
+
+        mock_logger.reset_mock()
+
+        with mock.patch("os.open") as mock_os_open:
+            monitor.gather_sample()
+
+        self.assertEqual(mock_os_open.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_args_list[0][0],
+                         ("rpi.soc.temperature", 51.3))
+        monitor.stop(wait_on_join=False)
+
+    def test_gather_sample_high_frequency_sampling(self):
+        sysfs_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sysfs_root)
+        shutil.rmtree(sysfs_root)
+        shutil.copytree(os.path.join(FIXTURES_DIR, "sysfs"), sysfs_root)
+        throttled_path = os.path.join(sysfs_root, "sys/devices/platform/soc/soc:firmware/get_throttled")
+
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd"),
+            "vcio_path": self.vcio_path,
+            "sysfs_root": sysfs_root,
+            "high_frequency_sampling_rate": 50,
+        }
+        mock_logger = mock.Mock()
+        monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+        self.addCleanup(monitor.stop, wait_on_join=False)
+
+        monitor.gather_sample()
+
+        # Simulate a short throttling burst which happens between two samples
+        with open(throttled_path, "w") as fp:
+            fp.write("50005\n")
+
+        time.sleep(0.3)
+
+        with open(throttled_path, "w") as fp:
+            fp.write("50000\n")
+
+        time.sleep(0.3)
+
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        emitted_values = dict(
+            [call_args[0] for call_args in mock_logger.emit_value.call_args_list]
+        )
+
+        self.assertEqual(emitted_values["rpi.status.throttled_state"], "1010000000000000101")
+        self.assertTrue(0 < emitted_values["rpi.status.throttled_fraction"] < 1)
+        self.assertEqual(emitted_values["rpi.soc.temperature"], 49.0)
+        self.assertEqual(emitted_values["rpi.soc.temperature.min"], 49.0)
+        self.assertEqual(emitted_values["rpi.soc.temperature.max"], 49.0)
+        self.assertEqual(emitted_values["rpi.soc.temperature.p95"], 49.0)
+        self.assertEqual(emitted_values["rpi.arm.clock"], 1800)
+        self.assertEqual(emitted_values["rpi.arm.clock.p95"], 1800)
+        self.assertEqual(emitted_values["rpi.core.clock"], 500)
+
+    def test_gather_sample_throttled_state_flags(self):
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd"),
+            "sysfs_root": os.path.join(FIXTURES_DIR, "sysfs_empty"),
+        }
+        mock_logger = mock.Mock()
+        monitor = RaspberryPiMetricsMonitor(monitor_config, mock_logger)
+
+        monitor._emit_throttled_state(throttled_state=0)
+        self.assertEqual(mock_logger.emit_value.call_count, 9)
+
+        # Under-voltage detected, only changed flags should be emitted
+        mock_logger.reset_mock()
+        monitor._emit_throttled_state(throttled_state=0x50005)
+        self.assertEqual(
+            [call_args[0] for call_args in mock_logger.emit_value.call_args_list],
+            [
+                ("rpi.status.throttled_state", "1010000000000000101"),
+                ("rpi.status.under_voltage", 1),
+                ("rpi.status.throttled", 1),
+                ("rpi.status.under_voltage_occurred", 1),
+                ("rpi.status.throttled_occurred", 1),
+            ],
+        )
+
+        mock_logger.reset_mock()
+        monitor._emit_throttled_state(throttled_state=0x50005)
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+        # All the values should be emitted on full refresh
+        with mock.patch("time.time", return_value=time.time() + 601):
+            monitor._emit_throttled_state(throttled_state=0x50005)
+
+        self.assertEqual(mock_logger.emit_value.call_count, 9)
+
+    def test_ring_buffer(self):
+        ring_buffer = RingBuffer(size=3)
+        self.assertEqual(ring_buffer.drain(), [])
+
+        ring_buffer.append(1)
+        ring_buffer.append(2)
+        self.assertEqual(ring_buffer.drain(), [1, 2])
+        self.assertEqual(ring_buffer.drain(), [])
+
+        # Oldest values are overwritten once the buffer is full
+        for value in range(3, 8):
+            ring_buffer.append(value)
+
+        self.assertEqual(ring_buffer.drain(), [5, 6, 7])
+
+    def test_invalid_collection_mode(self):
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "mock_vcgencmd"),
+            "collection_mode": "invalid",
+        }
+        with self.assertRaises(ValueError):
+            RaspberryPiMetricsMonitor(monitor_config, mock.Mock())
+
+    def test_per_metric_collection_mode_requires_vcgencmd_binary(self):
+        monitor_config = {
+            "module": "raspberry_pi_monitor",
+            "vcgencmd_path": os.path.join(FIXTURES_DIR, "doesnt_exist"),
+            "collection_mode": "per_metric",
+        }
+        with self.assertRaises(ValueError):
+            RaspberryPiMetricsMonitor(monitor_config, mock.Mock())
+
+    def _assert_emitted_values(self, mock_logger, expected_values=None):
+        expected_values = expected_values or EXPECTED_VALUES
 
         index = 0
-        for expected_metric_name, expected_metric_value in EXPECTED_VALUES:
+        for expected_metric_name, expected_metric_value in expected_values:
             actual_metric_name = mock_logger.emit_value.call_args_list[index][0][0]
             actual_metric_value = mock_logger.emit_value.call_args_list[index][0][1]
 
@@ -0,0 +1,560 @@
+# Copyright 2023 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import importlib
+
+import mock
+
+from scalyr_agent import util as scalyr_util
+from scalyr_agent.test_base import ScalyrTestCase
+
+from utils import tibber_stub
+
+
+def wait_for(condition, timeout=5):
+    start_ts = time.time()
+
+    while not condition():
+        if time.time() - start_ts >= timeout:
+            raise AssertionError("Timeout waiting for condition")
+
+        time.sleep(0.01)
+
+
+def get_measurement(**data):
+    # NOTE: Measurement is created from the raw GraphQL live measurement data same as in the library
+    return tibber_stub.StubLiveMeasurement(data)
+
+
+class TibberTestCase(ScalyrTestCase):
+    """
+    Base test case which installs stub "tibber" module and imports the monitor module using it.
+    """
+
+    def setUp(self):
+        super(TibberTestCase, self).setUp()
+
+        self.sys_modules_patcher = mock.patch.dict(sys.modules, tibber_stub.get_stub_modules())
+        self.sys_modules_patcher.start()
+
+        self.tibber_pulse_monitor = importlib.import_module("custom_monitors.tibber_pulse_monitor")
+
+    def tearDown(self):
+        # NOTE: This also removes the monitor module which has been imported using the stub
+        self.sys_modules_patcher.stop()
+
+        super(TibberTestCase, self).tearDown()
+
+
+class MeasurementAggregatorTestCase(TibberTestCase):
+    def test_add_aggregates_measurements_into_windows(self):
+        aggregator = self.tibber_pulse_monitor.MeasurementAggregator(window_size=30)
+
+        self.assertEqual(
+            aggregator.add(61, get_measurement(power=1000, currentL1=1.5, voltagePhase1=230)), []
+        )
+        self.assertEqual(aggregator.add(70, get_measurement(power=3000, currentL1=2.5)), [])
+        self.assertEqual(aggregator.add(80, get_measurement(power=2000)), [])
+
+        closed_windows = aggregator.add(95, get_measurement(power=500))
+        self.assertEqual(len(closed_windows), 1)
+
+        window = closed_windows[0]
+        self.assertEqual((window.start, window.end), (60, 90))
+        self.assertEqual(window.count, 3)
+
+        power = window.fields[0]
+        self.assertEqual(
+            (power.count, power.min, power.max, power.mean, power.last), (3, 1000, 3000, 2000, 2000)
+        )
+
+        current = window.fields[3]
+        self.assertEqual((current.count, current.mean, current.last), (2, 2, 2.5))
+
+        voltage = window.fields[6]
+        self.assertEqual((voltage.count, voltage.last), (1, 230))
+
+        # Fields which were not received are not aggregated
+        self.assertEqual(window.fields[1].count, 0)
+
+    def test_close_expired(self):
+        aggregator = self.tibber_pulse_monitor.MeasurementAggregator(window_size=30)
+        aggregator.add(61, get_measurement(power=1000))
+
+        self.assertEqual(aggregator.close_expired(89), [])
+
+        closed_windows = aggregator.close_expired(90)
+        self.assertEqual(len(closed_windows), 1)
+        self.assertEqual(closed_windows[0].end, 90)
+
+        self.assertEqual(aggregator.close_expired(200), [])
+
+    def test_energy_is_integrated_across_window_boundaries(self):
+        aggregator = self.tibber_pulse_monitor.MeasurementAggregator(window_size=30)
+
+        aggregator.add(0, get_measurement(power=3600))
+        aggregator.add(20, get_measurement(power=7200))
+
+        # 20 seconds at 3600 W and 10 seconds at 7200 W
+        window = aggregator.add(40, get_measurement(power=0))[0]
+        self.assertAlmostEqual(window.energy_wh, 20 + 20)
+
+        # Remaining 10 seconds at 7200 W are accounted for in the next window
+        window = aggregator.close_expired(60)[0]
+        self.assertAlmostEqual(window.energy_wh, 20)
+
+    def test_energy_is_not_integrated_across_gaps(self):
+        aggregator = self.tibber_pulse_monitor.MeasurementAggregator(window_size=30)
+
+        aggregator.add(1, get_measurement(power=3600))
+
+        window = aggregator.close_expired(30)[0]
+        self.assertAlmostEqual(window.energy_wh, 29)
+
+        # Gap since the last power sample is too large (even though the previous window has
+        # ended less than MAX_ENERGY_INTEGRATION_GAP seconds ago)
+        aggregator.add(75, get_measurement(power=3600))
+        window = aggregator.close_expired(90)[0]
+        self.assertAlmostEqual(window.energy_wh, 15)
+
+        aggregator.add(91, get_measurement(power=3600))
+        window = aggregator.add(200, get_measurement(power=3600))[0]
+        self.assertAlmostEqual(window.energy_wh, 30)
+
+        # Only the part of the window which follows the sample at 200 is integrated
+        window = aggregator.close_expired(210)[0]
+        self.assertAlmostEqual(window.energy_wh, 10)
+
+
+class MeasurementSpoolTestCase(TibberTestCase):
+    def setUp(self):
+        super(MeasurementSpoolTestCase, self).setUp()
+
+        self.spool_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_path)
+
+    def test_append_read_and_commit(self):
+        spool = self.tibber_pulse_monitor.MeasurementSpool(
+            path=self.spool_path, max_size=1024 * 1024
+        )
+
+        spool.append([{"timestamp": 1000, "values": []}, {"timestamp": 2000, "values": []}])
+        spool.append([{"timestamp": 3000, "values": []}])
+
+        records, cursor = spool.read(max_records=2)
+        self.assertEqual([record["timestamp"] for record in records], [1000, 2000])
+
+        # Records are not consumed until the cursor is committed
+        records, _ = spool.read(max_records=10)
+        self.assertEqual(len(records), 3)
+
+        spool.commit(cursor)
+
+        # Cursor is persisted on disk
+        spool = self.tibber_pulse_monitor.MeasurementSpool(
+            path=self.spool_path, max_size=1024 * 1024
+        )
+        records, cursor = spool.read(max_records=10)
+        self.assertEqual([record["timestamp"] for record in records], [3000])
+
+        spool.commit(cursor)
+        self.assertEqual(spool.read(max_records=10)[0], [])
+
+    def test_oldest_segments_are_evicted_when_size_limit_is_reached(self):
+        spool = self.tibber_pulse_monitor.MeasurementSpool(
+            path=self.spool_path, max_size=1024, segment_size=256
+        )
+
+        evicted = 0
+
+        for index in range(0, 100):
+            evicted += spool.append([{"timestamp": index, "values": [["name", 1, {}]]}])
+
+        self.assertTrue(evicted > 0)
+
+        spool_size = sum(
+            os.path.getsize(os.path.join(self.spool_path, file_name))
+            for file_name in os.listdir(self.spool_path)
+            if file_name.startswith("segment-")
+        )
+        self.assertTrue(spool_size <= 1024, "Spool size is %s bytes" % (spool_size))
+
+        # Only the newest records are left and the cursor has been moved past the evicted ones
+        records, _ = spool.read(max_records=1000)
+        timestamps = [record["timestamp"] for record in records]
+        self.assertEqual(timestamps, list(range(timestamps[0], 100)))
+        self.assertTrue(timestamps[0] > 0)
+
+
+class TibberPulseMonitorTestCase(TibberTestCase):
+    def setUp(self):
+        super(TibberPulseMonitorTestCase, self).setUp()
+
+        # Account discovery is instantaneous in the tests
+        patcher = mock.patch.object(tibber_stub, "API_LATENCY", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def _get_monitor(self, **config):
+        monitor_config = {
+            "module": "custom_monitors.tibber_pulse_monitor",
+            "access_token": "token",
+            "sample_write_interval": 30,
+        }
+        monitor_config.update(config)
+
+        mock_logger = mock.Mock()
+        monitor = self.tibber_pulse_monitor.TibberPulselectricityConsumptionMonitor(
+            monitor_config, mock_logger
+        )
+        monitor._run_state = mock.Mock()
+        monitor._run_state.is_running.return_value = True
+
+        return monitor, mock_logger
+
+    def test_stop_stops_event_loop_thread(self):
+        monitor, _ = self._get_monitor()
+
+        monitor.gather_sample()
+        wait_for(lambda: not monitor._queue.empty())
+
+        loop_thread = monitor._loop_thread
+        self.assertTrue(loop_thread.is_alive())
+
+        monitor.stop(wait_on_join=False)
+
+        self.assertFalse(loop_thread.is_alive())
+        self.assertTrue(monitor._loop.is_closed())
+        self.assertEqual(monitor._loop_thread, None)
+
+    def test_event_loop_thread_is_restarted_after_it_dies(self):
+        monitor, mock_logger = self._get_monitor()
+
+        with mock.patch.object(self.tibber_pulse_monitor, "LOOP_THREAD_RESTART_DELAY", 0):
+            with mock.patch.object(
+                monitor, "_add_callbacks", side_effect=Exception("unexpected error")
+            ):
+                monitor.gather_sample()
+                wait_for(lambda: not monitor._loop_thread.is_alive())
+
+            # Thread has died so it's restarted on the next sample
+            monitor.gather_sample()
+            self.assertEqual(mock_logger.warn.call_count, 1)
+            self.assertTrue("has died" in mock_logger.warn.call_args_list[0][0][0])
+
+            monitor.gather_sample()
+            wait_for(lambda: not monitor._queue.empty())
+            self.assertTrue(monitor._loop_thread.is_alive())
+
+        monitor.stop(wait_on_join=False)
+
+    def test_event_loop_thread_restart_is_delayed(self):
+        monitor, mock_logger = self._get_monitor()
+
+        with mock.patch.object(
+            monitor, "_add_callbacks", side_effect=Exception("unexpected error")
+        ):
+            monitor.gather_sample()
+            wait_for(lambda: not monitor._loop_thread.is_alive())
+
+            dead_loop_thread = monitor._loop_thread
+
+            monitor.gather_sample()
+            monitor.gather_sample()
+
+            # Thread is not restarted until the back off delay has passed
+            self.assertTrue(monitor._loop_thread is dead_loop_thread)
+            self.assertEqual(mock_logger.warn.call_count, 1)
+
+        monitor.stop(wait_on_join=False)
+
+    def test_open_windows_are_spooled_on_stop_and_replayed_after_restart(self):
+        spool_path = os.path.join(self.tmp_dir, "spool")
+        window_start = int(time.time()) // 3600 * 3600
+
+        monitor, mock_logger = self._get_monitor(spool_path=spool_path, sample_write_interval=3600)
+        monitor._start_loop_thread = mock.Mock()
+
+        monitor._queue.put(("home-1", window_start + 1, get_measurement(power=1000)))
+        monitor.gather_sample()
+
+        # Window is still open
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+        # Measurement which is still queued when the monitor is stopped
+        monitor._queue.put(("home-1", window_start + 2, get_measurement(power=2000)))
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+        monitor, mock_logger = self._get_monitor(spool_path=spool_path, sample_write_interval=3600)
+        monitor._start_loop_thread = mock.Mock()
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        emitted_values = dict(
+            [
+                (call_args[0][0], (call_args[0][1], call_args[1]["timestamp"]))
+                for call_args in mock_logger.emit_value.call_args_list
+            ]
+        )
+
+        # Values are emitted with the original timestamp
+        expected_timestamp = (window_start + 3600) * 1000
+        self.assertEqual(emitted_values["tibber.measurements"], (2, expected_timestamp))
+        self.assertEqual(emitted_values["tibber.consumption"], (1500, expected_timestamp))
+        self.assertEqual(emitted_values["tibber.consumption.max"], (2000, expected_timestamp))
+        self.assertEqual(
+            mock_logger.emit_value.call_args_list[0][1]["extra_fields"], {"home": "home-1"}
+        )
+
+    def test_spooled_windows_are_committed_on_next_sample(self):
+        spool_path = os.path.join(self.tmp_dir, "spool")
+
+        monitor, mock_logger = self._get_monitor(spool_path=spool_path)
+        monitor._start_loop_thread = mock.Mock()
+
+        monitor._queue.put(("home-1", 1000, get_measurement(power=1000)))
+        monitor.gather_sample()
+
+        self.assertEqual(mock_logger.emit_value.call_count, 6)
+        self.assertEqual(mock_logger.emit_value.call_args_list[0][1]["timestamp"], 1020000)
+
+        # Agent is killed before the next sample so the emitted window is replayed (values are
+        # emitted at least once)
+        monitor, mock_logger = self._get_monitor(spool_path=spool_path)
+        monitor._start_loop_thread = mock.Mock()
+        monitor.gather_sample()
+
+        self.assertEqual(mock_logger.emit_value.call_count, 6)
+        self.assertEqual(mock_logger.emit_value.call_args_list[0][1]["timestamp"], 1020000)
+
+        # Window has been committed on the next sample
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+        monitor, mock_logger = self._get_monitor(spool_path=spool_path)
+        monitor._start_loop_thread = mock.Mock()
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+    def test_live_feed_is_started_using_library_retry_arguments(self):
+        monitor, _ = self._get_monitor()
+        monitor.gather_sample()
+        wait_for(lambda: not monitor._queue.empty())
+        monitor.stop(wait_on_join=False)
+
+        # Unknown keyword arguments would be passed to the websocket transport by the library
+        home = monitor._homes[0]
+        self.assertEqual(home.live_feed_retries, self.tibber_pulse_monitor.LIVE_FEED_RETRIES)
+        self.assertEqual(home.transport_kwargs, {})
+        self.assertEqual(home.tibber_client.user_agent, self.tibber_pulse_monitor.USER_AGENT)
+
+    def test_home_metadata_is_cached(self):
+        metadata_cache_path = os.path.join(self.tmp_dir, "metadata.json")
+
+        monitor, _ = self._get_monitor(metadata_cache_path=metadata_cache_path)
+        monitor.gather_sample()
+        wait_for(lambda: not monitor._queue.empty())
+        monitor.stop(wait_on_join=False)
+
+        with open(metadata_cache_path, "r") as fp:
+            metadata = scalyr_util.json_decode(fp.read())
+
+        self.assertEqual(
+            metadata["websocket_subscription_url"], tibber_stub.WEBSOCKET_SUBSCRIPTION_URL
+        )
+        self.assertEqual(metadata["homes"], [tibber_stub.HOME_DATA])
+
+    def test_live_feed_is_started_using_cached_metadata(self):
+        metadata_cache_path = os.path.join(self.tmp_dir, "metadata.json")
+
+        monitor, _ = self._get_monitor(metadata_cache_path=metadata_cache_path)
+
+        with open(metadata_cache_path, "w") as fp:
+            fp.write(
+                scalyr_util.json_encode(
+                    {
+                        "access_token_hash": monitor._get_access_token_hash(),
+                        "websocket_subscription_url": "wss://cached",
+                        "homes": [tibber_stub.HOME_DATA],
+                    }
+                )
+            )
+
+        with mock.patch.object(
+            self.tibber_pulse_monitor.tibber, "Account", side_effect=tibber_stub.StubAccount
+        ) as mock_account:
+            monitor.gather_sample()
+            wait_for(lambda: not monitor._queue.empty())
+            monitor.stop(wait_on_join=False)
+
+        # Account data is not retrieved before starting the live feed and the websocket
+        # subscription URL is read from the cache
+        self.assertEqual(mock_account.call_count, 1)
+        self.assertFalse(mock_account.call_args[1]["immediate_update"])
+        self.assertEqual(monitor._homes[0].websocket_subscription_url, "wss://cached")
+
+    def test_metadata_cache_without_websocket_subscription_url_is_ignored(self):
+        metadata_cache_path = os.path.join(self.tmp_dir, "metadata.json")
+
+        monitor, _ = self._get_monitor(metadata_cache_path=metadata_cache_path)
+
+        with open(metadata_cache_path, "w") as fp:
+            fp.write(
+                scalyr_util.json_encode(
+                    {
+                        "access_token_hash": monitor._get_access_token_hash(),
+                        "homes": [tibber_stub.HOME_DATA],
+                    }
+                )
+            )
+
+        monitor.gather_sample()
+        wait_for(lambda: not monitor._queue.empty())
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(
+            monitor._homes[0].websocket_subscription_url, tibber_stub.WEBSOCKET_SUBSCRIPTION_URL
+        )
+
+        with open(metadata_cache_path, "r") as fp:
+            metadata = scalyr_util.json_decode(fp.read())
+
+        self.assertEqual(
+            metadata["websocket_subscription_url"], tibber_stub.WEBSOCKET_SUBSCRIPTION_URL
+        )
+
+    def test_metadata_cache_for_different_access_token_is_ignored(self):
+        metadata_cache_path = os.path.join(self.tmp_dir, "metadata.json")
+
+        with open(metadata_cache_path, "w") as fp:
+            fp.write(
+                scalyr_util.json_encode(
+                    {
+                        "access_token_hash": "invalid",
+                        "websocket_subscription_url": "wss://cached",
+                        "homes": [tibber_stub.HOME_DATA],
+                    }
+                )
+            )
+
+        monitor, _ = self._get_monitor(metadata_cache_path=metadata_cache_path)
+        monitor.gather_sample()
+        wait_for(lambda: not monitor._queue.empty())
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(
+            monitor._homes[0].websocket_subscription_url, tibber_stub.WEBSOCKET_SUBSCRIPTION_URL
+        )
+
+    def test_measurements_are_aggregated_per_home(self):
+        monitor, mock_logger = self._get_monitor()
+        monitor._start_loop_thread = mock.Mock()
+
+        monitor._queue.put(("home-1", 1000, get_measurement(power=1000)))
+        monitor._queue.put(("home-2", 1001, get_measurement(power=3000)))
+        monitor._queue.put(("home-1", 1002, get_measurement(power=2000)))
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        emitted_values = dict(
+            [
+                ((call_args[0][0], call_args[1]["extra_fields"]["home"]), call_args[0][1])
+                for call_args in mock_logger.emit_value.call_args_list
+            ]
+        )
+
+        self.assertEqual(emitted_values[("tibber.measurements", "home-1")], 2)
+        self.assertEqual(emitted_values[("tibber.consumption", "home-1")], 1500)
+        self.assertEqual(emitted_values[("tibber.measurements", "home-2")], 1)
+        self.assertEqual(emitted_values[("tibber.consumption", "home-2")], 3000)
+
+    def test_consumption_includes_voltage_phase_extra_field(self):
+        monitor, mock_logger = self._get_monitor()
+        monitor._start_loop_thread = mock.Mock()
+
+        monitor._queue.put(("home-1", 1000, get_measurement(power=1000, voltagePhase1=231)))
+        monitor._queue.put(("home-1", 1001, get_measurement(power=2000, voltagePhase1=229)))
+        monitor._queue.put(("home-2", 1001, get_measurement(power=3000)))
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        extra_fields = dict(
+            [
+                (call_args[1]["extra_fields"]["home"], call_args[1]["extra_fields"])
+                for call_args in mock_logger.emit_value.call_args_list
+                if call_args[0][0] == "tibber.consumption"
+            ]
+        )
+
+        # Same as in the previous versions, voltage_phase contains the phase 1 voltage
+        self.assertEqual(extra_fields["home-1"], {"home": "home-1", "voltage_phase": 229})
+        self.assertEqual(extra_fields["home-2"], {"home": "home-2"})
+
+    def test_live_feed_is_started_for_all_configured_homes(self):
+        home_data = dict(tibber_stub.HOME_DATA, id="home-2")
+        account_data = {
+            "viewer": dict(
+                tibber_stub.ACCOUNT_DATA["viewer"], homes=[tibber_stub.HOME_DATA, home_data]
+            )
+        }
+
+        with mock.patch.object(tibber_stub, "ACCOUNT_DATA", account_data):
+            monitor, _ = self._get_monitor(homes=["home-2", "home-1"])
+            monitor.gather_sample()
+
+            wait_for(lambda: monitor._queue.qsize() >= 4)
+            monitor.stop(wait_on_join=False)
+
+        self.assertEqual([home.id for home in monitor._homes], ["home-2", "home-1"])
+
+        home_ids = set()
+
+        while not monitor._queue.empty():
+            home_ids.add(monitor._queue.get_nowait()[0])
+
+        self.assertEqual(home_ids, set(["home-1", "home-2"]))
+
+    def test_select_homes(self):
+        monitor, _ = self._get_monitor()
+        account = tibber_stub.StubAccount("token", immediate_update=False)
+
+        homes = [
+            tibber_stub.StubTibberHome(tibber_stub.HOME_DATA, account),
+            tibber_stub.StubTibberHome(
+                {"id": "home-2", "features": {"realTimeConsumptionEnabled": False}}, account
+            ),
+        ]
+
+        # By default only homes with real time consumption enabled are used
+        self.assertEqual([home.id for home in monitor._select_homes(homes)], ["home-1"])
+
+        monitor, _ = self._get_monitor(homes=["home-2"])
+        self.assertEqual([home.id for home in monitor._select_homes(homes)], ["home-2"])
+
+        monitor, _ = self._get_monitor(homes=["home-3"])
+        with self.assertRaises(ValueError):
+            monitor._select_homes(homes)
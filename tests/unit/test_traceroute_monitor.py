@@ -0,0 +1,879 @@
+# Copyright 2022 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import socket
+import struct
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from scalyr_agent.test_base import ScalyrTestCase
+
+import mock
+
+from scalyr_agent import util as scalyr_util
+
+from custom_monitors.traceroute_monitor import TracerouteMonitor
+from custom_monitors.traceroute_monitor import TracerouteWorker
+from custom_monitors.traceroute_monitor import TracerouteScheduler
+from custom_monitors.traceroute_monitor import TracerouteTarget
+from custom_monitors.traceroute_monitor import IcmpProber
+from custom_monitors.traceroute_monitor import get_icmp_checksum
+from custom_monitors.traceroute_monitor import DestinationResolver
+from custom_monitors.traceroute_monitor import get_dns_query
+from custom_monitors.traceroute_monitor import get_dns_response_ttl
+from custom_monitors.traceroute_monitor import read_tracelb_record
+from custom_monitors.traceroute_monitor import get_hop_stats
+from custom_monitors.traceroute_monitor import format_hop_values
+
+__all__ = ["TracerouteMonitorTestCase"]
+
+
+BASE_DIR = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(BASE_DIR, "../fixtures")
+
+MOCK_TRACEROUTE_PATH = os.path.join(FIXTURES_DIR, "mock_fast_mda_traceroute")
+
+
+def skip_if_icmp_sockets_are_not_available(test_case):
+    prober = IcmpProber()
+
+    try:
+        prober.open()
+    except OSError as e:
+        test_case.skipTest("ICMP sockets are not available: %s" % (str(e)))
+    finally:
+        prober.close()
+
+
+class TracerouteMonitorTestCase(ScalyrTestCase):
+    def test_gather_sample_local_executor(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "label": "localhost",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 1)
+
+        call_args = mock_logger.emit_value.call_args_list[0]
+        self.assertEqual(call_args[0], ("traceroute.hops", 2))
+        self.assertEqual(
+            call_args[1]["extra_fields"],
+            {
+                "destination": "127.0.0.1",
+                "destination_original": "127.0.0.1",
+                "label": "localhost",
+                "hops": "10.0.0.1,127.0.0.1",
+                "hop_rtts": "4.98,12.15",
+                "hop_rtts_min": "4.84,11.8",
+                "hop_rtts_max": "5.12,12.5",
+                "hop_rtts_stddev": "0.14,0.35",
+                "hop_loss": "0.0,0.0",
+                "total_rtt": 17.13,
+                "method": "icmp-echo",
+                "path_fingerprint": "607f3c8ced5101b0",
+            },
+        )
+
+    def test_gather_sample_multiple_destinations_run_concurrently(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destinations": [
+                "127.0.0.1",
+                {"destination": "127.0.0.2", "label": "two"},
+                "127.0.0.3",
+                "127.0.0.99",
+            ],
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+            "max_parallel_traceroutes": 4,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        with mock.patch.dict(os.environ, {"MOCK_TRACEROUTE_DELAY": "0.5"}):
+            start_ts = time.time()
+            monitor.gather_sample()
+            duration = time.time() - start_ts
+
+        monitor.stop(wait_on_join=False)
+
+        self.assertTrue(duration < 1.5, "Sample took %s seconds" % (duration))
+
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("127.0.0.99" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertTrue("Network is unreachable" in mock_logger.warn.call_args_list[0][0][0])
+
+        destinations = {}
+        for call_args in mock_logger.emit_value.call_args_list:
+            extra_fields = call_args[1]["extra_fields"]
+            destinations[extra_fields["destination"]] = extra_fields["label"]
+
+        self.assertEqual(destinations, {"127.0.0.1": "", "127.0.0.2": "two", "127.0.0.3": ""})
+
+    def test_gather_sample_docker_exec_executor_runs_single_batch(self):
+        # Mock docker and fast-mda-traceroute binaries which run on the host are put on the PATH
+        bin_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bin_dir)
+
+        os.symlink(os.path.join(FIXTURES_DIR, "mock_docker"), os.path.join(bin_dir, "docker"))
+
+        traceroute_path = os.path.join(bin_dir, "fast-mda-traceroute")
+        with open(traceroute_path, "w") as fp:
+            fp.write('#!/usr/bin/env bash\nexec "%s" "$@"\n' % (MOCK_TRACEROUTE_PATH))
+        os.chmod(traceroute_path, 0o755)
+
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destinations": [
+                "127.0.0.1",
+                {"destination": "127.0.0.2", "label": "two"},
+                "127.0.0.3",
+                "127.0.0.99",
+            ],
+            "executor": "docker_exec",
+            "max_parallel_traceroutes": 2,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        environ = {"PATH": bin_dir + os.pathsep + os.environ["PATH"]}
+
+        with mock.patch.dict(os.environ, environ), mock.patch(
+            "custom_monitors.traceroute_monitor.subprocess.Popen", wraps=subprocess.Popen
+        ) as mock_popen:
+            monitor.gather_sample()
+            monitor.stop(wait_on_join=False)
+
+        # Traceroutes for all the destinations run using a single "docker exec" invocation
+        exec_cmds = [
+            call_args[0][0]
+            for call_args in mock_popen.call_args_list
+            if call_args[0][0][:2] == ["docker", "exec"]
+        ]
+        self.assertEqual(len(exec_cmds), 1)
+        self.assertEqual(
+            exec_cmds[0][-5:], ["2", "127.0.0.1", "127.0.0.2", "127.0.0.3", "127.0.0.99"]
+        )
+
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("127.0.0.99" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertTrue("Network is unreachable" in mock_logger.warn.call_args_list[0][0][0])
+
+        destinations = {}
+        for call_args in mock_logger.emit_value.call_args_list:
+            extra_fields = call_args[1]["extra_fields"]
+            destinations[extra_fields["destination"]] = extra_fields["label"]
+            self.assertEqual(call_args[0][1], 2)
+
+        self.assertEqual(destinations, {"127.0.0.1": "", "127.0.0.2": "two", "127.0.0.3": ""})
+
+    @mock.patch("custom_monitors.traceroute_monitor.subprocess")
+    def test_docker_exec_executor_reuses_worker_container(self, mock_subprocess):
+        worker = TracerouteWorker(
+            executor="docker_exec",
+            docker_image="image",
+            binary_path="fast-mda-traceroute",
+            worker_container_name="worker1",
+        )
+
+        worker.start()
+        worker.start()
+
+        # Container is only started once, after the container which may have been left behind by
+        # the previous agent process has been removed
+        self.assertEqual(mock_subprocess.check_output.call_count, 1)
+        start_cmd = mock_subprocess.check_output.call_args_list[0][0][0]
+        self.assertEqual(start_cmd[:2], ["docker", "run"])
+        self.assertEqual(start_cmd[start_cmd.index("--name") + 1], "worker1")
+
+        self.assertEqual(mock_subprocess.call.call_count, 1)
+        self.assertEqual(
+            mock_subprocess.call.call_args_list[0][0][0], ["docker", "rm", "--force", "worker1"]
+        )
+
+        cmd = worker.get_command("127.0.0.1")
+        self.assertEqual(cmd[:4], ["docker", "exec", "worker1", "fast-mda-traceroute"])
+        self.assertEqual(cmd[-1], "127.0.0.1")
+
+        worker.stop()
+        self.assertEqual(mock_subprocess.call.call_count, 2)
+        self.assertEqual(
+            mock_subprocess.call.call_args_list[1][0][0], ["docker", "rm", "--force", "worker1"]
+        )
+
+    def test_gather_sample_missing_tracelb_record(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.98",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("missing tracelb record" in mock_logger.warn.call_args_list[0][0][0])
+        self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+    def test_gather_sample_timeout(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+            "traceroute_timeout": 0.3,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        with mock.patch.dict(os.environ, {"MOCK_TRACEROUTE_DELAY": "2"}):
+            start_ts = time.time()
+            monitor.gather_sample()
+            duration = time.time() - start_ts
+
+        monitor.stop(wait_on_join=False)
+
+        self.assertTrue(duration < 1.5, "Sample took %s seconds" % (duration))
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertTrue("Timed out" in mock_logger.warn.call_args_list[0][0][0])
+
+    def test_docker_run_executor_kills_container_on_timeout(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        # Fake docker CLI which records "kill" commands and hangs otherwise
+        calls_path = os.path.join(tmp_dir, "calls")
+        docker_path = os.path.join(tmp_dir, "docker")
+
+        with open(docker_path, "w") as fp:
+            fp.write(
+                '#!/bin/sh\nif [ "$1" = "kill" ]; then echo "$@" >> %s; exit 0; fi\nsleep 5\n'
+                % (calls_path)
+            )
+
+        os.chmod(docker_path, 0o755)
+
+        worker = TracerouteWorker(
+            executor="docker_run", docker_image="image", binary_path="fast-mda-traceroute"
+        )
+
+        with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"]}):
+            record, error = worker.run("127.0.0.1", timeout=0.3)
+
+        self.assertEqual(record, None)
+        self.assertTrue("Timed out" in error)
+
+        with open(calls_path, "r") as fp:
+            kill_cmd = fp.read().split()
+
+        self.assertEqual(kill_cmd[0], "kill")
+        self.assertTrue(kill_cmd[1].startswith("fast-mda-traceroute-"))
+
+    def test_docker_exec_executor_wraps_command_with_timeout(self):
+        worker = TracerouteWorker(
+            executor="docker_exec", docker_image="image", binary_path="fast-mda-traceroute"
+        )
+
+        cmd = worker.get_command("127.0.0.1", timeout=2.5)
+        self.assertEqual(cmd[3:8], ["timeout", "-s", "KILL", "3", "fast-mda-traceroute"])
+
+    def test_read_tracelb_record_only_decodes_tracelb_records(self):
+        with open(os.path.join(FIXTURES_DIR, "traceroute/scamper_output.jsonl"), "rb") as fp:
+            lines = [b"Starting traceroute\n"] + fp.readlines()
+
+        with mock.patch(
+            "custom_monitors.traceroute_monitor.scalyr_util.json_decode",
+            wraps=scalyr_util.json_decode,
+        ) as mock_json_decode:
+            record = read_tracelb_record(iter(lines))
+
+        self.assertEqual(mock_json_decode.call_count, 1)
+        self.assertEqual(record["type"], "tracelb")
+        self.assertEqual(record["nodec"], 2)
+
+        self.assertEqual(read_tracelb_record(iter(lines[:2])), None)
+
+    def test_gather_sample_path_change_detection(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        # First sample includes full hop list
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.emit_value.call_count, 1)
+        extra_fields = mock_logger.emit_value.call_args_list[0][1]["extra_fields"]
+        self.assertEqual(extra_fields["hops"], "10.0.0.1,127.0.0.1")
+
+        # Path hasn't changed so compact sample is emitted
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        self.assertEqual(mock_logger.emit_value.call_count, 1)
+        extra_fields = mock_logger.emit_value.call_args_list[0][1]["extra_fields"]
+        self.assertEqual(
+            extra_fields,
+            {
+                "destination": "127.0.0.1",
+                "destination_original": "127.0.0.1",
+                "label": "",
+                "total_rtt": 17.13,
+                "method": "icmp-echo",
+                "path_fingerprint": "607f3c8ced5101b0",
+            },
+        )
+
+        # Path has changed
+        mock_logger.reset_mock()
+        with mock.patch.dict(os.environ, {"MOCK_TRACEROUTE_HOP": "10.0.0.2"}):
+            monitor.gather_sample()
+
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 2)
+        call_args = mock_logger.emit_value.call_args_list[0]
+        self.assertEqual(call_args[0][0], "traceroute.hops")
+        self.assertEqual(call_args[1]["extra_fields"]["hops"], "10.0.0.2,127.0.0.1")
+        self.assertEqual(call_args[1]["extra_fields"]["hop_rtts"], "4.98,12.15")
+
+        call_args = mock_logger.emit_value.call_args_list[1]
+        self.assertEqual(call_args[0], ("traceroute.path_changed", 1))
+        self.assertEqual(call_args[1]["extra_fields"]["hops"], "10.0.0.2,127.0.0.1")
+        self.assertEqual(call_args[1]["extra_fields"]["previous_hops"], "10.0.0.1,127.0.0.1")
+        self.assertEqual(call_args[1]["extra_fields"]["reason"], "hops_changed")
+        self.assertEqual(
+            call_args[1]["extra_fields"]["previous_path_fingerprint"], "607f3c8ced5101b0"
+        )
+
+    def test_gather_sample_always_include_hop_stats(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+            "always_include_hop_stats": True,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        monitor.gather_sample()
+        mock_logger.reset_mock()
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        # Compact sample includes per hop values, but not the full hop list
+        extra_fields = mock_logger.emit_value.call_args_list[0][1]["extra_fields"]
+        self.assertFalse("hops" in extra_fields)
+        self.assertEqual(extra_fields["hop_rtts"], "4.98,12.15")
+        self.assertEqual(extra_fields["hop_loss"], "0.0,0.0")
+
+    def test_gather_sample_path_cache_is_persisted(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+            "path_cache_path": os.path.join(tmp_dir, "paths.json"),
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertTrue(os.path.isfile(os.path.join(tmp_dir, "paths.json")))
+
+        # Path is loaded from the persisted cache so compact sample is emitted
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 1)
+        self.assertFalse("hops" in mock_logger.emit_value.call_args_list[0][1]["extra_fields"])
+
+        # Corrupted cache file is ignored
+        with open(os.path.join(tmp_dir, "paths.json"), "w") as fp:
+            fp.write("{invalid")
+
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+        self.assertEqual(mock_logger.emit_value.call_count, 1)
+        self.assertTrue("hops" in mock_logger.emit_value.call_args_list[0][1]["extra_fields"])
+
+    def test_gather_sample_multipath_hops_are_deduplicated(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        # Diamond (10.0.0.1 -> 10.0.0.2 / 10.0.0.3 -> destination) where destination is a link
+        # target of two nodes and also a node without links
+        with mock.patch.dict(
+            os.environ, {"MOCK_TRACEROUTE_FIXTURE": "scamper_output_multipath.jsonl"}
+        ):
+            monitor.gather_sample()
+
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.emit_value.call_count, 1)
+        call_args = mock_logger.emit_value.call_args_list[0]
+        extra_fields = call_args[1]["extra_fields"]
+        self.assertEqual(call_args[0][1], 4)
+        self.assertEqual(extra_fields["hops"], "10.0.0.1,10.0.0.2,10.0.0.3,127.0.0.1")
+        self.assertEqual(extra_fields["hop_rtts"], "5.0,8.0,10.0,13.0")
+        self.assertEqual(extra_fields["hop_loss"], "0.0,0.0,0.0,0.0")
+        self.assertEqual(extra_fields["total_rtt"], 36.0)
+
+    def test_get_hop_stats(self):
+        node = {
+            "addr": "192.168.1.1",
+            "links": [
+                [
+                    {
+                        "addr": "10.0.0.1",
+                        "probes": [
+                            {"replies": [{"rtt": 2.0}, {"rtt": 4.0}]},
+                            {"replies": []},
+                        ],
+                    },
+                ],
+                [
+                    {
+                        "addr": "10.0.0.2",
+                        "probes": [{"replies": [{"rtt": 6.0}]}, {}],
+                    },
+                ],
+            ],
+        }
+
+        # Each load balanced link target is a separate hop with its own stats
+        self.assertEqual(
+            get_hop_stats(node),
+            [
+                ("10.0.0.1", {"min": 2.0, "max": 4.0, "avg": 3.0, "stddev": 1.0, "loss": 0.5}),
+                ("10.0.0.2", {"min": 6.0, "max": 6.0, "avg": 6.0, "stddev": 0.0, "loss": 0.5}),
+            ],
+        )
+
+        # Probes on multiple links to the same address
+        hop_stats = get_hop_stats(
+            {
+                "addr": "192.168.1.1",
+                "links": [
+                    [{"addr": "10.0.0.1", "probes": [{"replies": [{"rtt": 2.0}]}]}],
+                    [{"addr": "10.0.0.1", "probes": [{"replies": [{"rtt": 4.0}]}, {}]}],
+                ],
+            }
+        )
+        self.assertEqual(
+            hop_stats,
+            [("10.0.0.1", {"min": 2.0, "max": 4.0, "avg": 3.0, "stddev": 1.0, "loss": 0.333})],
+        )
+
+        # Probes without any replies
+        hop_stats = get_hop_stats(
+            {"addr": "192.168.1.1", "links": [[{"addr": "10.0.0.1", "probes": [{}, {}]}]]}
+        )
+        self.assertEqual(hop_stats, [("10.0.0.1", {"loss": 1.0})])
+
+        # Node without any links
+        self.assertEqual(get_hop_stats({"addr": "8.8.8.8"}), [("8.8.8.8", None)])
+
+    def test_format_hop_values_keeps_hops_aligned(self):
+        hops_stats = [{"avg": 1.5, "loss": 0.0}, None, {"loss": 1.0}, {"avg": 10.0, "loss": 0.5}]
+
+        self.assertEqual(format_hop_values(hops_stats, "avg"), "1.5,,,10.0")
+        self.assertEqual(format_hop_values(hops_stats, "loss"), "0.0,,1.0,0.5")
+
+    @mock.patch("custom_monitors.traceroute_monitor.time")
+    def test_gather_sample_adaptive_scheduling(self, mock_time):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+            "sample_interval": 60,
+            "adaptive_scheduling": True,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        emit_counts = []
+        for now in [1000, 1060, 1120, 1180]:
+            mock_time.time.return_value = now
+            mock_logger.reset_mock()
+            monitor.gather_sample()
+            emit_counts.append(mock_logger.emit_value.call_count)
+
+        monitor.stop(wait_on_join=False)
+
+        # Path and RTT were stable on the second run so the third sample is skipped
+        self.assertEqual(emit_counts, [1, 1, 0, 1])
+
+    def test_scheduler_adaptive_backoff(self):
+        scheduler = TracerouteScheduler(
+            base_interval=60, adaptive=True, max_backoff_multiplier=4, rtt_deviation_threshold=0.2
+        )
+
+        multipliers = []
+        for total_rtt in [10.0, 10.5, 9.8, 10.1, 10.0]:
+            scheduler.update("dst", fingerprint="a", total_rtt=total_rtt, now=0)
+            multipliers.append(scheduler.get_multiplier("dst"))
+
+        self.assertEqual(multipliers, [1, 2, 4, 4, 4])
+
+        # RTT deviation resets the interval
+        scheduler.update("dst", fingerprint="a", total_rtt=20.0, now=0)
+        self.assertEqual(scheduler.get_multiplier("dst"), 1)
+
+        scheduler.update("dst", fingerprint="a", total_rtt=13.0, now=0)
+        self.assertEqual(scheduler.get_multiplier("dst"), 2)
+
+        # Path change resets the interval
+        scheduler.update("dst", fingerprint="b", total_rtt=13.0, now=0)
+        self.assertEqual(scheduler.get_multiplier("dst"), 1)
+
+        scheduler.update("dst", fingerprint="b", total_rtt=13.0, now=0)
+        self.assertEqual(scheduler.get_multiplier("dst"), 2)
+
+        # Failure resets the interval
+        scheduler.update("dst", fingerprint=None, total_rtt=None, now=0)
+        self.assertEqual(scheduler.get_multiplier("dst"), 1)
+
+        # Destination is due approximately multiplier sample intervals later
+        target = TracerouteTarget(destination="127.0.0.1")
+        scheduler.update("127.0.0.1", fingerprint="b", total_rtt=13.0, now=0)
+        scheduler.update("127.0.0.1", fingerprint="b", total_rtt=13.0, now=0)
+        self.assertEqual(scheduler.get_due_targets([target], now=60), [])
+        self.assertEqual(scheduler.get_due_targets([target], now=120), [target])
+
+    def test_scheduler_probe_budget(self):
+        scheduler = TracerouteScheduler(base_interval=60, probe_budget_per_minute=2)
+        targets = [mock.Mock(destination="dst%s" % (index)) for index in range(0, 3)]
+
+        self.assertEqual(scheduler.get_due_targets(targets, now=0), targets[:2])
+
+        for target in targets[:2]:
+            scheduler.update(target.destination, fingerprint="a", total_rtt=10.0, now=1)
+
+        # Budget is exhausted, deferred destination is first once budget is refilled
+        self.assertEqual(scheduler.get_due_targets(targets, now=1), [])
+        self.assertEqual(scheduler.get_due_targets(targets, now=31), [targets[2]])
+
+    def test_scheduler_probe_budget_charges_probes_count(self):
+        scheduler = TracerouteScheduler(base_interval=60, probe_budget_per_minute=100)
+        targets = [mock.Mock(destination="dst%s" % (index)) for index in range(0, 2)]
+
+        # Probes count is not known yet so each traceroute is charged a single probe
+        self.assertEqual(scheduler.get_due_targets(targets, now=0), targets)
+
+        # Actual probes count is charged once the results are available
+        scheduler.update("dst0", fingerprint="a", total_rtt=10.0, now=0, probes_count=60)
+        scheduler.update("dst1", fingerprint="a", total_rtt=10.0, now=0, probes_count=30)
+
+        # 10 probes are left which isn't enough for either of the destinations
+        self.assertEqual(scheduler.get_due_targets(targets, now=0), [])
+
+        # After 30 seconds, 60 probes are left which is only enough for the first destination
+        self.assertEqual(scheduler.get_due_targets(targets, now=30), [targets[0]])
+        scheduler.update("dst0", fingerprint="a", total_rtt=10.0, now=30, probes_count=60)
+
+        # Traceroute which needs more probes than the bucket can hold runs once the bucket is full
+        scheduler = TracerouteScheduler(base_interval=60, probe_budget_per_minute=100)
+        self.assertEqual(scheduler.get_due_targets(targets[:1], now=0), targets[:1])
+        scheduler.update("dst0", fingerprint="a", total_rtt=10.0, now=0, probes_count=150)
+
+        self.assertEqual(scheduler.get_due_targets(targets[:1], now=60), [])
+        self.assertEqual(scheduler.get_due_targets(targets[:1], now=120), targets[:1])
+
+    def test_scheduler_traceroute_interval(self):
+        scheduler = TracerouteScheduler(base_interval=300, sample_interval=60)
+        target = TracerouteTarget(destination="127.0.0.1")
+
+        self.assertEqual(scheduler.get_due_targets([target], now=0), [target])
+        scheduler.update("127.0.0.1", fingerprint="a", total_rtt=10.0, now=0)
+
+        self.assertEqual(scheduler.get_due_targets([target], now=240), [])
+        self.assertEqual(scheduler.get_due_targets([target], now=300), [target])
+
+    def test_icmp_checksum(self):
+        packet = struct.pack("!BBHHH", 8, 0, 0, 0x1234, 1) + b"payload"
+        checksum = get_icmp_checksum(packet)
+        packet = struct.pack("!BBHHH", 8, 0, checksum, 0x1234, 1) + b"payload"
+
+        # Checksum of the data which includes a valid checksum is always 0
+        self.assertEqual(get_icmp_checksum(packet), 0)
+
+    def test_icmp_prober(self):
+        skip_if_icmp_sockets_are_not_available(self)
+
+        prober = IcmpProber(count=3, interval=0.05, timeout=0.5)
+        self.addCleanup(prober.close)
+
+        # Probes to the broadcast address can't be sent so they are counted as lost
+        results = prober.probe(["127.0.0.1", "255.255.255.255"])
+
+        self.assertEqual(results["127.0.0.1"]["sent"], 3)
+        self.assertEqual(len(results["127.0.0.1"]["rtts"]), 3)
+        self.assertEqual(results["255.255.255.255"]["sent"], 3)
+        self.assertEqual(len(results["255.255.255.255"]["rtts"]), 0)
+
+    @mock.patch("custom_monitors.traceroute_monitor.get_dns_ttl", mock.Mock(return_value=None))
+    def test_gather_sample_icmp_probe_mode(self):
+        skip_if_icmp_sockets_are_not_available(self)
+
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "localhost",
+            "label": "local",
+            "probe_mode": "icmp",
+            "icmp_probe_count": 4,
+            "icmp_probe_interval": 0.05,
+            "icmp_probe_timeout": 0.5,
+            # Traceroute is not used in this probe mode
+            "traceroute_binary_path": "/invalid",
+            "executor": "local",
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        # Resolution is blocked until the first sample has finished
+        resolution_event = threading.Event()
+        gethostbyname = socket.gethostbyname
+
+        def mock_gethostbyname(hostname):
+            resolution_event.wait(5)
+            return gethostbyname(hostname)
+
+        with mock.patch("socket.gethostbyname", side_effect=mock_gethostbyname):
+            # Destination host name is resolved in the background so it's skipped on the first
+            # sample
+            monitor.gather_sample()
+            self.assertEqual(mock_logger.emit_value.call_count, 0)
+
+            resolution_event.set()
+            time.sleep(0.2)
+
+        monitor.gather_sample()
+        monitor.stop(wait_on_join=False)
+
+        self.assertEqual(mock_logger.warn.call_count, 0)
+
+        metric_names = [call_args[0][0] for call_args in mock_logger.emit_value.call_args_list]
+        self.assertEqual(
+            metric_names,
+            [
+                "traceroute.dns.resolution_time_ms",
+                "traceroute.probe.loss",
+                "traceroute.probe.rtt.min",
+                "traceroute.probe.rtt.avg",
+                "traceroute.probe.rtt.p50",
+                "traceroute.probe.rtt.p90",
+                "traceroute.probe.rtt.p99",
+                "traceroute.probe.rtt.max",
+            ],
+        )
+        self.assertEqual(mock_logger.emit_value.call_args_list[1][0][1], 0.0)
+        self.assertEqual(
+            mock_logger.emit_value.call_args_list[1][1]["extra_fields"],
+            {"destination": "127.0.0.1", "destination_original": "localhost", "label": "local"},
+        )
+
+        values = [call_args[0][1] for call_args in mock_logger.emit_value.call_args_list[2:]]
+        self.assertEqual(values[0], min(values))
+        self.assertEqual(values[-1], max(values))
+
+    @mock.patch("custom_monitors.traceroute_monitor.get_dns_ttl", mock.Mock(return_value=120))
+    @mock.patch("custom_monitors.traceroute_monitor.socket.gethostbyname")
+    def test_destination_resolver(self, mock_gethostbyname):
+        mock_gethostbyname.side_effect = ["127.0.0.1", socket.gaierror("Temporary failure")]
+        mock_logger = mock.Mock()
+        targets = [
+            TracerouteTarget(destination="127.0.0.2"),
+            TracerouteTarget(destination="example.test"),
+            TracerouteTarget(destination="example.test", label="same"),
+        ]
+        resolver = DestinationResolver(
+            targets, refresh_interval=600, min_refresh_interval=30, logger=mock_logger
+        )
+
+        # IP addresses don't need to be resolved
+        self.assertEqual(targets[0].destination_ipv4, "127.0.0.2")
+        self.assertEqual(targets[1].destination_ipv4, None)
+
+        # Host name is only resolved once for all the targets and refreshed once TTL expires
+        self.assertEqual(resolver.resolve(now=0), 120)
+        self.assertEqual(mock_gethostbyname.call_count, 1)
+        self.assertEqual(targets[1].destination_ipv4, "127.0.0.1")
+        self.assertEqual(targets[2].destination_ipv4, "127.0.0.1")
+
+        events = resolver.get_events()
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]["previous_ipv4"], None)
+        self.assertEqual(events[0]["ipv4"], "127.0.0.1")
+        self.assertTrue(events[0]["resolution_time_ms"] >= 0)
+        self.assertEqual(resolver.get_events(), [])
+
+        # Host name isn't resolved again before TTL expires
+        self.assertEqual(resolver.resolve(now=60), 120)
+        self.assertEqual(mock_gethostbyname.call_count, 1)
+
+        # Previously resolved address is used on failure and resolution is retried after the
+        # minimum refresh interval
+        self.assertEqual(resolver.resolve(now=120), 150)
+        self.assertEqual(mock_gethostbyname.call_count, 2)
+        self.assertEqual(mock_logger.warn.call_count, 1)
+        self.assertEqual(targets[1].destination_ipv4, "127.0.0.1")
+        self.assertEqual(resolver.get_events(), [])
+
+    def test_get_dns_response_ttl(self):
+        query = get_dns_query(0x1234, "www.example.test")
+        self.assertEqual(query[12:30], b"\x03www\x07example\x04test\x00")
+
+        # Response with a CNAME record (name compressed using a pointer to the question) followed
+        # by an A record for the CNAME target
+        answers = (
+            b"\xc0\x0c" + struct.pack("!HHIH", 5, 1, 3600, 4) + b"\x01a\xc0\x10"
+            + b"\xc0\x2e" + struct.pack("!HHIH", 1, 1, 60, 4) + socket.inet_aton("127.0.0.1")
+        )
+        response = struct.pack("!HHHHHH", 0x1234, 0x8180, 1, 2, 0, 0) + query[12:] + answers
+
+        # Shortest TTL in the chain is used
+        self.assertEqual(get_dns_response_ttl(response, 0x1234), 60)
+
+        # Response for a different query
+        self.assertEqual(get_dns_response_ttl(response, 0x4321), None)
+
+        # Response without any A records
+        response = struct.pack("!HHHHHH", 0x1234, 0x8183, 1, 0, 0, 0) + query[12:]
+        self.assertEqual(get_dns_response_ttl(response, 0x1234), None)
+
+    @mock.patch("custom_monitors.traceroute_monitor.get_dns_ttl", mock.Mock(return_value=None))
+    def test_gather_sample_destination_change_is_path_change(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "example.test",
+            "executor": "local",
+            "traceroute_binary_path": MOCK_TRACEROUTE_PATH,
+            "dns_refresh_interval": 1,
+        }
+        mock_logger = mock.Mock()
+        monitor = TracerouteMonitor(monitor_config, mock_logger)
+
+        resolved_addresses = ["127.0.0.1"]
+
+        def mock_gethostbyname_func(hostname):
+            time.sleep(0.2)
+            return resolved_addresses[0]
+
+        with mock.patch(
+            "custom_monitors.traceroute_monitor.socket.gethostbyname",
+            side_effect=mock_gethostbyname_func,
+        ):
+            # Resolution happens in the background and never blocks the sample
+            start_ts = time.time()
+            monitor.gather_sample()
+            self.assertTrue(time.time() - start_ts < 0.2)
+            self.assertEqual(mock_logger.emit_value.call_count, 0)
+            time.sleep(0.4)
+
+            monitor.gather_sample()
+            metric_names = [
+                call_args[0][0] for call_args in mock_logger.emit_value.call_args_list
+            ]
+            self.assertEqual(metric_names, ["traceroute.dns.resolution_time_ms", "traceroute.hops"])
+
+            resolved_addresses[0] = "127.0.0.2"
+            time.sleep(1.2)
+
+            mock_logger.reset_mock()
+            monitor.gather_sample()
+            monitor.stop(wait_on_join=False)
+
+        metric_names = [call_args[0][0] for call_args in mock_logger.emit_value.call_args_list]
+        self.assertEqual(
+            metric_names,
+            [
+                "traceroute.dns.resolution_time_ms",
+                "traceroute.path_changed",
+                "traceroute.hops",
+            ],
+        )
+
+        extra_fields = mock_logger.emit_value.call_args_list[1][1]["extra_fields"]
+        self.assertEqual(extra_fields["reason"], "destination_changed")
+        self.assertEqual(extra_fields["previous_destination"], "127.0.0.1")
+        self.assertEqual(extra_fields["destination"], "127.0.0.2")
+
+        # Cached path has been reset so full hop list is emitted again
+        extra_fields = mock_logger.emit_value.call_args_list[2][1]["extra_fields"]
+        self.assertEqual(extra_fields["hops"], "10.0.0.1,127.0.0.2")
+
+    def test_invalid_config(self):
+        monitor_config = {
+            "module": "traceroute_monitor",
+        }
+
+        with self.assertRaises(ValueError):
+            TracerouteMonitor(monitor_config, mock.Mock())
+
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "executor": "invalid",
+        }
+
+        with self.assertRaises(ValueError):
+            TracerouteMonitor(monitor_config, mock.Mock())
+
+        monitor_config = {
+            "module": "traceroute_monitor",
+            "destination": "127.0.0.1",
+            "probe_mode": "invalid",
+        }
+
+        with self.assertRaises(ValueError):
+            TracerouteMonitor(monitor_config, mock.Mock())
@@ -0,0 +1,68 @@
+# Copyright 2020 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Simulated VideoCore mailbox device which is used by the Raspberry Pi monitor tests and benchmarks
+so they don't need a Raspberry Pi.
+"""
+
+import struct
+
+from custom_monitors.raspberry_pi_monitor import IOCTL_MBOX_PROPERTY
+from custom_monitors.raspberry_pi_monitor import MBOX_TAG_GET_GENCMD_RESULT
+from custom_monitors.raspberry_pi_monitor import MBOX_RESPONSE_SUCCESS
+
+# Same output as returned by tests/fixtures/mock_vcgencmd
+MOCK_VCGENCMD_OUTPUT = {
+    "measure_temp": "temp=49.0'C",
+    "get_throttled": "throttled=0x0",
+    "measure_clock arm": "frequency(48)=1800404352",
+    "measure_clock core": "frequency(1)=500000992",
+    "measure_clock H264": "frequency(0)=0",
+    "measure_clock emmc": "frequency(50)=250000496",
+    "measure_clock vec": "frequency(10)=0",
+    "measure_volts core": "volt=0.9400V",
+    "measure_volts sdram_c": "volt=1.1000V",
+    "measure_volts sdram_i": "volt=1.1000V",
+    "measure_volts sdram_p": "volt=1.1000V",
+}
+
+
+class MockMailbox(object):
+    """
+    Simulates VideoCore mailbox "get gencmd result" property requests.
+    """
+
+    def __init__(self, output=None):
+        self.output = output if output is not None else MOCK_VCGENCMD_OUTPUT
+        self.commands = []
+
+    def ioctl(self, fd, request, buf, mutate_flag=True):
+        assert request == IOCTL_MBOX_PROPERTY
+        assert struct.unpack_from("=I", buf, 8)[0] == MBOX_TAG_GET_GENCMD_RESULT
+
+        command = bytes(buf[24:]).split(b"\0", 1)[0].decode("utf-8")
+        self.commands.append(command)
+
+        if command in self.output:
+            error_code, output = 0, self.output[command]
+        else:
+            error_code, output = 1, "error=1 error_msg=\"Command not registered\""
+
+        data = output.encode("utf-8") + b"\0"
+        buf[24:24 + len(data)] = data
+        struct.pack_into("=I", buf, 4, MBOX_RESPONSE_SUCCESS)
+        struct.pack_into("=I", buf, 20, error_code)
+
+        return 0
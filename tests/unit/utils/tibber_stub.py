@@ -0,0 +1,167 @@
+# Copyright 2023 Tomaz Muraus
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stub "tibber" module which is used by the tests and benchmarks so they don't need tibber library,
+network access or a Tibber account.
+
+Stub follows the tibber library contract - live feed reads websocket subscription URL from the
+account viewer data and refreshes the account data asynchronously once the websocket connection
+has been established. Account discovery API latency is simulated using API_LATENCY.
+"""
+
+import time
+import types
+import asyncio
+
+# Simulated latency (in seconds) of the account discovery GraphQL API calls
+API_LATENCY = 0.5
+
+WEBSOCKET_SUBSCRIPTION_URL = "wss://websocket-api.tibber.com/v1-beta/gql/subscriptions"
+
+HOME_DATA = {"id": "home-1", "features": {"realTimeConsumptionEnabled": True}}
+
+ACCOUNT_DATA = {
+    "viewer": {"websocketSubscriptionUrl": WEBSOCKET_SUBSCRIPTION_URL, "homes": [HOME_DATA]}
+}
+
+
+class StubLiveMeasurement(object):
+    """
+    Live measurement which exposes the same attributes as tibber.types.LiveMeasurement in
+    tibber.py 0.7.1 for the raw GraphQL live measurement data.
+    """
+
+    def __init__(self, data, tibber_client=None):
+        self.cache = data or {}
+        self.tibber_client = tibber_client
+
+    power = property(lambda self: self.cache.get("power"))
+    power_production = property(lambda self: self.cache.get("powerProduction"))
+    accumulated_consumption = property(lambda self: self.cache.get("accumulatedConsumption"))
+    voltage_phase_1 = property(lambda self: self.cache.get("voltagePhase1"))
+    voltage_phase_2 = property(lambda self: self.cache.get("voltagePhase2"))
+    voltage_phase_3 = property(lambda self: self.cache.get("voltagePhase3"))
+    currentL1 = property(lambda self: self.cache.get("currentL1"))
+    currentL2 = property(lambda self: self.cache.get("currentL2"))
+    currentL3 = property(lambda self: self.cache.get("currentL3"))
+
+
+class StubTibberHome(object):
+    def __init__(self, data, tibber_client):
+        self.cache = data
+        self.id = data["id"]
+        self.features = types.SimpleNamespace(
+            real_time_consumption_enabled=data["features"]["realTimeConsumptionEnabled"]
+        )
+        self.tibber_client = tibber_client
+        self.callbacks = []
+        # Websocket subscription URL and arguments used by the live feed
+        self.websocket_subscription_url = None
+        self.live_feed_retries = None
+        self.transport_kwargs = None
+
+    def event(self, event_name):
+        def decorator(func):
+            self.callbacks.append(func)
+            return func
+
+        return decorator
+
+    async def start_websocket_loop(
+        self, exit_condition=None, retries=3, retry_interval=10, **kwargs
+    ):
+        # NOTE: Signature matches TibberHome.start_websocket_loop() from tibber.py 0.7.1 where
+        # additional keyword arguments are passed to the gql websocket transport
+        if retry_interval < 1:
+            raise ValueError("The retry interval must be at least 1 second.")
+
+        self.live_feed_retries = retries
+        self.transport_kwargs = kwargs
+
+        url = self.tibber_client.viewer.websocket_subscription_url
+
+        if not url:
+            raise ValueError("Websocket subscription URL is not available")
+
+        self.websocket_subscription_url = url
+
+        # Account data is refreshed once the connection has been established
+        await self.tibber_client.update_async()
+
+        while True:
+            measurement = StubLiveMeasurement({"power": 1000}, self.tibber_client)
+
+            for callback in self.callbacks:
+                await callback(measurement)
+
+            if exit_condition and exit_condition(measurement):
+                return
+
+            await asyncio.sleep(0.01)
+
+
+class StubViewer(object):
+    def __init__(self, data, tibber_client):
+        self.cache = data or {}
+        self.tibber_client = tibber_client
+
+    @property
+    def websocket_subscription_url(self):
+        return self.cache.get("websocketSubscriptionUrl")
+
+    @property
+    def homes(self):
+        return [StubTibberHome(home, self.tibber_client) for home in self.cache.get("homes", [])]
+
+
+class StubAccount(object):
+    def __init__(self, token, user_agent=None, immediate_update=True):
+        self.cache = {}
+        self.token = token
+        self.user_agent = user_agent
+
+        if immediate_update:
+            time.sleep(API_LATENCY)
+            self.update_cache(ACCOUNT_DATA)
+
+    async def update_async(self):
+        await asyncio.sleep(API_LATENCY)
+        self.update_cache(ACCOUNT_DATA)
+
+    def update_cache(self, data):
+        self.cache = dict(self.cache, **data)
+
+    @property
+    def viewer(self):
+        return StubViewer(self.cache.get("viewer"), self)
+
+    @property
+    def homes(self):
+        return self.viewer.homes
+
+
+def get_stub_modules():
+    """
+    Return stub "tibber" modules keyed by the module name which can be installed into sys.modules.
+    """
+    tibber_module = types.ModuleType("tibber")
+    tibber_module.Account = StubAccount
+
+    tibber_types_module = types.ModuleType("tibber.types")
+    tibber_types_module.TibberHome = StubTibberHome
+    tibber_types_module.LiveMeasurement = StubLiveMeasurement
+    tibber_module.types = tibber_types_module
+
+    return {"tibber": tibber_module, "tibber.types": tibber_types_module}